@@ -1,3 +1,6 @@
+from concurrent.futures import ThreadPoolExecutor
+
+
 def get_clients_dict(args, clients={}):
     if "alloc" in clients and clients["alloc"]:
         alloc = True
@@ -85,10 +88,10 @@ def get_clients(args, alloc=True, ldap=True, slurm=True, lustre=True,
         ldap_cl = None
     
     if slurm:
-        from mercslurm.slurm import SlurmClient
+        from mercslurm.slurm import get_slurm_client
         with open(os.path.join(config_dir, 'slurmconfig.yml')) as f:
             slurm_config = yaml.full_load(f.read())
-        slurm_cl = SlurmClient(**slurm_config)
+        slurm_cl = get_slurm_client(**slurm_config)
     else:
         slurm_cl = None
     
@@ -288,6 +291,7 @@ def provision_project(args):
                     storageClient.create(mntpt, project, alloc_config[quotatype][mntpt], newfs=args.newscratch)
 
         # Check that things have actually been updated
+        slurmClient.invalidate_snapshot()
         updated_slurm_assocs = slurmClient.get_all_parent_projects()
         for project in projs_to_explore_limited:
             # Check the slurm parents
@@ -367,7 +371,7 @@ def get_user_account_combo(args):
             log.info("{} belongs to groups {}".format(args.username, groups))
 
             for g in groups:
-                g = g[0].decode('utf-8')
+                g = g[0]
                 account_user_dict_ldap[g].append(args.username)
         else:
             log.critical("homedir doesn't exist for {}".format(args.username))
@@ -385,8 +389,10 @@ def get_user_account_combo(args):
         if args.cluster.lower() == 'cvl':
             validprojs = [p for p in validprojs if allocsClient.get_project_parent(p) == 'p004']
 
+        # One paged search for every group rather than a search per project
+        membership = ldapClient.getMembershipIndex()
         for p in validprojs:
-            group_members = ldapClient.getMembers(p)
+            group_members = membership.getMembers(p)
             group_members = [m.split(",")[0][4:] for m in group_members]
             log.debug(
                 "Group {} has members {}".format(p, ", ".join(group_members))
@@ -426,6 +432,9 @@ def create_slurm_associations(args, account_user_dict_ldap=None):
     account_user_dict_slurm = slurmClient.get_cluster_associations(args.cluster.lower())
     slurm_accounts = account_user_dict_slurm.keys()
 
+    # Adds are queued and written per account once everything is checked
+    batch = slurmClient.association_batch()
+
     for account, group_members in account_user_dict_ldap.items():
         if account in slurmClient.get_mx_caps():
             log.debug('Account is MX CAP, ignoring')
@@ -450,21 +459,19 @@ def create_slurm_associations(args, account_user_dict_ldap=None):
             if member in slurm_users:
                 pass
             else:
-                log.critical('Adding user {} to slurm assoc {}'.format(member,
-                                                                       account))
-                slurmClient.add_user(account, member)
-                slackgdict[member].append(account)
+                log.debug('Queueing user {} for slurm assoc {}'.format(member,
+                                                                      account))
+                batch.add(account, member)
         else:
             for member in group_members:
                 if member in slurm_users:
                     pass
                 else:
-                    log.critical(
-                        'Adding user {} to slurm assoc {}'.format(member,
-                                                                  account)
+                    log.debug(
+                        'Queueing user {} for slurm assoc {}'.format(member,
+                                                                     account)
                     )
-                    slurmClient.add_user(account, member)
-                    slackgdict[member].append(account)
+                    batch.add(account, member)
 
             ## Commented out by KW to prevent slurmdb crashes due to rm user
             # for member in slurm_users:
@@ -482,6 +489,19 @@ def create_slurm_associations(args, account_user_dict_ldap=None):
             'Checking slurm associations for group {} with '
             'users {} is complete'.format(account, ", ".join(group_members)))
 
+    # Only report the adds sacctmgr accepted (or would run, in a dry run)
+    for verb, account, names, returncode in batch.flush():
+        for member in names:
+            if returncode in (0, None):
+                log.critical('Adding user {} to slurm assoc {}'.format(member,
+                                                                       account))
+                slackgdict[member].append(account)
+            else:
+                log.error('Failed to add user {} to slurm assoc {}'.format(member,
+                                                                          account))
+                slackf += 'Failed to add user `{}` to slurm assoc `{}`\n'.format(member,
+                                                                              account)
+
     for user in slackgdict.keys():
         slackg += 'Adding user `{}` to slurm assoc(s) `{}`\n'.format(user, ", ".join(slackgdict[user]))
 
@@ -578,6 +598,35 @@ def provision_user_links(args):
     return
 
 
+def default_account_handler(args):
+    """Set every user's default slurm account to their highest fairshare
+    account in one sweep"""
+    import logging
+    log = logging.getLogger('mgid.default_accounts')
+
+    clients = get_clients_dict(args, clients={"slurm": True, "slack": True})
+    slurmClient = clients["slurm"]
+    slackClient = clients["slack"]
+
+    users = None
+    if args.username:
+        users = [args.username]
+    changes = slurmClient.reconcile_default_accounts(users)
+
+    comp = ''
+    for user in sorted(changes):
+        comp += 'Default account for `{}` {} -> `{}`\n'.format(
+            user, changes[user][0], changes[user][1])
+    log.debug("Changed {} default accounts".format(len(changes)))
+
+    if args.execute:
+        slackClient.send_slack('', comp, '', 'manageid-default-accounts',
+                               'slurm')
+    else:
+        slackClient.send_slack('', '', comp, 'manageid-default-accounts-dry-run',
+                               'slurm', True)
+
+
 def check_sudo_permission():
     """Try and rename a file that requires sudo permissions, use this as an
     easy way to check if the user has sudo permissions or not as it'll throw
@@ -611,7 +660,6 @@ def check_if_cronjob():
 def homedir_handler(args):
     import logging
     import os
-    import pwd
     import grp
 
     # Set up the logging
@@ -626,12 +674,13 @@ def homedir_handler(args):
     slackClient = clients["slack"]
 
     from merchpcuser.hpcuser import HPCUserClient
+    from merchpcuser import nss
 
     # Determine who 'nobody' is and who 'root' is
     unowned = {}
-    nobody = pwd.getpwnam('nobody')
+    nobody = nss.getpwnam('nobody')
     unowned['nobody'] = {'uid': nobody.pw_uid, 'gid': nobody.pw_gid}
-    root = pwd.getpwnam('root')
+    root = nss.getpwnam('root')
     unowned['root'] = {'uid': root.pw_uid, 'gid': root.pw_gid}
 
     # Fetch the cluster groups
@@ -657,56 +706,53 @@ def homedir_handler(args):
     # Fetch the cluster acl members
     cluster_acl_users = [x for x in ldapClient.getMembers(cluster, ou=ou)]
     log.debug("cluster ACL has {} members".format(len(cluster_acl_users)))
+    log.debug("Nested group expansion cache: {}".format(ldapClient.expansionStats()))
 
-    # Fetch the uid, gid, and symlink status of each directory in home
-    # and store it in a dictionary for use later on
-    homedict = {}
-    with os.scandir(home) as it:
-        for entry in it:
-            if entry.is_dir():
-                s = entry.stat()
-                homedict[entry.name] = {'uid': s.st_uid, 'gid': s.st_gid,
-                                        'symlink': entry.is_symlink()}
-
-    # Iterate over the users in the ACL group and determine if they have a
-    # homedir that is owned by them, skipping symlinks to lustre
-    users_to_explore = {}
-    users_to_ignore = {}
-    users_with_key_issues = {}
-    for user in cluster_acl_users:
-        uid = user.split(",")[0].split("=")[-1]
-        path = "/".join((home, uid))
-
-        h = HPCUserClient(uid).UserHome(home, uid)
-        keys = h.check_user_keys()
-        auth = h.check_user_auth()
-        idrsa = h.check_user_idrsa()
-        if not keys or not auth or not idrsa:
-            users_with_key_issues[uid] = ['Keys', keys, 'Auth', auth, 'id_rsa', idrsa]
+    # Inventory home once: one scandir of the mount plus parallel stats of
+    # the ACL members' homes and .ssh directories
+    from merchpcuser.inventory import HomeInventory
+    acl_uids = set([user.split(",")[0].split("=")[-1] for user in cluster_acl_users])
+    inventory = HomeInventory(home).scan(acl_uids)
 
+    users_with_key_issues = {}
+    for uid in sorted(inventory.missing(acl_uids)):
+        log.error("ZFS or NFS directory not found for user {}, skipping...".format(uid))
+    for uid in sorted(acl_uids & inventory.symlinked()):
         # Temporary hack to get around the lustre homedirs
+        log.debug("Skipping {} as it is a symlink, probably to lustre".format("/".join((home, uid))))
+    candidates = acl_uids & inventory.names() - inventory.symlinked()
+
+    # Get the uidnumber, gidnumber, check that the directory has the
+    # correct ownership and group membership
+    owners = {}
+    for uid in candidates:
+        state = inventory[uid]
+        if not state.has_idrsa or not state.has_auth:
+            users_with_key_issues[uid] = ['Auth', state.has_auth, 'id_rsa', state.has_idrsa]
         try:
-            if homedict[uid]['symlink']:
-                log.debug("Skipping {} as it is a symlink, probably to lustre".format(path))
-                continue
+            user_attrs = nss.getpwnam(uid)
+            owners[uid] = (user_attrs.pw_uid, user_attrs.pw_gid)
         except KeyError as e:
-            log.error("ZFS or NFS directory not found for user {}, skipping...".format(uid))
-            continue
-        except Exception as e:
-            log.exception(e)
-
-        # Get the uidnumber, gidnumber, check that the directory has the
-        # correct ownership and group membership
-        try:
-            if h.check_ownership(h.homepath):
-                continue
-            else:
-                users_to_explore[uid] = homedict[uid]
-        except Exception as e:
             log.exception(e)
             log.exception("User {} should have a home dir but doesn't, check "
                           "the output of manageid zfs (M3) or manageid nfs "
-                          "(MonARCH)")
+                          "(MonARCH)".format(uid))
+    users_to_explore = dict([(uid, inventory[uid].as_dict())
+                             for uid in sorted(inventory.misowned(owners))])
+    users_to_ignore = candidates - set(users_to_explore)
+
+    # Check that each public key is authorized, skipping homes whose key
+    # files are unchanged since the last run
+    from merchpcuser.keyaudit import KeyAudit
+    audit = KeyAudit(getattr(args, 'keycache', None))
+    keyed = [HPCUserClient().UserHome(home, uid) for uid in sorted(owners)
+             if uid not in users_with_key_issues]
+    for uid, keys in audit.audit(keyed, inventory,
+                                 full=getattr(args, 'fullaudit', False)).items():
+        if not keys:
+            users_with_key_issues[uid] = ['Keys', keys]
+    audit.close()
+    log.debug("Users with key issues: {}".format(len(users_with_key_issues)))
 
     log.debug("Users to explore: {}".format(len(users_to_explore)))
     log.debug("Users to ignore: {}".format(len(users_to_ignore)))
@@ -720,11 +766,12 @@ def homedir_handler(args):
     else:
         upper_limit = args.number
 
-    failed = []
-    completed = []
-    # Handle users who don't have the correct permissions
-    log.debug("Processing {} users".format(upper_limit))
-    for user in {k: users_to_explore[k] for k in list(users_to_explore)[:upper_limit]}:
+    # Handle users who don't have the correct permissions. Each user's home
+    # is independent, so outside a dry run several are fixed at once; the
+    # filesystem commands themselves are bounded by the mysubprocess engine
+    keytype = getattr(args, 'keytype', 'ed25519')
+
+    def fix(user):
         if (users_to_explore[user]['uid'] == unowned['nobody']['uid'] and
                 users_to_explore[user]['gid'] == unowned['nobody']['gid']):
             log.debug(
@@ -734,23 +781,48 @@ def homedir_handler(args):
             log.debug(
                 'Dir /home/{} belongs to root:root, homedir has likely not been provisioned...'.format(user))
         try:
-            h = HPCUserClient(user).UserHome(home, user)
+            h = HPCUserClient(user).UserHome(home, user, keytype=keytype)
             log.info('Homedir exists for user {}: {}'.format(
                 user, h.check_user_home())
             )
             log.info('Keys set up for user {}: {}'.format(
                 user, h.check_user_keys())
             )
-            user_attrs = pwd.getpwnam(user)
+            user_attrs = nss.getpwnam(user)
             h.fix_home(user_attrs.pw_uid, user_attrs.pw_gid)
-            if h.check_user_home() and h.check_ownership(h.homepath) and \
-                h.check_user_keys():
-                completed.append('`{}`'.format(user))
-            else:
-                failed.append('`{}`'.format(user))
+            return h.check_user_home() and h.check_ownership(h.homepath) and \
+                h.check_user_keys()
         except Exception as e:
             log.exception(e)
 
+    failed = []
+    completed = []
+    log.debug("Processing {} users".format(upper_limit))
+    users = list(users_to_explore)[:upper_limit]
+
+    # Generate the missing keys as one batch across all cores first,
+    # fix_home then finds them in place. A dry run just lists them there
+    import mysubprocess
+    if not mysubprocess.debug:
+        from merchpcuser import sshkeys
+        sshkeys.create_keys([(os.path.join(home, user, '.ssh', sshkeys.keyname(keytype)), user)
+                             for user in users if not inventory[user].has_idrsa],
+                            keytype)
+    if mysubprocess.debug:
+        # A dry run fixes one home after another so the printed commands
+        # still read as a script per user
+        results = [fix(user) for user in users]
+    else:
+        with ThreadPoolExecutor(max_workers=getattr(args, 'workers', 8)) as pool:
+            results = list(pool.map(fix, users))
+    for user, ok in zip(users, results):
+        if ok is None:
+            continue
+        if ok:
+            completed.append('`{}`'.format(user))
+        else:
+            failed.append('`{}`'.format(user))
+
     # Report on the results
     slack_name = 'manageid-userhome'
     if not args.execute:
@@ -821,6 +893,7 @@ def nfs_handler(args):
     cluster_acl_users = [x for x in ldapClient.getMembers(cluster, ou=ou)]
     log.debug("There are {} users in cn={},ou={}".format(len(cluster_acl_users),
                                                          cluster, ou))
+    log.debug("Nested group expansion cache: {}".format(ldapClient.expansionStats()))
     log.debug("This may take a while...")
 
     # Empty data structures for use later on
@@ -828,13 +901,12 @@ def nfs_handler(args):
     users_to_ignore = []
 
     # This block always runs; determines which users are missing home dirs
-    for user in cluster_acl_users:
-        uid = user.strip().split(",")[0].split("=")[-1]
-        h = HPCUserClient().UserHome(nfsconfig['mnt'], uid)
-        if not h.check_user_home():
-            users_to_explore.append(uid)
-        else:
-            users_to_ignore.append(uid)
+    # from a single listing of the mount
+    from merchpcuser.inventory import HomeInventory
+    acl_uids = set([user.strip().split(",")[0].split("=")[-1] for user in cluster_acl_users])
+    inventory = HomeInventory(nfsconfig['mnt']).scan([], ssh=False)
+    users_to_explore = sorted(inventory.missing(acl_uids))
+    users_to_ignore = sorted(acl_uids & inventory.names())
 
     log.debug("Users to explore: {}".format(len(users_to_explore)))
     log.debug("Users to ignore: {}".format(len(users_to_ignore)))
@@ -865,9 +937,9 @@ def nfs_handler(args):
     # Check that the nfs operations have actually worked
     completed = []
     failed = []
+    present = HomeInventory(nfsconfig['mnt']).scan([], ssh=False).names()
     for uid in users_to_explore[:upper_limit]:
-        h = HPCUserClient().UserHome(nfsconfig['mnt'], uid)
-        if h.check_user_home():
+        if uid in present:
             completed.append('`{}`'.format(uid))
         else:
             failed.append('`{}`'.format(uid))
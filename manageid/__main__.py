@@ -52,6 +52,10 @@ def main():
     parser.add_argument('--configdir', default=configpath)
     parser.add_argument('--cluster', default='m3')
     parser.add_argument('--execute', action='store_true')
+    parser.add_argument('--metrics-json',
+                        help="Write per-command timings to this JSON file at the end of the run")
+    parser.add_argument('--metrics-prom',
+                        help="Write per-command timings to this Prometheus textfile")
     subparser = parser.add_subparsers()
     subp_provision_project = subparser.add_parser('provisionproject')
     subp_provision_project.set_defaults(func=provision_project)
@@ -74,10 +78,23 @@ def main():
     subp_provision_slurm_assocs.set_defaults(func=create_slurm_associations)
     subp_provision_slurm_assocs.add_argument('--username')
     subp_provision_slurm_assocs.add_argument('--groupid')
+    subp_default_accounts = subparser.add_parser('defaultaccounts')
+    subp_default_accounts.set_defaults(func=default_account_handler)
+    subp_default_accounts.add_argument('--username')
     subp_home = subparser.add_parser('home')
     subp_home.set_defaults(func=homedir_handler)
     subp_home.add_argument("-n", "--number", type=int, default=10,
                             help="The number of users to take action on")
+    subp_home.add_argument("-w", "--workers", type=int, default=8,
+                            help="The number of homedirs to fix at once when executing")
+    from merchpcuser.keyaudit import DEFAULT_PATH as DEFAULT_KEYCACHE
+    subp_home.add_argument("--keycache", default=DEFAULT_KEYCACHE,
+                            help="sqlite file remembering key audits between runs "
+                                 "(default %(default)s)")
+    subp_home.add_argument("--fullaudit", action='store_true',
+                            help="Re-read every user's keys, ignoring the key cache")
+    subp_home.add_argument("--keytype", choices=['ed25519', 'rsa'], default='ed25519',
+                            help="The type of ssh key to create for users without one")
     subp_nfs = subparser.add_parser('nfs')
     subp_nfs.set_defaults(func=nfs_handler)
     subp_nfs.add_argument("-n", "--number", type=int, default=10,
@@ -89,7 +106,24 @@ def main():
             import mysubprocess
             mysubprocess.debug = False
     if hasattr(args, 'func'):
-        args.func(args)
+        try:
+            args.func(args)
+        finally:
+            write_metrics(args)
+
+
+def write_metrics(args):
+    import logging
+    from mysubprocess import metrics
+    log = logging.getLogger('mgid')
+    for path, write in ((args.metrics_json, metrics.write_json),
+                        (args.metrics_prom, metrics.write_prometheus)):
+        if path is None:
+            continue
+        try:
+            write(path)
+        except Exception as e:
+            log.error("Unable to write command metrics to {}: {}".format(path, e))
 
 
 if __name__ == '__main__':
@@ -1,19 +1,202 @@
-import manageid
+"""Generate the mail address to username map used by the MTA and portal.
 
-def make_map(args):
-    clients = manageid.get_clients_dict(args,clients={'ldap':True})
-    search_str = "(&(objectClass=posixAccount)(mail=*)(uid=*))"
-    for user in clients['ldap'].search(search_str):
+The map can be printed as "mail: uid" lines (the default), or written as an
+sqlite database (table mailmap, indexed on mail) or a dbm file that can be
+queried directly. Output is written as ldap pages arrive rather than after
+the whole directory has been read.
+
+With --incremental an existing sqlite map is updated in place using only
+the accounts modified since the newest modifyTimestamp it has seen, so it
+can be refreshed every minute. A dbm map is only rebuilt when something has
+changed since the last build. Deleted accounts don't show up as modified,
+so both also check for them every prune_interval seconds: sqlite by
+listing the usernames, dbm with a full rebuild.
+"""
+import logging
+import os
+import sys
+import time
+
+log = logging.getLogger('mgid.email_username_map')
+
+SEARCH_STR = "(&(objectClass=posixAccount)(mail=*)(uid=*))"
+ATTRIBUTES = ['mail', 'uid', 'modifyTimestamp']
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS mailmap (
+    mail TEXT NOT NULL COLLATE NOCASE,
+    uid TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS mailmap_mail ON mailmap (mail);
+CREATE INDEX IF NOT EXISTS mailmap_uid ON mailmap (uid);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+def get_ldap_client(args):
+    """Only ldap is needed here, so don't build the rest of get_clients"""
+    import yaml
+    from mercldap.ldap import Client as LdapClient
+    with open(os.path.join(args.configdir, 'ldapconfig.yml')) as f:
+        ldap_config = yaml.full_load(f.read())
+    return LdapClient(**ldap_config)
+
+
+def _newest(newest, user):
+    from mercldap.replica import generalizedTime
+    stamp = user['attributes'].get('modifyTimestamp')
+    if stamp:
+        stamp = generalizedTime(stamp)
+        if newest is None or stamp > newest:
+            return stamp
+    return newest
+
+
+def write_text(ldap, out=sys.stdout):
+    for user in ldap.search(SEARCH_STR, attributes=['mail', 'uid']):
         for mail in user['attributes']['mail']:
-            print("{}: {}".format(mail,user['attributes']['uid'][0]))
+            out.write("{}: {}\n".format(mail, user['attributes']['uid'][0]))
+    out.flush()
+
+
+def write_sqlite(ldap, path, incremental=False, prune_interval=3600):
+    """Build (or update) an sqlite map at path"""
+    import sqlite3
+    if incremental and os.path.exists(path):
+        db = sqlite3.connect(path)
+        db.executescript(SCHEMA)
+        row = db.execute("SELECT value FROM meta WHERE key='highwater'").fetchone()
+        if row is not None:
+            _update_sqlite(ldap, db, row[0], prune_interval)
+            db.close()
+            return
+        db.close()
+
+    # Full build into a temporary file which replaces the map in one step
+    tmppath = '{}.tmp{}'.format(path, os.getpid())
+    if os.path.exists(tmppath):
+        os.unlink(tmppath)
+    db = sqlite3.connect(tmppath)
+    db.executescript(SCHEMA)
+    newest = None
+    count = 0
+    for user in ldap.search(SEARCH_STR, attributes=ATTRIBUTES):
+        uid = user['attributes']['uid'][0]
+        db.executemany("INSERT INTO mailmap (mail, uid) VALUES (?, ?)",
+                       [(mail, uid) for mail in user['attributes']['mail']])
+        newest = _newest(newest, user)
+        count += 1
+    if newest is not None:
+        db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('highwater', ?)", (newest,))
+    db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('pruned', ?)", (str(time.time()),))
+    db.commit()
+    db.close()
+    os.rename(tmppath, path)
+    log.debug("Wrote {} accounts to {}".format(count, path))
+
+
+def _update_sqlite(ldap, db, highwater, prune_interval):
+    # Accounts that lost their mail attribute must be seen too, so mail=* is
+    # left out of the filter
+    search_str = "(&(objectClass=posixAccount)(uid=*)(modifyTimestamp>={}))".format(highwater)
+    newest = highwater
+    count = 0
+    for user in ldap.search(search_str, attributes=ATTRIBUTES):
+        uid = user['attributes']['uid'][0]
+        db.execute("DELETE FROM mailmap WHERE uid=?", (uid,))
+        db.executemany("INSERT INTO mailmap (mail, uid) VALUES (?, ?)",
+                       [(mail, uid) for mail in user['attributes'].get('mail', [])])
+        newest = _newest(newest, user)
+        count += 1
+    db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('highwater', ?)", (newest,))
+
+    # Deleted accounts don't show up as modified, list the usernames now and
+    # then to catch them
+    row = db.execute("SELECT value FROM meta WHERE key='pruned'").fetchone()
+    if row is None or time.time() - float(row[0]) >= prune_interval:
+        live = set()
+        for user in ldap.search(SEARCH_STR, attributes=['uid']):
+            live.update(user['attributes']['uid'])
+        held = set([r[0] for r in db.execute("SELECT DISTINCT uid FROM mailmap")])
+        for uid in held - live:
+            db.execute("DELETE FROM mailmap WHERE uid=?", (uid,))
+        db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('pruned', ?)", (str(time.time()),))
+        log.debug("Pruned {} deleted accounts".format(len(held - live)))
+    db.commit()
+    log.debug("Updated {} accounts modified since {}".format(count, highwater))
+
+
+def write_dbm(ldap, path, incremental=False, prune_interval=3600):
+    """Build a dbm map at path, skipped if incremental, nothing changed and
+    the last build is less than prune_interval seconds old"""
+    import dbm
+    markerpath = '{}.marker'.format(path)
+    if incremental and os.path.exists(markerpath):
+        # The marker holds the newest modifyTimestamp and the build time
+        with open(markerpath) as f:
+            marker = f.read().split()
+        highwater = marker[0] if marker else None
+        built = float(marker[1]) if len(marker) > 1 else 0
+        if highwater is not None and time.time() - built < prune_interval:
+            # The marker account itself always matches >=, only look for
+            # stamps strictly newer
+            search_str = "(&(objectClass=posixAccount)(uid=*)(!(modifyTimestamp<={})))".format(highwater)
+            changed = next(iter(ldap.search(search_str, attributes=['1.1'])), None)
+            if changed is None:
+                log.debug("No accounts modified since {}, {} is current".format(highwater, path))
+                return
+
+    tmppath = '{}.tmp{}'.format(path, os.getpid())
+    newest = None
+    built = time.time()
+    with dbm.open(tmppath, 'n') as db:
+        for user in ldap.search(SEARCH_STR, attributes=ATTRIBUTES):
+            for mail in user['attributes']['mail']:
+                db[mail.lower()] = user['attributes']['uid'][0]
+            newest = _newest(newest, user)
+    # Some dbm implementations add a suffix to the file name
+    for name in os.listdir(os.path.dirname(os.path.abspath(tmppath))):
+        if name.startswith(os.path.basename(tmppath)):
+            suffix = name[len(os.path.basename(tmppath)):]
+            os.rename(os.path.join(os.path.dirname(os.path.abspath(tmppath)), name),
+                      os.path.abspath(path) + suffix)
+    if newest is not None:
+        with open(markerpath, 'w') as f:
+            f.write('{}\n{}\n'.format(newest, built))
+
+
+def make_map(args):
+    ldap = get_ldap_client(args)
+    fmt = getattr(args, 'format', 'text')
+    output = getattr(args, 'output', None)
+    incremental = getattr(args, 'incremental', False)
+    if fmt == 'sqlite':
+        write_sqlite(ldap, output, incremental)
+    elif fmt == 'dbm':
+        write_dbm(ldap, output, incremental)
+    elif output is not None:
+        with open(output, 'w') as f:
+            write_text(ldap, f)
+    else:
+        write_text(ldap)
 
 
 def main():
     import argparse
     parser = argparse.ArgumentParser()
     parser.add_argument('--configdir')
+    parser.add_argument('--format', choices=['text', 'sqlite', 'dbm'], default='text',
+                        help="text prints 'mail: uid' lines, sqlite and dbm write a lookup table")
+    parser.add_argument('--output', help="File to write, required for sqlite and dbm")
+    parser.add_argument('--incremental', action='store_true',
+                        help="Only apply changes since the last run to an existing map")
 
     args = parser.parse_args()
+    if args.format != 'text' and args.output is None:
+        parser.error('--output is required for --format {}'.format(args.format))
 
     make_map(args)
 
@@ -0,0 +1,195 @@
+"""Filesystem operations done in process rather than by forking coreutils
+
+Each function does one operation with os/shutil calls and then confirms it
+with a stat, raising FsOpError if the result isn't what was asked for, so
+callers need no sleeps between dependent steps. Like mysubprocess, nothing
+is changed unless mysubprocess.debug is cleared: a dry run prints the
+equivalent command line and appends it to `recorded`.
+
+Operations that run are timed with mysubprocess.metrics under the family
+fsops.<operation>.
+"""
+import os
+import shutil
+import stat
+import threading
+import time
+
+import mysubprocess
+from merchpcuser import nss
+from mysubprocess import metrics
+
+# Command lines of the operations skipped in dry runs, oldest first
+recorded = []
+_lock = threading.Lock()
+
+
+class FsOpError(Exception):
+    pass
+
+
+def _dry(*args):
+    """True (after recording args) if this is a dry run"""
+    if not mysubprocess.debug:
+        return False
+    line = " ".join([str(a) for a in args])
+    print(line)
+    with _lock:
+        recorded.append(line)
+    return True
+
+
+def _timed(name, path, fn):
+    start = time.time()
+    returncode = 1
+    try:
+        result = fn()
+        returncode = 0
+        return result
+    finally:
+        metrics.record(['fsops.{}'.format(name), path], time.time() - start,
+                       returncode)
+
+
+def _uid(user):
+    if user is None or isinstance(user, int):
+        return -1 if user is None else user
+    return nss.getpwnam(user).pw_uid
+
+
+def _gid(group):
+    if group is None or isinstance(group, int):
+        return -1 if group is None else group
+    return nss.getgrnam(group).gr_gid
+
+
+def _check(path, mode=None, uid=-1, gid=-1, follow=True):
+    st = os.stat(path) if follow else os.lstat(path)
+    if mode is not None and stat.S_IMODE(st.st_mode) != mode:
+        raise FsOpError("{} has mode {:o}, expected {:o}".format(
+            path, stat.S_IMODE(st.st_mode), mode))
+    if uid != -1 and st.st_uid != uid:
+        raise FsOpError("{} is owned by uid {}, expected {}".format(path, st.st_uid, uid))
+    if gid != -1 and st.st_gid != gid:
+        raise FsOpError("{} has gid {}, expected {}".format(path, st.st_gid, gid))
+    return st
+
+
+def mkdir(path, mode=None, user=None, group=None, exist_ok=False):
+    """Create directory path, optionally setting its mode and ownership
+    (user and group may be names or ids)"""
+    if _dry('mkdir', path):
+        return None
+
+    def op():
+        try:
+            os.mkdir(path)
+        except FileExistsError:
+            if not exist_ok:
+                raise
+        uid, gid = _uid(user), _gid(group)
+        if uid != -1 or gid != -1:
+            os.chown(path, uid, gid)
+        if mode is not None:
+            # After chown, which clears setgid on some filesystems
+            os.chmod(path, mode)
+        st = _check(path, mode, uid, gid)
+        if not stat.S_ISDIR(st.st_mode):
+            raise FsOpError("{} is not a directory".format(path))
+        return True
+    return _timed('mkdir', path, op)
+
+
+def chown(path, user=None, group=None):
+    """Change the owner and/or group of path"""
+    if _dry('chown', '{}:{}'.format('' if user is None else user,
+                                    '' if group is None else group), path):
+        return None
+
+    def op():
+        uid, gid = _uid(user), _gid(group)
+        os.chown(path, uid, gid)
+        _check(path, uid=uid, gid=gid)
+        return True
+    return _timed('chown', path, op)
+
+
+def chgrp(path, group):
+    """Change the group of path"""
+    if _dry('chgrp', group, path):
+        return None
+
+    def op():
+        gid = _gid(group)
+        os.chown(path, -1, gid)
+        _check(path, gid=gid)
+        return True
+    return _timed('chgrp', path, op)
+
+
+def chmod(path, mode):
+    """Set the permission bits of path, mode is an int e.g. 0o2770"""
+    if _dry('chmod', '{:o}'.format(mode), path):
+        return None
+
+    def op():
+        os.chmod(path, mode)
+        _check(path, mode)
+        return True
+    return _timed('chmod', path, op)
+
+
+def symlink(target, linkpath):
+    """Create linkpath pointing at target"""
+    if _dry('ln', '-s', target, linkpath):
+        return None
+
+    def op():
+        os.symlink(target, linkpath)
+        if os.readlink(linkpath) != target:
+            raise FsOpError("{} does not point at {}".format(linkpath, target))
+        return True
+    return _timed('symlink', linkpath, op)
+
+
+def copy(src, dst, mode=None):
+    """Copy the contents of file src to dst, optionally setting its mode"""
+    if _dry('cp', src, dst):
+        return None
+
+    def op():
+        shutil.copyfile(src, dst)
+        if mode is not None:
+            os.chmod(dst, mode)
+        st = _check(dst, mode)
+        if st.st_size != os.stat(src).st_size:
+            raise FsOpError("{} is {} bytes, {} is {}".format(
+                dst, st.st_size, src, os.stat(src).st_size))
+        return True
+    return _timed('copy', dst, op)
+
+
+def append(src, dst):
+    """Append the contents of file src to dst (creating it)"""
+    if _dry('cat', src, '>>', dst):
+        return None
+
+    def op():
+        before = os.stat(dst).st_size if os.path.exists(dst) else 0
+        with open(src, 'rb') as f:
+            data = f.read()
+        with open(dst, 'ab') as f:
+            if before and not _ends_with_newline(dst):
+                f.write(b'\n')
+                before += 1
+            f.write(data)
+        if os.stat(dst).st_size < before + len(data):
+            raise FsOpError("Appending {} to {} was short".format(src, dst))
+        return True
+    return _timed('append', dst, op)
+
+
+def _ends_with_newline(path):
+    with open(path, 'rb') as f:
+        f.seek(-1, os.SEEK_END)
+        return f.read(1) == b'\n'
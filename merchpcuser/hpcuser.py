@@ -3,7 +3,9 @@ including homedirs, symlinks, and slurm associations (through mercslurm)"""
 import mysubprocess
 import os
 import logging
-import pwd
+
+from merchpcuser import fsops, nss, sshkeys
+from merchpcuser.keyaudit import key_present
 
 
 # TODO: Complete refactor, reduce duplication, split clients properly
@@ -15,23 +17,16 @@ class HPCProjectClient(object):
         self.allocsdata = allocsdata
 
     @staticmethod
-    def create(mntpt, groupname, quota=None, delay=1):
-        """create a directory rooted at /fs, assign ownership and set quotas"""
+    def create(mntpt, groupname, quota=None, delay=None, newfs=False):
+        """create a directory rooted at /fs, assign ownership and set quotas.
+        Each step is confirmed by merchpcuser.fsops before the next, delay
+        is no longer needed and ignored"""
         import os
-        import mysubprocess as subprocess
-        import time
 
         path = os.path.join(mntpt, groupname)
-        mkdir = ['/bin/mkdir', path]
-        chgrp = ['/bin/chgrp', groupname, path]
-        chmod = ['/bin/chmod', '2770', path]
-
-        subprocess.call(mkdir)
-        time.sleep(delay)
-        subprocess.call(chgrp)
-        time.sleep(delay)
-        subprocess.call(chmod)
-
+        fsops.mkdir(path)
+        fsops.chgrp(path, groupname)
+        fsops.chmod(path, 0o2770)
 
     @staticmethod
     def exists(mntpt, groupname):
@@ -61,16 +56,14 @@ class HPCUserClient(object):
 
     def get_file_ownership(self, filename):
         import os
-        from pwd import getpwuid
-        from grp import getgrgid
+        st = os.lstat(filename)
         return (
-            getpwuid(os.lstat(filename).st_uid).pw_name,
-            getgrgid(os.lstat(filename).st_gid).gr_name
+            nss.getpwuid(st.st_uid).pw_name,
+            nss.getgrgid(st.st_gid).gr_name
         )
 
     def check_or_make_symlinks(self, proj, user, locations):
         """Check if symlinks for project and scratch exist, if not create"""
-        import mysubprocess as subprocess
         import logging
         import os
 
@@ -108,8 +101,9 @@ class HPCUserClient(object):
             else:
                 lncomm = [lnbin, '-s', dirpath, linkpath]
                 log.info("Symlink {} does not exist".format(linkpath))
+                retcode = None
                 try:
-                    retcode = subprocess.call(lncomm)
+                    retcode = fsops.symlink(dirpath, linkpath)
                     self.slackg += "Creating `{}`\n".format(linkpath)
                 except Exception as e:
                     log.exception(e)
@@ -127,9 +121,9 @@ class HPCUserClient(object):
         from mercallocations.allocations import AllocationsClient
 
         with open(os.path.join(configdir, 'ldapconfig.yml')) as filehandle:
-            ldapconfig = yaml.load(filehandle.read())
+            ldapconfig = yaml.full_load(filehandle.read())
         with open(os.path.join(configdir, 'allocationsconfig.yml')) as filehandle:
-            allocconfig = yaml.load(filehandle.read())
+            allocconfig = yaml.full_load(filehandle.read())
 
         allocsClient = AllocationsClient(allocconfig['sheetid'],
                                          allocconfig['sheetname'],
@@ -140,9 +134,9 @@ class HPCUserClient(object):
 
         ldapClient = LdapClient(**ldapconfig)
 
-        userprojs = [p['raw_attributes']['cn'] for p in ldapClient.getUsersProjects(user)]
+        userprojs = [p['attributes']['cn'] for p in ldapClient.getUsersProjects(user, attributes=['cn'])]
         validprojs = [p for p in allocsClient.get_projects()]
-        projs = [p for p in userprojs if str(p[0].decode('UTF-8')) in validprojs]
+        projs = [p for p in userprojs if p[0] in validprojs]
         return projs
 
     def copy_skeleton(self):
@@ -150,20 +144,35 @@ class HPCUserClient(object):
 
     class UserHome(object):
         def __init__(self, mnt, username,
-                     skelpath='/usr/local/hpcusr/latest/skel/skel/'):
+                     skelpath='/usr/local/hpcusr/latest/skel/skel/',
+                     keytype='ed25519'):
             self.mnt = mnt
             self.homepath = os.path.join(self.mnt, username)
             self.sshpath = os.path.join(self.homepath, ".ssh")
             self.idrsapath = os.path.join(self.sshpath, "id_rsa")
+            self.ed25519path = os.path.join(self.sshpath, "id_ed25519")
+            self.keytype = keytype
+            self.keypath = os.path.join(self.sshpath, sshkeys.keyname(keytype))
             self.authfile = os.path.join(self.sshpath, "authorized_keys")
-            self.publickey = ".".join((self.idrsapath, "pub"))
             self.log = logging.getLogger('mgid.userhome')
             self.pubkeycontents = ''
             self.authkeycontents = ''
             self.username = username
-            self.user_attrs = pwd.getpwnam(self.username)
+            self.user_attrs = nss.getpwnam(self.username)
             self.skelpath = skelpath
 
+        def _existing_key(self):
+            """The user's private key: an existing id_rsa or id_ed25519,
+            otherwise the one create_user_sshkey makes"""
+            for path in (self.idrsapath, self.ed25519path):
+                if os.path.exists(path):
+                    return path
+            return self.keypath
+
+        @property
+        def publickey(self):
+            return ".".join((self._existing_key(), "pub"))
+
         def check_user_home(self):
             if os.path.islink(self.homepath):
                 return True
@@ -177,10 +186,12 @@ class HPCUserClient(object):
                 return os.path.exists(self.sshpath)
 
         def check_user_idrsa(self):
+            """True if the user has a private key, id_rsa or id_ed25519"""
             if os.path.islink(self.homepath):
                 return True
             else:
-                return os.path.exists(self.idrsapath)
+                return os.path.exists(self.idrsapath) or \
+                    os.path.exists(self.ed25519path)
 
         def check_user_auth(self):
             if os.path.islink(self.homepath):
@@ -200,16 +211,8 @@ class HPCUserClient(object):
 
             if self.check_user_publickey() and self.check_user_auth():
                 try:
-                    with open(self.publickey, 'r') as pubkey:
-                        self.pubkeycontents = pubkey.readlines()
-                    with open(self.authfile, 'r') as authkey:
-                        self.authkeycontents = authkey.readlines()
-
-                    # Determine which keys are in both files
-                    res = set(self.pubkeycontents).intersection(self.authkeycontents)
-
-                    # If there aren't any common keys, return False
-                    if len(res) == 0:
+                    # Stream authorized_keys rather than reading it all
+                    if not key_present(self.publickey, self.authfile):
                         self.log.debug("Key not present in {}".format(
                             self.authfile
                         ))
@@ -233,15 +236,7 @@ class HPCUserClient(object):
             """Generic method to create a folder"""
             self.log.debug("Creating dir {}".format(targetpath))
             try:
-                cmd = ["mkdir", targetpath]
-                mkdir = mysubprocess.Popen(cmd, stdout=mysubprocess.PIPE,
-                                           stderr=mysubprocess.PIPE)
-                stdout, stderr = mkdir.communicate()
-
-                if stdout is not None:
-                    self.log.debug("stdout for .ssh creation is {}:".format(stdout))
-                if stderr is not None:
-                    self.log.debug("stderr for .ssh creation is {}:".format(stderr))
+                fsops.mkdir(targetpath)
                 return True
             except Exception as e:
                 self.log.critical("Unable to create dir {}".format(targetpath))
@@ -256,50 +251,32 @@ class HPCUserClient(object):
             self.create_dir(self.homepath)
 
         def create_user_sshkey(self):
-            """Create the user's id_rsa key for ssh between nodes"""
-            cmd = "ssh-keygen -t rsa -N \"\" -f {}".format(self.idrsapath)
+            """Create the user's key (ed25519 unless another keytype was
+            given) for ssh between nodes"""
             self.log.debug(
-                "Creating ssh key {} with command {}".format(self.idrsapath,
-                                                             cmd)
+                "Creating {} ssh key {}".format(self.keytype, self.keypath)
             )
 
             try:
-                keygen = mysubprocess.Popen([cmd], shell=True,
-                                            stdout=mysubprocess.PIPE,
-                                            stderr=mysubprocess.PIPE)
-                stdout, stderr = keygen.communicate()
-                if stdout is not None:
-                    self.log.debug("stdout for key creation is {}:".format(stdout))
-                if stderr is not None:
-                    self.log.debug("stderr for key creation is {}:".format(stderr))
+                sshkeys.create_key(self.keypath, self.keytype,
+                                   comment=self.username)
                 return True
             except Exception as e:
-                self.log.critical("ssh-keygen failed")
+                self.log.critical("ssh key creation failed")
                 self.log.exception(e)
 
         def create_user_auth(self):
             """Create the user's authorized_keys file"""
 
-            cmd = ["cp", self.publickey, self.authfile]
             self.log.debug(
-                "Creating authorized_keys file {} with command {}".format(self.authfile,
-                                                                          cmd)
+                "Creating authorized_keys file {} from {}".format(self.authfile,
+                                                                  self.publickey)
             )
 
             try:
-                cp = mysubprocess.Popen(cmd, stdout=mysubprocess.PIPE,
-                                        stderr=mysubprocess.PIPE)
-                stdout, stderr = cp.communicate()
-                if stdout is not None:
-                    self.log.debug(
-                        "stdout for authorized_keys creation is {}:".format(stdout)
-                    )
-                if stderr is not None:
-                    self.log.debug(
-                        "stderr for authorized_keys creation is {}:".format(stderr)
-                    )
+                fsops.copy(self.publickey, self.authfile, mode=0o600)
             except Exception as e:
-                self.log.critical("authorized_keys cp failed")
+                self.log.critical("authorized_keys copy failed")
                 self.log.exception(e)
 
         def copy_idrsa_to_authkeys(self):
@@ -312,15 +289,8 @@ class HPCUserClient(object):
             # If the id_rsa key is not in authorized_keys, add it
             if not self.check_user_keys():
                 self.log.debug("Key not present in {}, adding".format(self.authfile))
-                cmd = ["cat", self.publickey, ">>", self.authfile]
                 try:
-                    add_key = mysubprocess.Popen(cmd, stdout=mysubprocess.PIPE,
-                                                 stderr=mysubprocess.PIPE)
-                    stdout, stderr = add_key.communicate()
-                    if stdout is not None:
-                        self.log.debug("stdout for key copy is {}:".format(stdout))
-                    if stderr is not None:
-                        self.log.debug("stderr for key copy is {}:".format(stderr))
+                    fsops.append(self.publickey, self.authfile)
                     return True
                 except Exception as e:
                     self.log.critical("Adding id_rsa to authorized_keys failed")
@@ -368,9 +338,8 @@ class HPCUserClient(object):
 
             cmd = ['rsync', '-av', '--ignore-existing', self.skelpath, self.homepath]
             try:
-                rsync = mysubprocess.Popen(cmd, stdout=mysubprocess.PIPE,
-                                           stderr=mysubprocess.PIPE)
-                stdout, stderr = rsync.communicate()
+                rsync = mysubprocess.run(cmd, backend='filesystem')
+                stdout, stderr = rsync.stdout, rsync.stderr
                 if stdout is not None:
                     self.log.debug("stdout for skeleton rsync is: {}:".format(stdout))
                 if stderr is not None:
@@ -397,9 +366,8 @@ class HPCUserClient(object):
             self.log.debug("Recursively chowning path {}".format(self.homepath))
             try:
                 cmd = ["chown", "-R", "{}:{}".format(uid, gid), self.homepath]
-                chown = mysubprocess.Popen(cmd, stdout=mysubprocess.PIPE,
-                                           stderr=mysubprocess.PIPE)
-                stdout, stderr = chown.communicate()
+                chown = mysubprocess.run(cmd, backend='filesystem')
+                stdout, stderr = chown.stdout, chown.stderr
 
                 if stdout is not None:
                     self.log.debug("stdout for chown -R is {}:".format(stdout))
@@ -435,9 +403,8 @@ class HPCUserClient(object):
             )
 
             try:
-                setquota = mysubprocess.Popen(cmd, stdout=mysubprocess.PIPE,
-                                        stderr=mysubprocess.PIPE)
-                stdout, stderr = setquota.communicate()
+                setquota = mysubprocess.run(cmd, backend='filesystem')
+                stdout, stderr = setquota.stdout, setquota.stderr
                 self.log.debug(
                     "stdout for setquota is {}:".format(stdout)
                 )
@@ -452,9 +419,8 @@ class HPCUserClient(object):
             """Check the quota for the user"""
             cmd = ["quota", "-u", self.username]
             try:
-                getquota = mysubprocess.Popen(cmd, stdout=mysubprocess.PIPE,
-                                              stderr=mysubprocess.PIPE)
-                stdout, stderr = getquota.communicate()
+                getquota = mysubprocess.run(cmd, backend='filesystem')
+                stdout, stderr = getquota.stdout, getquota.stderr
                 self.log.debug(
                     "stdout for quota is {}:".format(stdout)
                 )
@@ -0,0 +1,145 @@
+"""A single pass inventory of the home directories under a mount
+
+Rather than building a UserHome and probing each path in turn for every
+user (each probe a round trip on NFS), HomeInventory lists the mount once
+with os.scandir, then stats the home directories and lists their .ssh
+directories on a thread pool:
+
+    inventory = HomeInventory('/home').scan(acl_users)
+    missing = set(acl_users) - inventory.names()
+    linked = inventory.symlinked()
+"""
+import logging
+import os
+
+from concurrent.futures import ThreadPoolExecutor
+
+SSH_FILES = ('id_rsa', 'id_rsa.pub', 'id_ed25519', 'id_ed25519.pub',
+             'authorized_keys')
+
+
+class HomeState(object):
+    """What the inventory found for one home directory"""
+    __slots__ = ('name', 'path', 'symlink', 'uid', 'gid', 'mode', 'ssh',
+                 'ssh_files')
+
+    def __init__(self, name, path, symlink=False):
+        self.name = name
+        self.path = path
+        self.symlink = symlink
+        self.uid = None
+        self.gid = None
+        self.mode = None
+        self.ssh = None
+        self.ssh_files = frozenset()
+
+    def __repr__(self):
+        return "<merchpcuser.HomeState {} uid={} gid={} symlink={} ssh={}>".format(
+            self.path, self.uid, self.gid, self.symlink, sorted(self.ssh_files))
+
+    def owned_by(self, uid, gid):
+        return self.uid == uid and self.gid == gid
+
+    @property
+    def has_idrsa(self):
+        """True if there is a private key, id_rsa or id_ed25519"""
+        return 'id_rsa' in self.ssh_files or 'id_ed25519' in self.ssh_files
+
+    @property
+    def has_publickey(self):
+        return 'id_rsa.pub' in self.ssh_files or 'id_ed25519.pub' in self.ssh_files
+
+    @property
+    def has_auth(self):
+        return 'authorized_keys' in self.ssh_files
+
+    def as_dict(self):
+        """The uid/gid/symlink dict homedir_handler used to build"""
+        return {'uid': self.uid, 'gid': self.gid, 'symlink': self.symlink}
+
+
+class HomeInventory(object):
+    """Home directories under mnt, keyed by directory name"""
+
+    def __init__(self, mnt, workers=16):
+        self.mnt = mnt
+        self.workers = workers
+        self.homes = {}
+        self.log = logging.getLogger('mgid.inventory')
+
+    def __repr__(self):
+        return "<merchpcuser.HomeInventory {} {} homes>".format(self.mnt, len(self.homes))
+
+    def __contains__(self, name):
+        return name in self.homes
+
+    def __getitem__(self, name):
+        return self.homes[name]
+
+    def __len__(self):
+        return len(self.homes)
+
+    def get(self, name, default=None):
+        return self.homes.get(name, default)
+
+    def scan(self, users=None, ssh=True):
+        """
+        List mnt and record every directory (or symlink) in it. Only the
+        homes of users (all of them if None) are then stat'ed and, with
+        ssh set, have their .ssh directories listed. Returns self
+        """
+        homes = {}
+        with os.scandir(self.mnt) as it:
+            for entry in it:
+                symlink = entry.is_symlink()
+                if symlink or entry.is_dir(follow_symlinks=False):
+                    homes[entry.name] = HomeState(entry.name, entry.path, symlink)
+        self.homes = homes
+        if users is None:
+            wanted = list(homes.values())
+        else:
+            wanted = [homes[u] for u in set(users) if u in homes]
+        # Symlinks (to lustre) are skipped by the handlers, don't follow
+        # them over the network
+        wanted = [h for h in wanted if not h.symlink]
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            list(pool.map(lambda h: self._inspect(h, ssh), wanted))
+        self.log.debug("Inventory of {}: {} homes, {} inspected".format(
+            self.mnt, len(homes), len(wanted)))
+        return self
+
+    @staticmethod
+    def _inspect(home, ssh):
+        try:
+            st = os.stat(home.path)
+        except OSError:
+            return
+        home.uid, home.gid, home.mode = st.st_uid, st.st_gid, st.st_mode
+        if not ssh:
+            return
+        try:
+            with os.scandir(os.path.join(home.path, '.ssh')) as it:
+                home.ssh_files = frozenset([e.name for e in it if e.name in SSH_FILES])
+            home.ssh = True
+        except FileNotFoundError:
+            home.ssh = False
+        except OSError:
+            home.ssh = None
+
+    def names(self):
+        """The set of home directory names"""
+        return set(self.homes)
+
+    def symlinked(self):
+        return set([n for n, h in self.homes.items() if h.symlink])
+
+    def missing(self, users):
+        """users without a home directory"""
+        return set(users) - self.names()
+
+    def misowned(self, owners):
+        """Names whose home isn't owned by the expected uid/gid, owners is a
+        dict of name -> (uid, gid). Symlinked homes are left out"""
+        return set([n for n, (uid, gid) in owners.items()
+                    if n in self.homes and not self.homes[n].symlink
+                    and not self.homes[n].owned_by(uid, gid)])
@@ -0,0 +1,168 @@
+"""Checks that each user's public key is in their authorized_keys
+
+KeyAudit remembers its last verdict for each home together with the
+(inode, mtime) of its .ssh directory and the (inode, size, mtime) of the
+public key and authorized_keys. A home whose .ssh is unchanged costs one
+stat; the key files are only stat'ed when it has changed, and only read
+when they have too. Given the HomeInventory states of the homes, which key
+exists is taken from the inventory's .ssh listing rather than probed.
+Editing a file in place doesn't touch the directory, so a verdict is read
+again once it is older than recheck seconds. The cache is an sqlite file
+when a path is given. Files are compared by streaming authorized_keys line
+by line and stopping at the first match, and a full audit (ignoring the
+cache) runs on a thread pool:
+
+    audit = KeyAudit(DEFAULT_PATH)
+    verdicts = audit.audit(homes, inventory)    # {username: bool}
+    verdicts = audit.audit(homes, full=True)
+"""
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_PATH = '/var/lib/manageid/keyaudit.db'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS keyaudit (
+    home TEXT PRIMARY KEY,
+    pubkey TEXT,
+    auth TEXT,
+    verdict INTEGER NOT NULL,
+    checked REAL NOT NULL
+);
+"""
+
+
+def signature(path):
+    """'inode:size:mtime' of path, None if it doesn't exist"""
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return '{}:{}:{}'.format(st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+def _publickey(home, state):
+    """home.publickey, using the inventory's .ssh listing if there is one"""
+    if state is None or state.ssh is None:
+        return home.publickey
+    for name in ('id_rsa', 'id_ed25519'):
+        if name in state.ssh_files:
+            return os.path.join(home.sshpath, name + '.pub')
+    return home.keypath + '.pub'
+
+
+def key_present(publickey, authfile):
+    """True if any line of publickey is a line of authfile. authfile is
+    streamed, so only the (small) public key is held in memory"""
+    with open(publickey, 'r') as pubkey:
+        keys = set([line.strip() for line in pubkey if line.strip()])
+    if not keys:
+        return False
+    with open(authfile, 'r') as authkeys:
+        for line in authkeys:
+            if line.strip() in keys:
+                return True
+    return False
+
+
+class KeyAudit(object):
+    """Cached verdicts of key_present, keyed by home directory"""
+
+    def __init__(self, path=None, workers=16, recheck=86400):
+        self.log = logging.getLogger('mgid.keyaudit')
+        self.path = path
+        self.workers = workers
+        self.recheck = recheck
+        try:
+            if path is not None:
+                os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self.db = sqlite3.connect(path or ':memory:', check_same_thread=False)
+            self.db.executescript(SCHEMA)
+        except (OSError, sqlite3.Error) as e:
+            self.log.warning("Key cache {} unavailable, keeping it in memory: {}".format(path, e))
+            self.path = None
+            self.db = sqlite3.connect(':memory:', check_same_thread=False)
+            self.db.executescript(SCHEMA)
+        columns = [r[1] for r in self.db.execute('PRAGMA table_info(keyaudit)')]
+        if 'ssh' not in columns:
+            self.db.execute('ALTER TABLE keyaudit ADD COLUMN ssh TEXT')
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __repr__(self):
+        return "<merchpcuser.KeyAudit {}>".format(self.path or 'memory')
+
+    def close(self):
+        self.db.close()
+
+    def check(self, home, full=False, state=None):
+        """
+        The verdict for a UserHome (anything with homepath, sshpath,
+        keypath, publickey and authfile), state being its HomeState from a
+        HomeInventory if there is one. Symlinked homes pass, as
+        UserHome.check_user_keys has it; missing files fail
+        """
+        if state.symlink if state is not None else os.path.islink(home.homepath):
+            return True
+        sshsig = signature(home.sshpath)
+        if sshsig is None:
+            return False
+        row = None
+        if not full:
+            with self._lock:
+                row = self.db.execute('SELECT ssh, pubkey, auth, verdict, checked FROM keyaudit '
+                                      'WHERE home=?', (home.homepath,)).fetchone()
+            if row is not None and time.time() - row[4] >= self.recheck:
+                row = None
+            if row is not None and row[0] == sshsig:
+                with self._lock:
+                    self.hits += 1
+                return bool(row[3])
+        publickey = _publickey(home, state)
+        pubsig, authsig = signature(publickey), signature(home.authfile)
+        if row is not None and row[1] == pubsig and row[2] == authsig:
+            # Something else in .ssh changed, the key files didn't
+            verdict, checked = bool(row[3]), row[4]
+            with self._lock:
+                self.hits += 1
+        else:
+            if pubsig is None or authsig is None:
+                verdict = False
+            else:
+                verdict = key_present(publickey, home.authfile)
+            checked = time.time()
+            with self._lock:
+                self.misses += 1
+        with self._lock:
+            self.db.execute('INSERT OR REPLACE INTO keyaudit '
+                            '(home, ssh, pubkey, auth, verdict, checked) '
+                            'VALUES (?, ?, ?, ?, ?, ?)',
+                            (home.homepath, sshsig, pubsig, authsig, int(verdict), checked))
+        return verdict
+
+    def audit(self, homes, inventory=None, full=False):
+        """Check every UserHome in homes on a thread pool, returning
+        {username: verdict}. inventory is the HomeInventory the homes were
+        found in, if any. Homes that can't be read are logged and left
+        out"""
+        def check(home):
+            state = inventory.get(home.username) if inventory is not None else None
+            try:
+                return home.username, self.check(home, full, state)
+            except Exception as e:
+                self.log.error("Could not check keys of {}: {}".format(home.homepath, e))
+                return home.username, None
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            results = [r for r in pool.map(check, homes) if r[1] is not None]
+        with self._lock:
+            self.db.commit()
+        self.log.debug("Key audit of {} homes, {} unchanged since the last run".format(
+            len(results), self.hits))
+        return dict(results)
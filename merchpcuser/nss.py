@@ -0,0 +1,164 @@
+"""A passwd/group index loaded once per run
+
+With sssd in front of ldap every pwd/grp lookup may be a round trip (or a
+stall), and the home handlers make several per user. NssIndex enumerates
+passwd and group once (pwd.getpwall/grp.getgrall, or from mercldap) and
+answers the same lookups from memory, returning the usual struct_passwd and
+struct_group records and raising KeyError for unknown names and ids. sssd
+only enumerates when configured to, so misses fall back to a live lookup
+whose result is remembered. Absence isn't: a user or group created later in
+the run is found by the next lookup.
+
+The module level functions use a shared index:
+
+    from merchpcuser import nss
+    nss.getpwnam('alice').pw_uid
+    nss.set_index(nss.NssIndex.from_ldap(ldapClient))
+"""
+import grp
+import logging
+import pwd
+import threading
+
+_MISSING = object()
+
+
+class NssIndex(object):
+    """passwd and group records by name and by id"""
+
+    def __init__(self, users=(), groups=(), live=True):
+        self.live = live
+        self._users = {}
+        self._uids = {}
+        self._groups = {}
+        self._gids = {}
+        self._lock = threading.Lock()
+        self.log = logging.getLogger('mgid.nss')
+        for user in users:
+            self._addUser(user)
+        for group in groups:
+            self._addGroup(group)
+
+    def __repr__(self):
+        return "<merchpcuser.NssIndex {} users {} groups>".format(len(self._users),
+                                                                 len(self._groups))
+
+    @classmethod
+    def from_nss(cls, live=True):
+        return cls(pwd.getpwall(), grp.getgrall(), live)
+
+    @classmethod
+    def from_ldap(cls, ldap_client, ous=('collaborations', 'aclgroups'), live=True):
+        """Build the index from the posixAccounts and project groups in ldap
+        (the replica, if the client has one)"""
+        users = []
+        for entry in ldap_client.getUsers(attributes=['uid', 'uidNumber', 'gidNumber',
+                                                      'gecos', 'homeDirectory',
+                                                      'loginShell']):
+            attrs = entry['attributes']
+            try:
+                users.append(pwd.struct_passwd((
+                    _first(attrs.get('uid')), 'x', int(_first(attrs.get('uidNumber'))),
+                    int(_first(attrs.get('gidNumber'))), _first(attrs.get('gecos')) or '',
+                    _first(attrs.get('homeDirectory')) or '',
+                    _first(attrs.get('loginShell')) or '')))
+            except (TypeError, ValueError):
+                continue
+        groups = []
+        for ou in ous:
+            for entry in ldap_client.getProjects(ou, attributes=['cn', 'gidNumber',
+                                                                 'memberUid']):
+                attrs = entry['attributes']
+                try:
+                    groups.append(grp.struct_group((
+                        _first(attrs.get('cn')), 'x', int(_first(attrs.get('gidNumber'))),
+                        list(attrs.get('memberUid', [])))))
+                except (TypeError, ValueError):
+                    continue
+        return cls(users, groups, live)
+
+    def _addUser(self, user):
+        self._users[user.pw_name] = user
+        self._uids.setdefault(user.pw_uid, user)
+
+    def _addGroup(self, group):
+        self._groups[group.gr_name] = group
+        self._gids.setdefault(group.gr_gid, group)
+
+    def _lookup(self, table, key, live, add):
+        record = table.get(key, _MISSING)
+        if record is _MISSING:
+            if not self.live:
+                raise KeyError(key)
+            try:
+                record = live(key)
+            except KeyError:
+                self.log.debug("Live NSS lookup of {}: False".format(key))
+                raise
+            with self._lock:
+                add(record)
+                # add indexes by name and id, a lookup by the other
+                # key may not have put it under this one
+                table[key] = record
+            self.log.debug("Live NSS lookup of {}: True".format(key))
+        return record
+
+    def getpwnam(self, name):
+        return self._lookup(self._users, name, pwd.getpwnam, self._addUser)
+
+    def getpwuid(self, uid):
+        return self._lookup(self._uids, uid, pwd.getpwuid, self._addUser)
+
+    def getgrnam(self, name):
+        return self._lookup(self._groups, name, grp.getgrnam, self._addGroup)
+
+    def getgrgid(self, gid):
+        return self._lookup(self._gids, gid, grp.getgrgid, self._addGroup)
+
+    def users(self):
+        return list(self._users.values())
+
+    def groups(self):
+        return list(self._groups.values())
+
+
+def _first(value):
+    if isinstance(value, list):
+        return value[0] if value else None
+    return value
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_index():
+    """The shared NssIndex, enumerated from NSS the first time"""
+    global _index
+    with _index_lock:
+        if _index is None:
+            _index = NssIndex.from_nss()
+        return _index
+
+
+def set_index(index):
+    """Use index (e.g. NssIndex.from_ldap) for the rest of the run"""
+    global _index
+    with _index_lock:
+        _index = index
+
+
+def getpwnam(name):
+    return get_index().getpwnam(name)
+
+
+def getpwuid(uid):
+    return get_index().getpwuid(uid)
+
+
+def getgrnam(name):
+    return get_index().getgrnam(name)
+
+
+def getgrgid(gid):
+    return get_index().getgrgid(gid)
@@ -0,0 +1,145 @@
+"""Create the ssh keys users use between cluster nodes
+
+Keys are generated in process with the cryptography package when it is
+installed (falling back to running ssh-keygen), ed25519 by default since
+it is far cheaper to generate than rsa. Both halves are written to a
+temporary file with their final mode (0600 private, 0644 public) and
+renamed into place, so a key is never seen half written or world
+readable. create_keys spreads a batch over a process pool sized to the
+cores:
+
+    create_keys([('/home/alice/.ssh/id_ed25519', 'alice@m3'), ...])
+
+Like mysubprocess, nothing is written in a dry run: the equivalent
+ssh-keygen command line is printed instead.
+"""
+import logging
+import os
+
+from concurrent.futures import ProcessPoolExecutor
+
+import mysubprocess
+
+KEYTYPES = ('ed25519', 'rsa')
+
+log = logging.getLogger('mgid.sshkeys')
+
+
+def keyname(keytype):
+    """The conventional file name of a private key, e.g. id_ed25519"""
+    return 'id_{}'.format(keytype)
+
+
+def have_cryptography():
+    try:
+        import cryptography.hazmat.primitives.asymmetric.ed25519  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def generate(keytype='ed25519', comment='', bits=4096):
+    """Return (private, public) as OpenSSH formatted bytes"""
+    from cryptography.hazmat.primitives import serialization
+    if keytype == 'ed25519':
+        from cryptography.hazmat.primitives.asymmetric import ed25519
+        key = ed25519.Ed25519PrivateKey.generate()
+    elif keytype == 'rsa':
+        from cryptography.hazmat.primitives.asymmetric import rsa
+        key = rsa.generate_private_key(public_exponent=65537, key_size=bits)
+    else:
+        raise ValueError("Unsupported key type {}".format(keytype))
+    private = key.private_bytes(serialization.Encoding.PEM,
+                                serialization.PrivateFormat.OpenSSH,
+                                serialization.NoEncryption())
+    public = key.public_key().public_bytes(serialization.Encoding.OpenSSH,
+                                           serialization.PublicFormat.OpenSSH)
+    if comment:
+        public += b' ' + comment.encode('utf-8')
+    return private, public + b'\n'
+
+
+def write_atomic(path, data, mode):
+    """Write data to path with mode, replacing it in one step"""
+    tmppath = '{}.tmp{}'.format(path, os.getpid())
+    fd = os.open(tmppath, os.O_WRONLY | os.O_CREAT | os.O_EXCL, mode)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        # O_CREAT's mode is masked by the umask
+        os.chmod(tmppath, mode)
+        os.rename(tmppath, path)
+    except Exception:
+        if os.path.exists(tmppath):
+            os.unlink(tmppath)
+        raise
+
+
+def _keygen_cmd(path, keytype, comment, bits):
+    cmd = ['ssh-keygen', '-q', '-t', keytype, '-N', '', '-C', comment, '-f', path]
+    if keytype == 'rsa':
+        cmd[4:4] = ['-b', str(bits)]
+    return cmd
+
+
+def create_key(path, keytype='ed25519', comment='', bits=4096):
+    """
+    Create the key pair path and path.pub (creating the parent directory
+    with mode 0700 if needed). Existing keys are left alone. Returns True
+    if a key was created, False if one exists and None in a dry run
+    """
+    if keytype not in KEYTYPES:
+        raise ValueError("Unsupported key type {}".format(keytype))
+    if mysubprocess.debug:
+        print(" ".join([a if a else '""' for a in _keygen_cmd(path, keytype, comment, bits)]))
+        return None
+    if os.path.exists(path):
+        return False
+    sshdir = os.path.dirname(path)
+    if not os.path.isdir(sshdir):
+        os.mkdir(sshdir, 0o700)
+    if have_cryptography():
+        private, public = generate(keytype, comment, bits)
+        write_atomic(path, private, 0o600)
+        write_atomic(path + '.pub', public, 0o644)
+        return True
+    result = mysubprocess.run(_keygen_cmd(path, keytype, comment, bits), backend='keygen')
+    if result.returncode != 0:
+        raise RuntimeError("ssh-keygen for {} failed: {}".format(
+            path, (result.stderr or b'').decode().strip()))
+    return True
+
+
+def _create(job):
+    path, keytype, comment, bits, debug = job
+    # A spawned worker starts with the module default
+    mysubprocess.debug = debug
+    try:
+        return path, create_key(path, keytype, comment, bits), None
+    except Exception as e:
+        return path, None, str(e)
+
+
+def create_keys(keys, keytype='ed25519', bits=4096, workers=None):
+    """
+    Create the keys for a list of (path, comment) across a process pool of
+    workers (the number of cores by default). Returns {path: created},
+    created is None for keys that failed (which are logged) and in a dry
+    run
+    """
+    jobs = [(path, keytype, comment, bits, mysubprocess.debug) for path, comment in keys]
+    if mysubprocess.debug or len(jobs) < 2:
+        results = [_create(job) for job in jobs]
+    else:
+        with ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+            results = list(pool.map(_create, jobs))
+    created = {}
+    for path, ok, error in results:
+        if error is not None:
+            log.error("Unable to create ssh key {}: {}".format(path, error))
+        created[path] = ok
+    log.debug("Created {} of {} ssh keys".format(
+        len([ok for ok in created.values() if ok]), len(created)))
+    return created
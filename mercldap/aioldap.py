@@ -0,0 +1,95 @@
+"""
+This module implements an asyncio interface to mercldap.ldap.Client
+
+ldap3's own asynchronous strategy hands back message ids that have to be
+polled, and doesn't cover the paged searches the Client relies on, so this
+wraps the ordinary blocking Client and runs each call on a thread pool.
+Every worker thread gets its own pooled connection (see
+mercldap.ldap.ConnectionPool) so calls really do run concurrently.
+
+    aclient = AsyncClient(ldapClient, concurrency=32)
+    users = aclient.run(aclient.map(aclient.getUserByMail, mails))
+"""
+import asyncio
+import functools
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+
+class AsyncClient(object):
+    """
+    Mirrors the read methods of mercldap.ldap.Client as coroutines. At most
+    concurrency calls are in flight against the server at any time, however
+    many coroutines are gathered
+    """
+    def __init__(self, client, concurrency=16):
+        self.client = client
+        self.concurrency = concurrency
+        self._executor = ThreadPoolExecutor(max_workers=concurrency)
+        self.log = logging.getLogger('mgid.ldap.async')
+
+    def __repr__(self):
+        return "<mercldap.AsyncClient {} x{}>".format(self.client.ldapURI, self.concurrency)
+
+    async def _call(self, fn, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor,
+                                          functools.partial(fn, *args, **kwargs))
+
+    async def _list(self, fn, *args, **kwargs):
+        """Run a generator returning method, collecting results in the worker"""
+        return await self._call(lambda: list(fn(*args, **kwargs)))
+
+    async def search(self, myfilter, base=None, attributes=None):
+        return await self._list(self.client.search, myfilter, base=base,
+                                attributes=attributes)
+
+    async def searchUser(self, user, attributes=None):
+        return await self._call(self.client.searchUser, user, attributes=attributes)
+
+    async def getUserByMail(self, mail, attributes=None):
+        return await self._call(self.client.getUserByMail, mail, attributes=attributes)
+
+    async def getUserDN(self, user):
+        return await self._call(self.client.getUserDN, user)
+
+    async def searchProject(self, projectName, ou='collaborations', attributes=None):
+        return await self._call(self.client.searchProject, projectName, ou,
+                                attributes=attributes)
+
+    async def getMembers(self, projectName, ou=None):
+        return await self._list(self.client.getMembers, projectName, ou)
+
+    async def getDNMembers(self, pdn):
+        return await self._list(self.client.getDNMembers, pdn)
+
+    async def getUsersProjects(self, username, ou='collaborations', attributes=None):
+        return await self._list(self.client.getUsersProjects, username, ou,
+                                attributes=attributes)
+
+    async def getUsers(self, attributes=None):
+        return await self._list(self.client.getUsers, attributes=attributes)
+
+    async def getProjects(self, ou='collaborations', attributes=None):
+        return await self._list(self.client.getProjects, ou, attributes=attributes)
+
+    async def getMembershipIndex(self, ous=('collaborations', 'aclgroups')):
+        return await self._call(self.client.getMembershipIndex, ous)
+
+    async def get_taken_usernames(self, uids):
+        return await self._call(self.client.get_taken_usernames, uids)
+
+    async def map(self, method, items, return_exceptions=False):
+        """
+        Call method (one of the coroutines above) for every item and return
+        the results in order, e.g. map(self.searchUser, usernames)
+        """
+        return await asyncio.gather(*[method(item) for item in items],
+                                    return_exceptions=return_exceptions)
+
+    def run(self, coro):
+        """Run a coroutine to completion from synchronous code"""
+        return asyncio.run(coro)
+
+    def close(self):
+        self._executor.shutdown(wait=True)
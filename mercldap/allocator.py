@@ -0,0 +1,159 @@
+"""
+This module implements uidNumber/gidNumber allocation for mercldap.Client
+
+The next free number is kept in a counter entry in the directory (by default
+cn=idpool under the ldap base, using the sambaUnixIdPool object class which
+carries both a uidNumber and a gidNumber). Numbers are taken with a single
+modify that deletes the value we last saw and adds the new one, so if
+another process got there first the modify fails and we re-read and retry.
+If the counter entry doesn't exist yet it is created once from a scan for
+the largest number in use. If it can't be created (the directory lacks the
+sambaUnixIdPool schema, or the bind DN may not add entries under the base)
+the allocator falls back to scanning for the largest number in use for
+every reservation, as mercldap did before the counter existed.
+"""
+import ldap3
+import logging
+import threading
+from collections import deque
+
+
+class IdAllocator(object):
+    """
+    Hands out unique values of one numeric attribute (uidNumber or gidNumber)
+    Numbers can be reserved in blocks with reserve() and are then handed out
+    by next() without talking to the server. Safe to share between threads
+    """
+    def __init__(self, client, attribute, ceiling=None, retries=20):
+        self.client = client
+        self.attribute = attribute
+        self.ceiling = ceiling
+        self.retries = retries
+        self._high = None
+        self._free = deque()
+        self._scanning = False
+        self._scanned = None
+        self._lock = threading.Lock()
+        self.log = logging.getLogger('mgid.ldap.allocator')
+
+    def __repr__(self):
+        return "<mercldap.IdAllocator {} {}>".format(self.attribute, self.client.idPoolDN)
+
+    def next(self):
+        """Return an unused number, reserving one if none are held locally"""
+        with self._lock:
+            if not self._free:
+                self._reserve(1)
+            return self._free.popleft()
+
+    def reserve(self, count):
+        """
+        Reserve count consecutive numbers with a single counter update.
+        They are returned and also queued for subsequent next() calls
+        """
+        with self._lock:
+            return self._reserve(count)
+
+    def _reserve(self, count):
+        for attempt in range(self.retries):
+            # Try the high-water mark from our last update first, it is only
+            # wrong if someone else has allocated since
+            current = self._high
+            if current is None:
+                current = self._read()
+            if current is None:
+                return self._reserveFromScan(count)
+            new = current + count
+            if self.ceiling is not None and new > self.ceiling:
+                raise Exception("No {} values left below {}".format(self.attribute, self.ceiling))
+            if self._swap(current, new):
+                self._high = new
+                numbers = list(range(current, new))
+                self._free.extend(numbers)
+                self.log.debug("Reserved {} {} from {}".format(count, self.attribute, current))
+                return numbers
+            self.log.debug("{} counter moved from {}, retrying".format(self.attribute, current))
+            self._high = None
+        raise Exception("Unable to reserve {} after {} attempts".format(self.attribute, self.retries))
+
+    def _swap(self, current, new):
+        changes = {self.attribute: [(ldap3.MODIFY_DELETE, [str(current)]),
+                                    (ldap3.MODIFY_ADD, [str(new)])]}
+        try:
+            return self.client.conn.modify(self.client.idPoolDN, changes)
+        except (ldap3.core.exceptions.LDAPNoSuchAttributeResult,
+                ldap3.core.exceptions.LDAPAttributeOrValueExistsResult,
+                ldap3.core.exceptions.LDAPConstraintViolationResult):
+            return False
+
+    def _reserveFromScan(self, count):
+        """
+        Fallback without a counter entry: the numbers after the largest in
+        use, or after the last we handed out. Not safe against concurrent
+        allocation
+        """
+        if self.attribute == 'uidNumber':
+            current = int(self.client._getMaxUidNumber()) + 1
+        else:
+            current = int(self.client._getMaxGidNumber()) + 1
+        if self._scanned is not None:
+            current = max(current, self._scanned)
+        new = current + count
+        if self.ceiling is not None and new > self.ceiling:
+            raise Exception("No {} values left below {}".format(self.attribute, self.ceiling))
+        self._scanned = new
+        numbers = list(range(current, new))
+        self._free.extend(numbers)
+        self.log.debug("Reserved {} {} from {} by scanning".format(count, self.attribute, current))
+        return numbers
+
+    def _read(self):
+        """The counter's current value, None if there is no counter entry
+        and one can't be created"""
+        if self._scanning:
+            return None
+        entry = self._fetch()
+        if entry is None and self._createPool():
+            entry = self._fetch()
+        if entry is None:
+            self.log.warning("Id pool {} unavailable, allocating {} by scanning the directory".format(
+                self.client.idPoolDN, self.attribute))
+            self._scanning = True
+            return None
+        value = entry['attributes'][self.attribute]
+        if isinstance(value, list):
+            value = value[0]
+        return int(value)
+
+    def _fetch(self):
+        conn = self.client.conn
+        try:
+            conn.search(self.client.idPoolDN, '(objectClass=*)',
+                        search_scope=ldap3.BASE, attributes=[self.attribute])
+        except ldap3.core.exceptions.LDAPNoSuchObjectResult:
+            return None
+        if len(conn.response) == 0:
+            return None
+        return conn.response[0]
+
+    def _createPool(self):
+        """
+        One off fallback: seed the counter entry from the largest numbers
+        currently in the directory. Returns False if it couldn't be created
+        """
+        uidNumber = int(self.client._getMaxUidNumber()) + 1
+        gidNumber = int(self.client._getMaxGidNumber()) + 1
+        cn = self.client.idPoolDN.split(',')[0].split('=', 1)[1]
+        self.log.info("Creating id pool {} with uidNumber {} gidNumber {}".format(
+            self.client.idPoolDN, uidNumber, gidNumber))
+        try:
+            self.client.conn.add(self.client.idPoolDN,
+                                 object_class=self.client.idPoolObjectClass,
+                                 attributes={'cn': cn, 'uidNumber': uidNumber,
+                                             'gidNumber': gidNumber})
+        except ldap3.core.exceptions.LDAPEntryAlreadyExistsResult:
+            self.log.debug("Id pool already created by someone else")
+        except ldap3.core.exceptions.LDAPException as e:
+            self.log.error("Unable to create id pool {}: {}".format(self.client.idPoolDN, e))
+            return False
+        return True
@@ -2,71 +2,334 @@
 This module implements an ldap interface with simplified calls for the HPC getProjectNames
 """
 import ldap3
+from mercldap.allocator import IdAllocator
+from ldap3.utils.conv import escape_filter_chars
+import atexit
 import logging
+import threading
+
+# Per item outcomes reported by Client.modifyMembers
+MEMBER_ADDED = 'added'
+MEMBER_REMOVED = 'removed'
+ALREADY_MEMBER = 'already a member'
+NOT_MEMBER = 'not a member'
+NO_SUCH_GROUP = 'no such group'
+AMBIGUOUS_GROUP = 'too many groups matched'
+NO_SUCH_USER = 'no such user'
+MODIFY_FAILED = 'failed'
+
+
+class Entry(object):
+    """
+    A compact search result holding only the dn and the attributes that
+    were asked for. Indexing with 'dn' or 'attributes' works as it does on
+    the dicts returned by ldap3 so existing callers are unaffected
+    """
+    __slots__ = ('dn', 'attributes')
+
+    def __init__(self, dn, attributes):
+        self.dn = dn
+        self.attributes = attributes
+
+    def __repr__(self):
+        return "<mercldap.Entry {}>".format(self.dn)
+
+    def __getitem__(self, key):
+        if key == 'dn':
+            return self.dn
+        if key == 'attributes':
+            return self.attributes
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        return key in ('dn', 'attributes')
+
+
+class ExpansionCache(object):
+    """
+    Flattened membership of nested groups keyed by lower cased group DN.
+    Shared by every Client in the process and cleared whenever group
+    membership is modified through a Client
+    """
+    def __init__(self):
+        self._members = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            members = self._members.get(key)
+            if members is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return members
+
+    def put(self, key, members):
+        with self._lock:
+            self._members[key] = members
+
+    def clear(self):
+        with self._lock:
+            self._members.clear()
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'groups': len(self._members)}
+
+
+_expansionCache = ExpansionCache()
+
+
+def expandGroup(dn, direct, cache, log, unique=False):
+    """
+    Return the flattened membership of group dn. direct(dn) returns the
+    group's own members as (member, nested) pairs, nested being True for a
+    group to recurse into, and flattened groups are kept in cache (anything
+    with get and put, keyed by lower cased DN).
+    Groups that form a cycle all have the same flattened membership, so a
+    cycle is expanded as one unit (Tarjan's strongly connected components):
+    a group still waiting on a group further up the walk is never cached on
+    its own, every group of the cycle is cached with the combined members
+    once the walk is back at the first of them. With unique set members are
+    only listed once (DNs compared case insensitively)
+    """
+    order = []
+    onstack = {}
+
+    def visit(dn):
+        key = dn.lower()
+        members = cache.get(key)
+        if members is not None:
+            return members, None
+        if key in onstack:
+            log.warning('Group membership cycle through {}'.format(dn))
+            return [], onstack[key]
+        index = len(order)
+        onstack[key] = index
+        order.append(key)
+        low = index
+        members = []
+        for member, nested in direct(dn):
+            if not nested:
+                members.append(member)
+                continue
+            found, reached = visit(member)
+            members.extend(found)
+            if reached is not None and reached < low:
+                low = reached
+        if unique:
+            members = _unique(members)
+        if low < index:
+            # Part of a cycle through a group that is still being expanded,
+            # members are only complete once that group is done
+            return members, low
+        for k in order[index:]:
+            del onstack[k]
+            cache.put(k, members)
+        del order[index:]
+        return members, None
+
+    return visit(dn)[0]
+
+
+def _unique(members):
+    seen = set()
+    result = []
+    for m in members:
+        k = m.lower() if isinstance(m, str) else m
+        if k not in seen:
+            seen.add(k)
+            result.append(m)
+    return result
+
+
+class ConnectionPool(object):
+    """
+    Bound connections to one set of ldap servers, shared by every Client in
+    the process configured with the same servers and credentials.
+    ldap3 connections can't be used from two threads at once, so each thread
+    gets its own connection, opened and bound the first time that thread
+    needs it. When several servers are configured they are tried
+    round-robin (or first-available) and a dead server is skipped. Binding
+    gives up with LDAPServerPoolExhaustedError once every server has failed
+    poolActive times in a row
+    """
+    def __init__(self,ldapURI,user=None,passwd=None,cafile=None,poolStrategy='ROUND_ROBIN',poolActive=3):
+        tls_configuration = ldap3.Tls(validate=2, version=3,ca_certs_file=cafile)
+        if not isinstance(ldapURI,list):
+            ldapURI = [ldapURI]
+        servers = [ ldap3.Server(uri,port=636,use_ssl=True, tls=tls_configuration,get_info=ldap3.ALL) for uri in ldapURI]
+        strategy = getattr(ldap3, poolStrategy.upper())
+        self.serverPool = ldap3.ServerPool(servers,pool_strategy=strategy,active=poolActive,exhaust=60)
+        self.user = user
+        self.passwd = passwd
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections = []
+        self.log = logging.getLogger('mgid.ldap')
+
+    def connection(self):
+        """
+        Return the calling thread's connection, binding it if necessary
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and not conn.closed:
+            return conn
+        conn = ldap3.Connection(self.serverPool,user=self.user,password=self.passwd,raise_exceptions=True)
+        if not conn.bind():
+            raise Exception("error in bind {}".format(conn.result))
+        self.log.debug("Bound new ldap connection to {}".format(conn.server))
+        self._local.conn = conn
+        with self._lock:
+            self._connections.append(conn)
+        return conn
+
+    def close(self):
+        with self._lock:
+            for conn in self._connections:
+                try:
+                    conn.unbind()
+                except Exception:
+                    pass
+            self._connections = []
+        self._local = threading.local()
+
+
+_pools = {}
+_poolsLock = threading.Lock()
+
+
+def getConnectionPool(ldapURI,user=None,passwd=None,cafile=None,poolStrategy='ROUND_ROBIN'):
+    """
+    Return the process wide ConnectionPool for these servers and credentials,
+    creating it on first use
+    """
+    uris = tuple(ldapURI) if isinstance(ldapURI,list) else (ldapURI,)
+    key = (uris, user, passwd, cafile, poolStrategy)
+    with _poolsLock:
+        if key not in _pools:
+            _pools[key] = ConnectionPool(list(uris),user,passwd,cafile,poolStrategy)
+        return _pools[key]
+
+
+def closeConnectionPools():
+    with _poolsLock:
+        for pool in _pools.values():
+            pool.close()
+        _pools.clear()
+
+
+atexit.register(closeConnectionPools)
+
 
 class Client(object):
     """
     Interaction with ldap is done through the client class
-    This object is not "thread safe". Specifically using the same object from
-    two threads or different objects from two threads will probably succeed,
-    but if createUser is called twice from two different threads, it might
-    create users with the same uidNumber (which would be bad) therefore please
-    use a mutex around calls to createUser
+    Connections come from a process wide ConnectionPool, one per thread, so
+    the same object can be used from several threads. uidNumbers and
+    gidNumbers are taken from a counter entry (see mercldap.allocator) so
+    concurrent createUser/createProject calls, even from different hosts,
+    won't hand out the same number (if the entry can't be created they fall
+    back to a scan for the largest number in use)
     """
-    def __init__(self,ldapURI=None,user=None,passwd=None,cafile=None,ldapAccountBase=None,*args,**kwargs):
+    def __init__(self,ldapURI=None,user=None,passwd=None,cafile=None,ldapAccountBase=None,poolStrategy='ROUND_ROBIN',
+                 idPoolDN=None,idPoolObjectClass=('top','device','sambaUnixIdPool'),
+                 replicaPath=None,replicaMaxAge=300,*args,**kwargs):
         self.ldapURI=ldapURI
         self.user=user
         self.passwd=passwd
         self.cafile=cafile
         self.ldapAccountBase = ldapAccountBase
-        self.conn=None
+        self.poolStrategy = poolStrategy
+        self._conn=None
         self.ldapBase='dc=erc,dc=monash,dc=edu,dc=au'
         self.log=logging.getLogger('mgid.ldap')
+        if idPoolDN is None:
+            idPoolDN='cn=idpool,{}'.format(self.ldapBase)
+        self.idPoolDN=idPoolDN
+        self.idPoolObjectClass=list(idPoolObjectClass)
+        self.uidAllocator=IdAllocator(self,'uidNumber')
+        # 65534 is the Nobody group, we shouldn't have gids above this
+        self.gidAllocator=IdAllocator(self,'gidNumber',ceiling=65534)
+        if replicaPath is not None:
+            from mercldap.replica import Replica
+            self.replica=Replica(self,replicaPath,maxAge=replicaMaxAge)
+        else:
+            self.replica=None
 
     def __repr__(self):
         return("<mercldap.Client {}>".format(self.ldapURI))
 
-    def __connect(self):
+    @property
+    def conn(self):
         """
-        The __connect call will cause you to authenticate to the ldap server and be
-        ready to make changes
+        The connection for the calling thread. Connections are taken from the
+        shared pool and bound on first use unless one has been assigned
+        explicitly (e.g. an ldap3 MOCK_SYNC connection)
         """
-        tls_configuration = ldap3.Tls(validate=2, version=3,ca_certs_file=self.cafile)
-        if isinstance(self.ldapURI,list):
-            servers = [ ldap3.Server(uri,port=636,use_ssl=True, tls=tls_configuration,get_info=ldap3.ALL) for uri in self.ldapURI]
-            self.conn=ldap3.Connection(servers,user=self.user,password=self.passwd,raise_exceptions=True)
-        else:
-            servers = ldap3.Server(self.ldapURI,port=636,use_ssl=True, tls=tls_configuration,get_info=ldap3.ALL)
-            self.conn=ldap3.Connection(servers,user=self.user,password=self.passwd,raise_exceptions=True)
-        if not self.conn.bind():
-            raise Exception("error in bind {}".format(self.conn.result))
+        if self._conn is not None:
+            return self._conn
+        pool = getConnectionPool(self.ldapURI,self.user,self.passwd,self.cafile,self.poolStrategy)
+        return pool.connection()
+
+    @conn.setter
+    def conn(self, value):
+        self._conn = value
+
+    def _replica(self):
+        """
+        Return the local replica, synced if it is older than its maximum
+        age, or None if reads should go to the server
+        """
+        if self.replica is None:
+            return None
+        self.replica.ensureFresh()
+        return self.replica
+
+    def _changed(self):
+        """
+        Called after any write, cached group expansions are dropped and
+        the replica will sync before it is read again
+        """
+        _expansionCache.clear()
+        if self.replica is not None:
+            self.replica.invalidate()
 
 
     def _createOu(self,ouName):
-        if self.conn == None:
-            self.__connect()
         self.conn.add('ou={},{}'.format(ouName,self.ldapBase),'organizationalUnit')
 
     def _removeOu(self,ouName):
-        if self.conn == None:
-            self.__connect()
         self.conn.delete('ou={},{}'.format(ouName,self.ldapBase))
 
     def _getMaxGidNumber(self):
-        if self.conn == None:
-            self.__connect()
         entries=self.conn.extend.standard.paged_search(self.ldapBase,'(gidNumber=*)',attributes=['gidNumber'],paged_size=100)
         gidlist = [ int(x['attributes']['gidnumber']) for x in entries ]
         # 65534 is the Nobody group, we shouldn't have gids above this
         return max( filter(lambda x: x < 65534, gidlist) )
 
     def _getMaxUidNumber(self):
-        if self.conn == None:
-            self.__connect()
         entries=self.conn.extend.standard.paged_search(self.ldapBase,'(uidNumber=*)',attributes=['uidNumber'],paged_size=100)
         maxuser = max( entries, key=lambda x: int(x['attributes']['uidNumber']))
         return maxuser['attributes']['uidNumber']
 
+    def reserveUidNumbers(self,count):
+        """
+        Reserve count uidNumbers with one counter update, the following
+        count createUser calls without an explicit uidNumber will use them
+        """
+        return self.uidAllocator.reserve(count)
+
+    def reserveGidNumbers(self,count):
+        """
+        Reserve count gidNumbers with one counter update, the following
+        count createProject calls without an explicit gidNumber will use them
+        """
+        return self.gidAllocator.reserve(count)
+
     def createUser(self,user,attributes={},uidNumber=None,ou='Accounts'):
         """
         create a user,
@@ -76,6 +339,7 @@ class Client(object):
         Obviously its assumed you will check for the existance of the username first
         but expect the exception in case of an extremely unlikely race condition
         Note also that I don't believe we enforce uidNumber uniqueness constraints
+        on the server, uniqueness comes from the uidNumber allocator
         """
         nogroup=65534 # I should look this up on the system, but I will assume nogroup is always 65534 for the moment
         defaultAttributes={'sn':' ', 'cn':' ','pwdAttribute':'userPassword','gidNumber':nogroup,'homeDirectory':'/home/{}'.format(user)}
@@ -83,19 +347,19 @@ class Client(object):
             if not attrib in attributes:
                 attributes[attrib]=defaultAttributes[attrib]
         objectClasses = ['organizationalPerson','top','inetOrgPerson','person','shadowAccount','pwdPolicy','posixAccount']
-        if self.conn == None:
-            self.__connect()
-        lle = len(list(self.search('(ou={})'.format(ou))))
+        lle = len(list(self.search('(ou={})'.format(ou),attributes=['ou'])))
         if lle == 0:
             self._createOu('users')
         if uidNumber  == None:
-            uidNumber = self._getMaxUidNumber() + 1
+            uidNumber = self.uidAllocator.next()
         attributes['uidNumber'] = uidNumber
         self.conn.add('uid={},ou={},{}'.format(user,ou,self.ldapBase),object_class=objectClasses,attributes=attributes)
+        self._changed()
 
     def deleteUser(self,user):
         userdn=self.getUserDN(user)
         self.conn.delete(userdn)
+        self._changed()
 
     def modifyUser(self,user,attributes):
         userdn = self.getUserDN(user)
@@ -103,9 +367,10 @@ class Client(object):
         for attrib in attributes:
             changes[attrib] = (ldap3.MODIFY_REPLACE,[attributes[attrib]])
         self.conn.modify(userdn,changes)
+        self._changed()
 
     def getUserDN(self,user):
-        u = self.searchUser(user)
+        u = self.searchUser(user,attributes=['uid'])
         if u != None:
             return u['dn']
         else:
@@ -118,16 +383,15 @@ class Client(object):
         self.createProject(projectName,attributes=attributes)
 
     def createProject(self,projectName,gidNumber=None,attributes={},ou='collaborations'):
-        if self.conn == None:
-            self.__connect()
-        lle = len(list(self.search('(ou={})'.format(ou))))
+        lle = len(list(self.search('(ou={})'.format(ou),attributes=['ou'])))
         if lle == 0:
             self._createOu(ou)
         if gidNumber  == None:
-            gidNumber = self._getMaxGidNumber() + 1
+            gidNumber = self.gidAllocator.next()
         attributes.update({'cn':projectName,'member':'','gidNumber':gidNumber})
         try:
             self.conn.add('cn={},ou={},{}'.format(projectName,ou,self.ldapBase),object_class=['groupOfNames','top','auxPosixGroup'],attributes=attributes)
+            self._changed()
         except ldap3.core.exceptions.LDAPEntryAlreadyExistsResult:
             self.log.debug("Project already exists in LDAP, ignoring this exception")
         except Exception as e:
@@ -138,28 +402,37 @@ class Client(object):
         filter2='(&(uid={})(objectClass=posixAccount))'.format(userName)
         self._addNestedDN(filter1,filter2)
 
-    def getProjects(self,ou='collaborations'):
+    def getProjects(self,ou='collaborations',attributes=None):
+        replica = self._replica()
+        if replica is not None:
+            yield from replica.getProjects(ou, attributes)
+            return
         filter1='(&(ou:dn:={})(|(objectClass=posixGroup)(objectClass=auxPosixGroup)))'.format(ou)
-        for p in self.search(filter1):
+        for p in self.search(filter1,attributes=attributes):
             yield p
 
     def getProjectNames(self,ou='collaborations'):
-        for p in self.getProjects(ou):
+        for p in self.getProjects(ou,attributes=['cn']):
             yield p['attributes']['cn'][0]
 
-    def getUsers(self):
+    def getUsers(self,attributes=None):
+        replica = self._replica()
+        if replica is not None:
+            yield from replica.getUsers(attributes)
+            return
         filter1='(objectClass=posixAccount)'
-        for p in self.search(filter1):
+        for p in self.search(filter1,attributes=attributes):
             yield p
-    def getPeople(self):
+
+    def getPeople(self,attributes=None):
         filter1='(objectClass=person)'
-        for p in self.search(filter1):
+        for p in self.search(filter1,attributes=attributes):
             yield p
 
-    def getUsersProjects(self,username,ou='collaborations'):
+    def getUsersProjects(self,username,ou='collaborations',attributes=None):
         userdn = self.getUserDN(username)
         filter1='(&(ou:dn:={})(&(objectClass=auxPosixGroup)(member={})))'.format(ou,userdn)
-        for p in self.search(filter1):
+        for p in self.search(filter1,attributes=attributes):
             yield p
 
     def groupName(self,project):
@@ -183,17 +456,87 @@ class Client(object):
         return self.getDNMembers(p['dn'])
 
     def getMembers(self, projectName, ou=None):
+        replica = self._replica()
+        if replica is not None:
+            return replica.getMembershipIndex().getMembers(projectName, ou or 'collaborations')
         if ou is not None:
-            p = self.searchProject(projectName, ou)
+            p = self.searchProject(projectName, ou, attributes=['cn'])
         else:
-            p = self.searchProject(projectName)
+            p = self.searchProject(projectName, attributes=['cn'])
         return self.getDNMembers(p['dn'])
 
 
+    def getMembershipIndex(self, ous=('collaborations', 'aclgroups')):
+        """
+        Fetch every group under the given OUs with a single paged search and
+        return a MembershipIndex which answers getMembers from memory.
+        Only cn, member and memberUid are requested, memberUid values are
+        resolved back to DNs in bulk and nested groups are expanded
+        """
+        replica = self._replica()
+        if replica is not None:
+            return replica.getMembershipIndex(ous)
+        oufilter = ''.join(['(ou:dn:={})'.format(ou) for ou in ous])
+        filter1 = ('(&(|{})(|(objectClass=groupOfNames)(objectClass=posixGroup)'
+                   '(objectClass=auxPosixGroup)))'.format(oufilter))
+        entries = self.conn.extend.standard.paged_search(
+            self.ldapBase, filter1, paged_size=500,
+            attributes=['cn', 'member', 'memberUid'])
+        groups = []
+        memberuids = set()
+        for e in entries:
+            if e.get('type') != 'searchResEntry':
+                continue
+            attrs = e['attributes']
+            members = [m for m in attrs.get('member', []) if m != '']
+            uids = list(attrs.get('memberUid', []))
+            memberuids.update(uids)
+            groups.append((e['dn'], attrs['cn'][0], members, uids))
+        uiddns = self._resolveUidDNs(memberuids)
+        index = MembershipIndex(self, ous)
+        for dn, cn, members, uids in groups:
+            for muid in uids:
+                if muid in uiddns:
+                    members.append(uiddns[muid])
+                else:
+                    self.log.debug('memberUid {} of {} does not exist'.format(muid, dn))
+            index._addGroup(dn, cn, members)
+        self.log.debug('Membership index holds {} groups'.format(len(groups)))
+        return index
+
+    def _resolveUidDNs(self, uids, chunk=200):
+        """
+        Turn a collection of usernames into a dict of username to DN using
+        as few OR-filter searches as possible
+        """
+        result = {}
+        uids = sorted(uids)
+        for i in range(0, len(uids), chunk):
+            terms = ''.join(['(uid={})'.format(escape_filter_chars(u))
+                             for u in uids[i:i + chunk]])
+            filter1 = '(&(objectClass=posixAccount)(|{}))'.format(terms)
+            entries = self.conn.extend.standard.paged_search(
+                self.ldapBase, filter1, paged_size=500, attributes=['uid'])
+            for e in entries:
+                if e.get('type') != 'searchResEntry':
+                    continue
+                result[e['attributes']['uid'][0]] = e['dn']
+        return result
+
     def getDNMembers(self, pdn):
+        """
+        Yield the members of the group pdn, recursing into nested groups.
+        Each group is fetched and flattened once per process, see
+        expansionStats, and membership cycles are broken rather than followed
+        """
+        yield from expandGroup(pdn, self._directMembers, _expansionCache, self.log)
+
+    def _directMembers(self, pdn):
         p=self.conn.extend.standard.paged_search(pdn, '(objectClass=*)',
+                                                 search_scope=ldap3.BASE,
                                                  paged_size=3, generator=False,
-                                                 attributes=['*'])
+                                                 attributes=['member', 'memberUid'])
+        members = []
         # New style "groupOfNames" objects store a full dn in the member attributes
         # Old style "posixGroup" objects store a username in the memberUid attributes
         if 'member' in p[0]['attributes']:
@@ -202,15 +545,22 @@ class Client(object):
                     continue
                 # If the DN begins with uid= then it must be a user, if it
                 # begins with anything else, its probably a group, which we can recurse
-                if 'uid=' in mdn[0:4]:
-                    yield mdn
-                else:
-                    yield from self.getDNMembers(mdn)
+                members.append((mdn, 'uid=' not in mdn[0:4]))
         # If we've encountered a memberUid attribute, we need to turn it back from
         # a username into a DN
         if 'memberUid' in p[0]['attributes']:
             for muid in p[0]['attributes']['memberUid']:
-                yield self.searchUser(muid)
+                members.append((self.searchUser(muid), False))
+        return members
+
+    def expansionStats(self):
+        """
+        Return the hits, misses and size of the nested group expansion cache
+        """
+        return _expansionCache.stats()
+
+    def clearExpansionCache(self):
+        _expansionCache.clear()
 
     def addManager(self, projectName, userName, ou='collaborations'):
         filter1='(&(ou:dn:={})(&(cn={})(objectClass=auxPosixGroup)))'.format(ou,projectName)
@@ -237,8 +587,6 @@ class Client(object):
     def _addNestedDN(self, filter1, filter2):
         import logging
         log = logging.getLogger('mgid.ldap')
-        if self.conn == None:
-            self.__connect()
         group = self.conn.extend.standard.paged_search(self.ldapBase, filter1,
                                                        paged_size=3,
                                                        generator=False)
@@ -258,12 +606,11 @@ class Client(object):
             for g in group:
                 log.debug('Adding member {} to {}'.format(m['dn'], g['dn']))
                 self.conn.modify(g['dn'],{'member':[ldap3.MODIFY_ADD,[m['dn']]]})
+        self._changed()
 
     def _addNestedManagerDN(self,filter1,filter2):
         import logging
         log = logging.getLogger('mgid.ldap')
-        if self.conn == None:
-            self.__connect()
         group=self.conn.extend.standard.paged_search(self.ldapBase,filter1,paged_size=3,generator=False)
         member=self.conn.extend.standard.paged_search(self.ldapBase,filter2,paged_size=3,generator=False)
         if len(group) > 1:
@@ -274,12 +621,11 @@ class Client(object):
             for g in group:
                 log.debug('Removing member {} from {}'.format(m['dn'], d['dn']))
                 self.conn.modify(g['dn'],{'owner':[ldap3.MODIFY_ADD,[m['dn']]]})
+        self._changed()
 
     def _rmNestedDN(self,filter1,filter2):
         import logging
         log = logging.getLogger('mgid.ldap')
-        if self.conn == None:
-            self.__connect()
         group=self.conn.extend.standard.paged_search(self.ldapBase,filter1,paged_size=3,generator=False)
         member=self.conn.extend.standard.paged_search(self.ldapBase,filter2,paged_size=3,generator=False)
 
@@ -295,6 +641,95 @@ class Client(object):
             for g in group:
                 log.debug('Removing member {} from {}'.format(m['dn'], g['dn']))
                 self.conn.modify(g['dn'],{'member':[ldap3.MODIFY_DELETE,[m['dn']]]})
+        self._changed()
+
+    def addUsers(self, pairs, ou='collaborations'):
+        """
+        Bulk version of addUser, pairs is an iterable of (projectName, userName)
+        """
+        return self.modifyMembers(pairs, ldap3.MODIFY_ADD, ou,
+                                  '(|(objectClass=posixGroup)(objectClass=auxPosixGroup))')
+
+    def rmUsers(self, pairs, ou='collaborations'):
+        """
+        Bulk version of rmUser, pairs is an iterable of (projectName, userName)
+        """
+        return self.modifyMembers(pairs, ldap3.MODIFY_DELETE, ou,
+                                  '(objectClass=auxPosixGroup)')
+
+    def add_acl_users(self, pairs, ou='aclgroups'):
+        return self.modifyMembers(pairs, ldap3.MODIFY_ADD, ou,
+                                  '(objectClass=groupOfNames)')
+
+    def remove_acl_users(self, pairs, ou='aclgroups'):
+        return self.modifyMembers(pairs, ldap3.MODIFY_DELETE, ou,
+                                  '(objectClass=groupOfNames)')
+
+    def modifyMembers(self, pairs, operation, ou, groupFilter, chunk=200):
+        """
+        Add (operation=ldap3.MODIFY_ADD) or remove (ldap3.MODIFY_DELETE) many
+        users to/from many groups. Groups and users are resolved with a
+        handful of OR-filter searches and each group gets a single multi-value
+        modify containing only the members that actually need changing.
+        Returns a dict of (projectName, userName) -> outcome, one of the
+        MEMBER_*/NO_SUCH_*/... constants in this module, MODIFY_FAILED
+        outcomes are followed by the error
+        """
+        pairs = list(pairs)
+        outcomes = {}
+        projectNames = sorted(set([g for g, u in pairs]))
+        groups = {}
+        for i in range(0, len(projectNames), chunk):
+            terms = ''.join(['(cn={})'.format(escape_filter_chars(g))
+                             for g in projectNames[i:i + chunk]])
+            filter1 = '(&(ou:dn:={}){}(|{}))'.format(ou, groupFilter, terms)
+            for e in self.search(filter1, attributes=['cn', 'member']):
+                for cn in e['attributes']['cn']:
+                    groups.setdefault(cn, []).append(e)
+        userdns = self._resolveUidDNs(set([u for g, u in pairs]), chunk)
+
+        pending = {}
+        for projectName, userName in pairs:
+            key = (projectName, userName)
+            if projectName not in groups:
+                outcomes[key] = NO_SUCH_GROUP
+            elif len(groups[projectName]) > 1:
+                outcomes[key] = AMBIGUOUS_GROUP
+            elif userName not in userdns:
+                outcomes[key] = NO_SUCH_USER
+            else:
+                pending.setdefault(projectName, []).append(key)
+
+        for projectName, keys in pending.items():
+            group = groups[projectName][0]
+            current = set([m.lower() for m in group['attributes'].get('member', [])])
+            values = []
+            changing = []
+            for key in keys:
+                dn = userdns[key[1]]
+                if operation == ldap3.MODIFY_ADD and dn.lower() in current:
+                    outcomes[key] = ALREADY_MEMBER
+                elif operation == ldap3.MODIFY_DELETE and dn.lower() not in current:
+                    outcomes[key] = NOT_MEMBER
+                elif dn not in values:
+                    values.append(dn)
+                    changing.append(key)
+                else:
+                    changing.append(key)
+            if len(values) == 0:
+                continue
+            self.log.debug('Modifying {} members of {}'.format(len(values), group['dn']))
+            try:
+                self.conn.modify(group['dn'], {'member': [(operation, values)]})
+                done = MEMBER_ADDED if operation == ldap3.MODIFY_ADD else MEMBER_REMOVED
+                for key in changing:
+                    outcomes[key] = done
+            except Exception as e:
+                self.log.error('Unable to modify members of {}: {}'.format(group['dn'], e))
+                for key in changing:
+                    outcomes[key] = '{}: {}'.format(MODIFY_FAILED, e)
+        self._changed()
+        return outcomes
 
     def setUserPassword(self,username,passwd):
         """
@@ -308,8 +743,6 @@ class Client(object):
         self.conn.modify(user['dn'], {'userPassword': [(ldap3.MODIFY_REPLACE,[hashed_password])]})
 
     def lockAccount(self,user):
-        if self.conn == None:
-            self.__connect()
         ldapfilter='(&(uid={})(objectClass=posixAccount))'.format(user)
         users=self.conn.extend.standard.paged_search(self.ldapBase,ldapfilter,paged_size=3,generator=False)
         if len(users) > 1:
@@ -320,8 +753,6 @@ class Client(object):
             self.conn.modify(u['dn'],{'pwdAccountLockedTime':[ldap3.MODIFY_REPLACE,['000001010000Z']]})
 
     def unlockAccount(self,user):
-        if self.conn == None:
-            self.__connect()
         ldapfilter='(&(uid={})(objectClass=posixAccount))'.format(user)
         users=self.conn.extend.standard.paged_search(self.ldapBase,ldapfilter,paged_size=3,generator=False)
         if len(users) > 1:
@@ -334,12 +765,14 @@ class Client(object):
 
 
     def deleteProject(self,projectName,ou='collaborations'):
-        if self.conn == None:
-            self.__connect()
         self.conn.delete('cn={},ou={},{}'.format(projectName,ou,self.ldapBase))
+        self._changed()
 
-    def searchProject(self,projectName,ou='collaborations'):
-        entries = self.search('(cn={})'.format(projectName),base='ou={},{}'.format(ou,self.ldapBase))
+    def searchProject(self,projectName,ou='collaborations',attributes=None):
+        replica = self._replica()
+        if replica is not None:
+            return replica.searchProject(projectName, ou, attributes)
+        entries = self.search('(cn={})'.format(projectName),base='ou={},{}'.format(ou,self.ldapBase),attributes=attributes)
         le = list(entries)
         if len(le) > 1:
             raise Exception("too any projects matched")
@@ -347,8 +780,11 @@ class Client(object):
             return None
         return le[0]
 
-    def searchUser(self,user):
-        entries = self.search('(&(uid={})(objectClass=posixAccount))'.format(user))
+    def searchUser(self,user,attributes=None):
+        replica = self._replica()
+        if replica is not None:
+            return replica.searchUser(user, attributes)
+        entries = self.search('(&(uid={})(objectClass=posixAccount))'.format(user),attributes=attributes)
         le = list(entries)
         if len(le) > 1:
             raise Exception("too any users matched")
@@ -356,8 +792,11 @@ class Client(object):
             return None
         return le[0]
 
-    def getUserByMail(self,mail):
-        entries = self.search('(&(mail={})(objectClass=posixAccount))'.format(mail))
+    def getUserByMail(self,mail,attributes=None):
+        replica = self._replica()
+        if replica is not None:
+            return replica.getUserByMail(mail, attributes)
+        entries = self.search('(&(mail={})(objectClass=posixAccount))'.format(mail),attributes=attributes)
         le = list(entries)
         if len(le) > 1:
             raise Exception("too any users matched")
@@ -365,17 +804,20 @@ class Client(object):
             return None
         return le[0]
 
-    def search(self, myfilter, base=None):
+    def search(self, myfilter, base=None, attributes=None):
         """
         Use this method with an appropriate filter to determine if a username already exists
         Be aware it returns a generator. If the generator is not empty then the username exists
+        Pass attributes to limit what the server sends back (all user
+        attributes by default). Results are Entry objects
         """
         if base == None:
             base = self.ldapBase
-        if self.conn == None:
-            self.__connect()
-        entries=self.conn.extend.standard.paged_search(base,myfilter,paged_size=100,attributes=['*'])
-        return entries
+        if attributes is None:
+            attributes = ['*']
+        entries=self.conn.extend.standard.paged_search(base,myfilter,paged_size=100,attributes=attributes)
+        return (Entry(e['dn'], e['attributes']) for e in entries
+                if e.get('type') == 'searchResEntry')
 
     def generate_all_uids(self, mail, cn, suffix=''):
         """
@@ -447,6 +889,25 @@ class Client(object):
 
         return uids
 
+    def get_taken_usernames(self, uids, chunk=100):
+        """
+        Return the subset of uids that already belong to a posixAccount,
+        checking up to chunk candidates per OR-filter search and only
+        asking for the uid attribute
+        :param uids: an iterable of candidate usernames
+        :param chunk: the number of candidates per search
+        :return: a set of usernames that are taken
+        """
+        uids = list(uids)
+        taken = set()
+        for i in range(0, len(uids), chunk):
+            terms = ''.join(['(uid={})'.format(escape_filter_chars(u))
+                             for u in uids[i:i + chunk]])
+            search_str = '(&(objectClass=posixAccount)(|{}))'.format(terms)
+            for user in self.search(search_str, attributes=['uid']):
+                taken.update(user['attributes']['uid'])
+        return taken
+
     def get_possible_usernames(self, mail, cn, suffix=''):
         """
         Get only the acceptable options for a username based on generating all
@@ -459,22 +920,27 @@ class Client(object):
         """
 
         possible_uids = self.generate_all_uids(mail, cn, suffix)
+        taken = self.get_taken_usernames(possible_uids)
         for test_uid in possible_uids:
-            search_str = "(&(uid={})(objectClass=posixAccount))".format(test_uid)
-            users = list(self.search(search_str))
             # If a user already exists, skip this posix uid by continuing
-            if len(users) > 0:
+            if test_uid in taken:
                 continue
             yield test_uid
 
-    def possible_username_handler(self, mail, cn, suffix='', min_length=3):
+    def possible_username_handler(self, mail, cn, suffix='', min_length=3,
+                                  batch=25, max_suffix=9999):
         """
         A handler to ensure that a minimum of 3 username options are returned
         each time a new username is requested
+        Suffixed candidates are generated up front, batch suffixes at a time,
+        and each batch is checked with a single search, so the number of
+        searches doesn't grow with the number of collisions on a common name
         :param mail:
         :param cn:
         :param suffix:
         :param min_length:
+        :param batch: the number of numeric suffixes checked per search
+        :param max_suffix: give up after this suffix
         :return:
         """
 
@@ -482,14 +948,22 @@ class Client(object):
         # options
         uids = set(self.get_possible_usernames(mail, cn))
         suffix = 1
-        while len(uids) < min_length:
-            uids = uids.union(
-                set(
-                    self.get_possible_usernames(
-                        mail, cn, '{0:04d}'.format(suffix))
-                )
-            )
-            suffix += 1
+        while len(uids) < min_length and suffix <= max_suffix:
+            last = min(suffix + batch, max_suffix + 1)
+            bysuffix = [self.generate_all_uids(mail, cn, '{0:04d}'.format(n))
+                        for n in range(suffix, last)]
+            candidates = set([uid for generated in bysuffix for uid in generated])
+            if len(candidates) == 0:
+                # The name can't produce a valid username, more suffixes won't help
+                break
+            taken = self.get_taken_usernames(candidates)
+            # As when each suffix was checked on its own, every free option
+            # of the suffix that reaches min_length is kept
+            for generated in bysuffix:
+                uids.update([uid for uid in generated if uid not in taken])
+                if len(uids) >= min_length:
+                    break
+            suffix = last
 
         return list(uids)
 
@@ -502,3 +976,54 @@ class Client(object):
         filter1='(&(ou:dn:={})(&(cn={})(objectClass=groupOfNames)))'.format(ou,projectName)
         filter2='(&(uid={})(objectClass=posixAccount))'.format(userName)
         self._rmNestedDN(filter1, filter2)
+
+
+class MembershipIndex(object):
+    """
+    An in memory snapshot of group membership as returned by
+    Client.getMembershipIndex. getMembers behaves like Client.getMembers
+    but never talks to the ldap server unless a nested group lives outside
+    of the indexed OUs. Group names are matched case insensitively, as a
+    (cn=X) search would
+    """
+    def __init__(self, client, ous):
+        self.client = client
+        self.ous = tuple(ous)
+        self._names = dict((ou, {}) for ou in self.ous)
+        self._direct = {}
+        self._expanded = ExpansionCache()
+        self.log = logging.getLogger('mgid.ldap')
+
+    def __repr__(self):
+        return "<mercldap.MembershipIndex {} groups>".format(len(self._direct))
+
+    def _addGroup(self, dn, cn, members):
+        self._direct[dn.lower()] = members
+        for ou in self.ous:
+            if ',ou={},'.format(ou).lower() in dn.lower():
+                self._names[ou][cn.lower()] = (cn, dn)
+
+    def getProjectNames(self, ou='collaborations'):
+        return [cn for cn, dn in self._names[ou].values()]
+
+    def getMembers(self, projectName, ou='collaborations'):
+        """
+        Return the DNs of all users in the group, nested groups expanded.
+        Unknown groups have no members
+        """
+        found = self._names[ou].get(projectName.lower())
+        if found is None:
+            self.log.warning('Group {} not found in ou={}'.format(projectName, ou))
+            return []
+        dn = found[1]
+        return list(expandGroup(dn, self._directMembers, self._expanded, self.log,
+                                unique=True))
+
+    def _directMembers(self, dn):
+        members = self._direct.get(dn.lower())
+        if members is None:
+            # Nested group outside the indexed OUs, fall back to the server
+            return [(m if isinstance(m, str) else m['dn'], False)
+                    for m in self.client.getDNMembers(dn) if m is not None]
+        # As in getDNMembers, anything not starting with uid= is a group
+        return [(mdn, 'uid=' not in mdn[0:4]) for mdn in members]
@@ -0,0 +1,321 @@
+"""
+This module implements an optional local copy of the parts of the directory
+manageid reads (posixAccount entries and the groups under the project OUs)
+
+The copy lives in an sqlite file so it survives between cron runs. Each
+sync only asks the server for entries whose modifyTimestamp is at or after
+the newest one already held, and every pruneInterval seconds lists the DNs
+(no attributes) to drop entries that were deleted. mercldap.ldap.Client
+serves its read methods from the replica when one is configured
+(replicaPath in ldapconfig.yml), syncing first if the last sync is older
+than maxAge seconds.
+
+Entries read from the replica have the shape of live ldap3 results: each
+attribute keeps the single or multi-valued form the server sent (uidNumber
+is an int, mail a list), datetime and bytes values are restored, and only
+the requested attributes are returned. uid and cn are matched case
+insensitively, as the server's (uid=X) and (cn=X) filters are.
+"""
+import base64
+import datetime
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+from ldap3.utils.ciDict import CaseInsensitiveDict
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    dn TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    name TEXT,
+    ou TEXT,
+    attributes TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_kind_name ON entries (kind, name);
+CREATE INDEX IF NOT EXISTS entries_kind_name_nocase ON entries (kind, name COLLATE NOCASE);
+CREATE TABLE IF NOT EXISTS mail (
+    mail TEXT NOT NULL,
+    key TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS mail_mail ON mail (mail);
+CREATE INDEX IF NOT EXISTS mail_key ON mail (key);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+USER = 'user'
+# Never written to the replica file
+PRIVATE_ATTRIBUTES = ('userpassword',)
+# Stored for syncing but, like on the server, only returned when asked for
+OPERATIONAL_ATTRIBUTES = ('modifytimestamp',)
+GROUP = 'group'
+# Bumped when the stored form of entries changes, forcing a full sync
+FORMAT = '2'
+
+
+def generalizedTime(value):
+    """Render a modifyTimestamp (datetime or string) as LDAP generalized time"""
+    if isinstance(value, list):
+        value = value[0]
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo is not None:
+            value = value.astimezone(datetime.timezone.utc)
+        return value.strftime('%Y%m%d%H%M%SZ')
+    return str(value)
+
+
+def _jsonable(value):
+    if isinstance(value, list):
+        return [_jsonable(v) for v in value]
+    if isinstance(value, bytes):
+        return {'$bytes': base64.b64encode(value).decode('ascii')}
+    if isinstance(value, datetime.datetime):
+        return {'$datetime': value.isoformat()}
+    if isinstance(value, (int, float, bool)):
+        return value
+    return str(value)
+
+
+def _restore(value):
+    """json.loads object_hook reversing _jsonable"""
+    if '$bytes' in value:
+        return base64.b64decode(value['$bytes'])
+    if '$datetime' in value:
+        return datetime.datetime.fromisoformat(value['$datetime'])
+    return value
+
+
+def _first(value):
+    if isinstance(value, list):
+        return value[0] if value else None
+    return value
+
+
+def _select(attributes, requested):
+    """The stored attributes a search for requested would return: '*' (or
+    None) for all user attributes, '+' for operational ones, '1.1' for
+    none. Requested attributes the entry doesn't have are empty lists, as
+    ldap3 returns them"""
+    if requested is None:
+        requested = ['*']
+    wanted = set([a.lower() for a in requested])
+    selected = CaseInsensitiveDict()
+    for name, value in attributes.items():
+        operational = name.lower() in OPERATIONAL_ATTRIBUTES
+        if (name.lower() in wanted or ('*' in wanted and not operational) or
+                ('+' in wanted and operational)):
+            selected[name] = value
+    for name in requested:
+        if name not in ('*', '+', '1.1') and name not in selected:
+            selected[name] = []
+    return selected
+
+
+class Replica(object):
+    """
+    A persistent, incrementally synced copy of users and project groups
+    """
+    def __init__(self, client, path, maxAge=300, pruneInterval=3600,
+                 ous=('collaborations', 'aclgroups')):
+        self.client = client
+        self.path = path
+        self.maxAge = maxAge
+        self.pruneInterval = pruneInterval
+        self.ous = tuple(ous)
+        self.log = logging.getLogger('mgid.ldap.replica')
+        self._lock = threading.RLock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.executescript(SCHEMA)
+        self._stale = False
+        self._indexes = {}
+
+    def __repr__(self):
+        return "<mercldap.Replica {}>".format(self.path)
+
+    def _meta(self, key, default=None):
+        row = self._db.execute('SELECT value FROM meta WHERE key=?', (key,)).fetchone()
+        if row is None:
+            return default
+        return row[0]
+
+    def _setMeta(self, key, value):
+        self._db.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)',
+                         (key, value))
+
+    def _userFilter(self):
+        return '(objectClass=posixAccount)'
+
+    def _groupFilter(self):
+        oufilter = ''.join(['(ou:dn:={})'.format(ou) for ou in self.ous])
+        return ('(&(|{})(|(objectClass=groupOfNames)(objectClass=posixGroup)'
+                '(objectClass=auxPosixGroup)))'.format(oufilter))
+
+    def invalidate(self):
+        """Force a sync before the next read, called after writes"""
+        with self._lock:
+            self._stale = True
+            self._indexes = {}
+
+    def fresh(self):
+        synced = self._meta('synced')
+        if self._stale or synced is None:
+            return False
+        return time.time() - float(synced) < self.maxAge
+
+    def ensureFresh(self):
+        with self._lock:
+            if not self.fresh():
+                self.sync()
+
+    def sync(self, full=False):
+        """
+        Bring the replica up to date. Without a high-water mark (or with
+        full=True) everything is fetched, otherwise only entries modified
+        since the newest modifyTimestamp already held
+        """
+        with self._lock:
+            if self._meta('format') != FORMAT:
+                full = True
+            highwater = None if full else self._meta('highwater')
+            newest = highwater
+            changed = 0
+            for kind, filter1 in ((USER, self._userFilter()), (GROUP, self._groupFilter())):
+                if highwater is not None:
+                    filter1 = '(&{}(modifyTimestamp>={}))'.format(filter1, highwater)
+                for entry in self.client.search(filter1, attributes=['*', 'modifyTimestamp']):
+                    stamp = entry['attributes'].get('modifyTimestamp')
+                    if stamp:
+                        stamp = generalizedTime(stamp)
+                        if newest is None or stamp > newest:
+                            newest = stamp
+                    self._store(kind, entry)
+                    changed += 1
+            now = time.time()
+            lastPrune = self._meta('pruned')
+            if highwater is None:
+                self._setMeta('pruned', str(now))
+            elif lastPrune is None or now - float(lastPrune) >= self.pruneInterval:
+                self._prune()
+                self._setMeta('pruned', str(now))
+            if newest is not None:
+                self._setMeta('highwater', newest)
+            self._setMeta('synced', str(now))
+            self._setMeta('format', FORMAT)
+            self._db.commit()
+            self._stale = False
+            self._indexes = {}
+            self.log.debug("Replica sync from {} stored {} entries".format(highwater, changed))
+            return changed
+
+    def _prune(self):
+        """Drop entries that no longer exist on the server"""
+        live = set()
+        for filter1 in (self._userFilter(), self._groupFilter()):
+            for entry in self.client.search(filter1, attributes=['1.1']):
+                live.add(entry.dn.lower())
+        held = [r[0] for r in self._db.execute('SELECT key FROM entries')]
+        gone = [key for key in held if key not in live]
+        for key in gone:
+            self._db.execute('DELETE FROM entries WHERE key=?', (key,))
+            self._db.execute('DELETE FROM mail WHERE key=?', (key,))
+        if gone:
+            self.log.debug("Replica pruned {} deleted entries".format(len(gone)))
+
+    def _store(self, kind, entry):
+        attributes = {}
+        for name, values in entry['attributes'].items():
+            if name.lower() in PRIVATE_ATTRIBUTES:
+                continue
+            attributes[name] = values
+        dn = entry['dn']
+        key = dn.lower()
+        if kind == USER:
+            name = _first(attributes.get('uid'))
+            ou = None
+        else:
+            name = _first(attributes.get('cn'))
+            ou = None
+            for o in self.ous:
+                if ',ou={},'.format(o).lower() in key:
+                    ou = o
+        self._db.execute('INSERT OR REPLACE INTO entries (key, dn, kind, name, ou, attributes) '
+                         'VALUES (?, ?, ?, ?, ?, ?)',
+                         (key, dn, kind, name, ou,
+                          json.dumps(dict([(n, _jsonable(v)) for n, v in attributes.items()]))))
+        self._db.execute('DELETE FROM mail WHERE key=?', (key,))
+        if kind == USER:
+            mails = attributes.get('mail') or []
+            if not isinstance(mails, list):
+                mails = [mails]
+            for mail in mails:
+                self._db.execute('INSERT INTO mail (mail, key) VALUES (?, ?)',
+                                 (mail.lower(), key))
+
+    def _entries(self, sql, params=(), attributes=None):
+        from mercldap.ldap import Entry
+        with self._lock:
+            rows = self._db.execute(sql, params).fetchall()
+        for dn, stored in rows:
+            yield Entry(dn, _select(json.loads(stored, object_hook=_restore), attributes))
+
+    def _one(self, sql, params, attributes=None):
+        le = list(self._entries(sql, params, attributes))
+        if len(le) > 1:
+            raise Exception("too any entries matched")
+        if len(le) == 0:
+            return None
+        return le[0]
+
+    def searchUser(self, user, attributes=None):
+        return self._one('SELECT dn, attributes FROM entries WHERE kind=? AND name=? COLLATE NOCASE',
+                         (USER, user), attributes)
+
+    def getUserByMail(self, mail, attributes=None):
+        return self._one('SELECT e.dn, e.attributes FROM entries e JOIN mail m ON m.key=e.key '
+                         'WHERE m.mail=?', (mail.lower(),), attributes)
+
+    def getUsers(self, attributes=None):
+        return self._entries('SELECT dn, attributes FROM entries WHERE kind=?', (USER,),
+                             attributes)
+
+    def searchProject(self, projectName, ou='collaborations', attributes=None):
+        return self._one('SELECT dn, attributes FROM entries '
+                         'WHERE kind=? AND name=? COLLATE NOCASE AND ou=?',
+                         (GROUP, projectName, ou), attributes)
+
+    def getProjects(self, ou='collaborations', attributes=None):
+        return self._entries('SELECT dn, attributes FROM entries WHERE kind=? AND ou=?',
+                             (GROUP, ou), attributes)
+
+    def getMembershipIndex(self, ous=('collaborations', 'aclgroups')):
+        """
+        Build a MembershipIndex from the replicated groups, as
+        Client.getMembershipIndex does from the server. The index is kept
+        until the next sync or invalidate
+        """
+        from mercldap.ldap import MembershipIndex
+        ous = tuple(ous)
+        with self._lock:
+            if ous in self._indexes:
+                return self._indexes[ous]
+            uiddns = {}
+            for dn, name in self._db.execute('SELECT dn, name FROM entries WHERE kind=?', (USER,)):
+                uiddns[name] = dn
+            index = MembershipIndex(self.client, ous)
+            for ou in ous:
+                for entry in self.getProjects(ou, ['cn', 'member', 'memberUid']):
+                    attrs = entry['attributes']
+                    members = [m for m in attrs.get('member', []) if m != '']
+                    for muid in attrs.get('memberUid', []):
+                        if muid in uiddns:
+                            members.append(uiddns[muid])
+                    index._addGroup(entry.dn, attrs['cn'][0], members)
+            self._indexes[ous] = index
+            return index
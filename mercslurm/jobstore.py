@@ -0,0 +1,147 @@
+"""Local sqlite store of finished slurm jobs
+
+SlurmClient.update_job_store appends every job that has finished since the
+latest End already held (the high-water mark), so each run only asks sacct
+for the new period. Usage reports are then answered from the store:
+
+    store = JobStore('/var/lib/manageid/jobs.db')
+    slurmClient.update_job_store(store, since='2019-01-01')
+    store.monthly_usage(account='pMERC')
+    store.usage_by_group(for_codes, '2020-01-01', '2020-07-01')
+"""
+import datetime
+import logging
+import sqlite3
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    jobid TEXT PRIMARY KEY,
+    user TEXT,
+    account TEXT,
+    alloc_cpus INTEGER,
+    alloc_gres TEXT,
+    req_gres TEXT,
+    cputime_raw INTEGER,
+    jobname TEXT,
+    submit TEXT,
+    start TEXT,
+    end TEXT,
+    state TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_account ON jobs (account);
+CREATE INDEX IF NOT EXISTS jobs_user ON jobs (user);
+CREATE INDEX IF NOT EXISTS jobs_end ON jobs (end);
+"""
+
+TIME_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+
+def _time(value):
+    if value is None:
+        return None
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        if not isinstance(value, datetime.datetime):
+            value = datetime.datetime(value.year, value.month, value.day)
+        return value.strftime(TIME_FORMAT)
+    return str(value)
+
+
+class JobStore(object):
+    """Finished jobs indexed by account, user and end time"""
+
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.executescript(SCHEMA)
+        self.log = logging.getLogger('mgid.slurm.jobstore')
+
+    def __repr__(self):
+        return "<mercslurm.JobStore {}>".format(self.path)
+
+    def close(self):
+        self.db.close()
+
+    def highwater(self):
+        """The latest End held, as a datetime, or None if the store is empty"""
+        row = self.db.execute('SELECT MAX(end) FROM jobs').fetchone()
+        if row[0] is None:
+            return None
+        return datetime.datetime.strptime(row[0], TIME_FORMAT)
+
+    def append(self, jobs, batch=5000):
+        """Store Job records (see mercslurm.slurm.Job) that have an End time,
+        replacing any earlier copy of the same job. Returns the number
+        stored"""
+        count = 0
+        rows = []
+        sql = ('INSERT OR REPLACE INTO jobs (jobid, user, account, alloc_cpus, '
+               'alloc_gres, req_gres, cputime_raw, jobname, submit, start, end, '
+               'state) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)')
+        for job in jobs:
+            if job.End is None:
+                # Still pending or running, it will be picked up once it ends
+                continue
+            rows.append((job.JobID, job.User, job.Account, job.AllocCPUS,
+                         job.AllocGRES, job.ReqGRES, job.CPUTimeRAW, job.JobName,
+                         _time(job.Submit), _time(job.Start), _time(job.End),
+                         job.State))
+            if len(rows) >= batch:
+                self.db.executemany(sql, rows)
+                count += len(rows)
+                rows = []
+        if rows:
+            self.db.executemany(sql, rows)
+            count += len(rows)
+        self.db.commit()
+        self.log.debug("Stored {} jobs".format(count))
+        return count
+
+    def _where(self, start, end, account=None, user=None):
+        clauses = []
+        params = []
+        if start is not None:
+            clauses.append('end >= ?')
+            params.append(_time(start))
+        if end is not None:
+            clauses.append('end < ?')
+            params.append(_time(end))
+        if account is not None:
+            clauses.append('account = ?')
+            params.append(account)
+        if user is not None:
+            clauses.append('user = ?')
+            params.append(user)
+        if not clauses:
+            return '', params
+        return ' WHERE ' + ' AND '.join(clauses), params
+
+    def usage_by_account(self, start=None, end=None):
+        """CPU seconds per account for jobs ending in [start, end)"""
+        where, params = self._where(start, end)
+        sql = 'SELECT account, SUM(cputime_raw) FROM jobs{} GROUP BY account'.format(where)
+        return dict(self.db.execute(sql, params).fetchall())
+
+    def usage_by_user(self, start=None, end=None, account=None):
+        """CPU seconds per user for jobs ending in [start, end), optionally
+        within one account"""
+        where, params = self._where(start, end, account=account)
+        sql = 'SELECT user, SUM(cputime_raw) FROM jobs{} GROUP BY user'.format(where)
+        return dict(self.db.execute(sql, params).fetchall())
+
+    def monthly_usage(self, start=None, end=None, account=None):
+        """CPU seconds per (YYYY-MM, account) by job end time"""
+        where, params = self._where(start, end, account=account)
+        sql = ('SELECT substr(end, 1, 7), account, SUM(cputime_raw) FROM jobs{} '
+               'GROUP BY substr(end, 1, 7), account'.format(where))
+        return dict([((month, acct), usage) for month, acct, usage
+                     in self.db.execute(sql, params).fetchall()])
+
+    def usage_by_group(self, mapping, start=None, end=None):
+        """Roll account usage up to groups (e.g. FOR codes) using mapping,
+        a dict of account -> group. Unmapped accounts are grouped under
+        None"""
+        result = {}
+        for account, usage in self.usage_by_account(start, end).items():
+            group = mapping.get(account)
+            result[group] = result.get(group, 0) + (usage or 0)
+        return result
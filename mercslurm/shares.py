@@ -0,0 +1,191 @@
+"""Fairshare and usage samples collected from sshare
+
+A ShareCollector takes one `sshare -l -a` sample (every account and user
+association) at most once per interval and keeps it as typed ShareSample
+records indexed by account and user, so quota checks and reports answer
+from memory. Given a path the samples are also appended to an sqlite
+time-series, which lets cron runs within the interval reuse the last
+sample and lets usage be charted over time:
+
+    collector = slurmClient.share_collector()
+    collector.account('pMERC').NormUsage
+    collector.history('pMERC', start='2020-01-01')
+"""
+import logging
+import sqlite3
+import time
+
+from collections import namedtuple
+
+SHARE_FIELDS = ['Account', 'User', 'NormShares', 'NormUsage', 'LevelFS',
+                'RawUsage', 'FairShare']
+
+# One association at one sample time. User is '' for the account itself,
+# the numbers are floats (None where sshare leaves the column empty)
+ShareSample = namedtuple('ShareSample', ['Time'] + SHARE_FIELDS)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS samples (
+    time INTEGER NOT NULL,
+    account TEXT NOT NULL,
+    user TEXT NOT NULL,
+    norm_shares REAL,
+    norm_usage REAL,
+    level_fs REAL,
+    raw_usage REAL,
+    fairshare REAL
+);
+CREATE INDEX IF NOT EXISTS samples_account ON samples (account, time);
+CREATE INDEX IF NOT EXISTS samples_time ON samples (time);
+"""
+
+
+def _float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def make_sample(when, values):
+    """Build a ShareSample from the SHARE_FIELDS values of one sshare line"""
+    values = list(values[:len(SHARE_FIELDS)])
+    if len(values) < len(SHARE_FIELDS):
+        values = values + [''] * (len(SHARE_FIELDS) - len(values))
+    account, user = values[0].strip(), values[1].strip()
+    return ShareSample(int(when), account, user,
+                       *[_float(v) for v in values[2:]])
+
+
+def _time(value):
+    if value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return int(value)
+    from mercslurm.slurm import to_datetime
+    return int(time.mktime(to_datetime(value).timetuple()))
+
+
+class ShareCollector(object):
+    """The latest sshare sample in memory, optionally with an sqlite history"""
+
+    def __init__(self, slurm_client, path=None, interval=300):
+        self.slurm = slurm_client
+        self.path = path
+        self.interval = interval
+        self.db = None
+        if path is not None:
+            self.db = sqlite3.connect(path)
+            self.db.executescript(SCHEMA)
+        self.sampled = None
+        self._accounts = {}
+        self._users = {}
+        self.log = logging.getLogger('mgid.slurm.shares')
+
+    def __repr__(self):
+        return "<mercslurm.ShareCollector {}>".format(self.path or 'memory')
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+
+    def _index(self, samples):
+        self._accounts = {}
+        self._users = {}
+        for sample in samples:
+            if sample.User == '':
+                self._accounts[sample.Account] = sample
+            else:
+                self._users.setdefault(sample.User, {})[sample.Account] = sample
+
+    def _load(self):
+        """Reuse the newest stored sample if it is within the interval"""
+        if self.db is None:
+            return False
+        row = self.db.execute('SELECT MAX(time) FROM samples').fetchone()
+        if row[0] is None or time.time() - row[0] >= self.interval:
+            return False
+        self.sampled = row[0]
+        self._index([ShareSample(*r) for r in self.db.execute(
+            'SELECT time, account, user, norm_shares, norm_usage, level_fs, '
+            'raw_usage, fairshare FROM samples WHERE time=?', (row[0],))])
+        self.log.debug("Reusing share sample from {}".format(row[0]))
+        return True
+
+    def sample(self, force=False):
+        """Take a sample unless the last one is newer than interval seconds.
+        Returns the number of associations sampled"""
+        if not force:
+            if self.sampled is not None and time.time() - self.sampled < self.interval:
+                return 0
+            if self.sampled is None and self._load():
+                return 0
+        now = int(time.time())
+        samples = [make_sample(now, values) for values in self.slurm.share_rows()]
+        self._index(samples)
+        self.sampled = now
+        if self.db is not None:
+            self.db.executemany('INSERT INTO samples (time, account, user, norm_shares, '
+                                'norm_usage, level_fs, raw_usage, fairshare) '
+                                'VALUES (?, ?, ?, ?, ?, ?, ?, ?)', samples)
+            self.db.commit()
+        self.log.debug("Sampled {} share associations".format(len(samples)))
+        return len(samples)
+
+    def _fresh(self):
+        self.sample()
+
+    def account(self, account):
+        """The latest ShareSample for account, None if sshare doesn't list it"""
+        self._fresh()
+        return self._accounts.get(account)
+
+    def accounts(self):
+        """{account: ShareSample} for every account"""
+        self._fresh()
+        return dict(self._accounts)
+
+    def user(self, user):
+        """{account: ShareSample} for every association of user"""
+        self._fresh()
+        return dict(self._users.get(user, {}))
+
+    def users(self):
+        """{user: {account: ShareSample}}"""
+        self._fresh()
+        return dict([(u, dict(a)) for u, a in self._users.items()])
+
+    def history(self, account, user='', start=None, end=None):
+        """Stored ShareSamples of one association in [start, end), oldest
+        first. Needs a path"""
+        if self.db is None:
+            raise ValueError("ShareCollector has no store, history needs a path")
+        clauses = ['account = ?', 'user = ?']
+        params = [account, user]
+        if start is not None:
+            clauses.append('time >= ?')
+            params.append(_time(start))
+        if end is not None:
+            clauses.append('time < ?')
+            params.append(_time(end))
+        sql = ('SELECT time, account, user, norm_shares, norm_usage, level_fs, '
+               'raw_usage, fairshare FROM samples WHERE {} ORDER BY time'.format(
+                   ' AND '.join(clauses)))
+        return [ShareSample(*r) for r in self.db.execute(sql, params)]
+
+    def prune(self, before):
+        """Drop stored samples older than before"""
+        if self.db is None:
+            return 0
+        cursor = self.db.execute('DELETE FROM samples WHERE time < ?', (_time(before),))
+        self.db.commit()
+        return cursor.rowcount
+
+    def run(self, count=None):
+        """Sample every interval seconds, count times (forever if None)"""
+        n = 0
+        while count is None or n < count:
+            self.sample(force=True)
+            n += 1
+            if count is None or n < count:
+                time.sleep(self.interval)
@@ -4,18 +4,127 @@ import logging
 
 l = logging.getLogger('mgid.slurm')
 
+from collections import namedtuple
+
+JOB_FIELDS = ['JobID', 'User', 'Account', 'AllocCPUS', 'AllocGRES', 'ReqGRES',
+              'CPUTimeRAW', 'JobName', 'Submit', 'Start', 'End', 'State']
+
+# A typed sacct record: AllocCPUS and CPUTimeRAW are ints, Submit, Start and
+# End are datetimes (None when slurm reports Unknown/None)
+Job = namedtuple('Job', JOB_FIELDS)
+
+
+def parse_slurm_time(value):
+    """Parse a slurm timestamp, returning None for Unknown/None/empty"""
+    import datetime
+    if value in ('', 'Unknown', 'None', 'N/A'):
+        return None
+    try:
+        return datetime.datetime.strptime(value, '%Y-%m-%dT%H:%M:%S')
+    except ValueError:
+        return None
+
+
+def to_datetime(value):
+    """Accept a datetime, date or slurm style time string"""
+    import datetime
+    if isinstance(value, datetime.datetime):
+        return value
+    if isinstance(value, datetime.date):
+        return datetime.datetime(value.year, value.month, value.day)
+    for fmt in ('%Y-%m-%dT%H:%M:%S', '%Y-%m-%dT%H:%M', '%Y-%m-%d'):
+        try:
+            return datetime.datetime.strptime(str(value), fmt)
+        except ValueError:
+            continue
+    raise ValueError("Unrecognised time {}".format(value))
+
+
+def _int(value):
+    try:
+        return int(value)
+    except ValueError:
+        return None
+
+
+def make_job(values):
+    """Build a Job from one line of sacct output split on |"""
+    values = values[:len(JOB_FIELDS)]
+    if len(values) < len(JOB_FIELDS):
+        values = values + [''] * (len(JOB_FIELDS) - len(values))
+    (jobid, user, account, alloccpus, allocgres, reqgres, cputimeraw, jobname,
+     submit, start, end, state) = values
+    return Job(jobid, user, account, _int(alloccpus), allocgres, reqgres,
+               _int(cputimeraw), jobname, parse_slurm_time(submit),
+               parse_slurm_time(start), parse_slurm_time(end), state)
+
+
+def get_slurm_client(backend='cli', rest=None, **kwargs):
+    """Create the slurm client selected by slurmconfig.yml: the command line
+    tools (backend: cli, the default) or slurmrestd (backend: rest, with
+    the connection details under rest:)"""
+    if backend == 'rest':
+        from mercslurm.slurmrest import SlurmRestClient
+        return SlurmRestClient(rest=rest, **kwargs)
+    return SlurmClient(**kwargs)
+
 
 class SlurmClient(object):
     """Implements all methods for interacting with slurm, creating
     accounts, adding and removing users from those accounts"""
-    def __init__(self, slurm_base):
+    def __init__(self, slurm_base, share_store=None, share_interval=300):
         import os
         self.slurm_base = slurm_base
+        self.share_store = share_store
+        self.share_interval = share_interval
         self.sacctmgr = os.path.join(self.slurm_base, 'sacctmgr')
         self.sacct = os.path.join(self.slurm_base, 'sacct')
         self.sshare = os.path.join(self.slurm_base, 'sshare')
         self.scontrol = os.path.join(self.slurm_base, 'scontrol')
         self.log = logging.getLogger('mgid.slurm')
+        self._snapshot = None
+        self._groups = None
+        self._collector = None
+
+    def association_snapshot(self, refresh=False):
+        """Return the AssociationSnapshot used to answer association queries,
+        loading it with a single sacctmgr call the first time (or when
+        refresh is set)"""
+        if self._snapshot is None or refresh:
+            cmd = [self.sacctmgr, 'show', 'associations',
+                   'format=cluster,account,user,parentname', '--parsable2',
+                   '--noheader']
+            sacctmgr = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                                        stderr=subprocess.PIPE, query=True)
+            (stdout, _) = sacctmgr.communicate()
+            self._snapshot = AssociationSnapshot(self, stdout.decode('utf-8'))
+            self.log.debug("Loaded {} slurm accounts".format(len(self._snapshot.accounts)))
+        return self._snapshot
+
+    def get_all_default_accounts(self):
+        """Every user's default account from one sacctmgr call"""
+        cmd = [self.sacctmgr, 'show', 'user', 'Format=User,DefaultAccount',
+               '--noheader', '--parsable2']
+        sacctmgr = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                                    stderr=subprocess.PIPE, query=True)
+        (stdout, _) = sacctmgr.communicate()
+        defaults = {}
+        for line in stdout.decode().splitlines():
+            fields = line.split('|')
+            if len(fields) >= 2 and fields[0] != '':
+                defaults[fields[0]] = fields[1]
+        return defaults
+
+    def invalidate_snapshot(self):
+        """Forget the association snapshot, the next query reloads it"""
+        self._snapshot = None
+
+    def _patch_snapshot(self):
+        """The snapshot to patch after a write, None in a dry run (nothing
+        changed) or if no snapshot has been loaded"""
+        if subprocess.debug:
+            return None
+        return self._snapshot
 
     def check_slurm_status(self):
         cmd = [self.scontrol, 'ping']
@@ -51,47 +160,143 @@ class SlurmClient(object):
         return code
 
     def all_jobs(self,starttime,endtime):
-        import subprocess
-        fields = ['JobID','User','Account','AllocCPUS','AllocGRES','ReqGRES','CPUTimeRAW','JobName','Submit','Start','End','State']
+        fields = JOB_FIELDS
         result = []
-        cmd  = [self.sacct,'-X','-S',"{}".format(starttime),'-E',"{}".format(endtime),'-a','--format={}'.format(','.join(fields)),'-n','-p']
-        p = subprocess.Popen(cmd,stdout=subprocess.PIPE,stderr=subprocess.PIPE)
-        (stdout,stderr) = p.communicate()
-        if len(stderr) > 0:
-            print(stderr)
-        for l in stdout.decode().splitlines():
-            values = l.split('|')
+        for values in self._sacct_lines(starttime, endtime, fields):
             job = dict(zip(fields,values))
             result.append(job)
         return result
 
-    def check_account_status(self, account, parent=None):
-        """Check that a slurm account exists, ignoring the parent account"""
-        cmd = [self.sacctmgr, 'show', 'account', account, 'withassoc',
-               'format=parentname', '--parsable', '--noheader']
-        sacctmgr = subprocess.Popen(cmd, query=True, stdout=subprocess.PIPE,
-                                    stderr=subprocess.PIPE)
-        (stdout, _) = sacctmgr.communicate()
-        if len(stdout.splitlines()) == 0:
+    def _sacct_lines(self, starttime, endtime, fields=JOB_FIELDS):
+        """Run sacct for the period and yield each line split on |, parsing
+        stdout as it arrives rather than buffering the whole output"""
+        import tempfile
+        cmd  = [self.sacct,'-X','-S',"{}".format(starttime),'-E',"{}".format(endtime),'-a','--format={}'.format(','.join(fields)),'-n','-p']
+        with tempfile.TemporaryFile() as errfile:
+            p = subprocess.Popen(cmd,stdout=subprocess.PIPE,stderr=errfile,query=True)
+            try:
+                for line in p.stdout:
+                    p.stdout_bytes += len(line)
+                    yield line.decode('utf-8', 'replace').rstrip('\n').split('|')
+            finally:
+                p.stdout.close()
+                p.wait()
+                errfile.seek(0)
+                stderr = errfile.read()
+                if len(stderr) > 0:
+                    print(stderr)
+
+    def iter_jobs(self, starttime, endtime, window=None, workers=1,
+                  queue_size=10000):
+        """Yield a Job for every job in the period, with bounded memory.
+
+        With window (a timedelta) the period is split into windows that are
+        queried separately, up to `workers` at a time. sacct reports a job in
+        every window it was pending or running in, so each job is only kept
+        in the window containing max(Start, or Submit if it hasn't started,
+        starttime). With workers > 1 jobs from different windows are
+        interleaved."""
+        if window is None:
+            for values in self._sacct_lines(starttime, endtime):
+                yield make_job(values)
+            return
+
+        start = to_datetime(starttime)
+        end = to_datetime(endtime)
+        windows = []
+        ws = start
+        while ws < end:
+            we = min(ws + window, end)
+            windows.append((ws, we))
+            ws = we
+
+        def window_jobs(ws, we):
+            fmt = '%Y-%m-%dT%H:%M:%S'
+            for values in self._sacct_lines(ws.strftime(fmt), we.strftime(fmt)):
+                job = make_job(values)
+                began = job.Start or job.Submit
+                effective = start if began is None or began < start else began
+                if ws <= effective < we or (we == end and effective >= end):
+                    yield job
+
+        if workers <= 1:
+            for ws, we in windows:
+                yield from window_jobs(ws, we)
+            return
+
+        import queue
+        import threading
+        from concurrent.futures import ThreadPoolExecutor
+        results = queue.Queue(maxsize=queue_size)
+        stop = threading.Event()
+        done = object()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    results.put(item, timeout=1)
+                    return True
+                except queue.Full:
+                    continue
             return False
+
+        def run(ws, we):
+            try:
+                for job in window_jobs(ws, we):
+                    if not put(job):
+                        return
+            except Exception as e:
+                put(e)
+            put(done)
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for ws, we in windows:
+                pool.submit(run, ws, we)
+            try:
+                remaining = len(windows)
+                while remaining > 0:
+                    item = results.get()
+                    if item is done:
+                        remaining -= 1
+                    elif isinstance(item, Exception):
+                        raise item
+                    else:
+                        yield item
+            finally:
+                stop.set()
+
+    def update_job_store(self, store, since=None, until=None, window=None,
+                         workers=1):
+        """Append jobs that finished after the store's high-water mark (or
+        `since` for an empty store) up to `until` (default now) to a
+        mercslurm.jobstore.JobStore. Returns the number of jobs stored"""
+        import datetime
+        start = store.highwater()
+        if start is None:
+            if since is None:
+                raise ValueError("The job store is empty, since is required")
+            start = to_datetime(since)
+        if until is None:
+            until = datetime.datetime.now().replace(microsecond=0)
+        self.log.debug("Updating job store {} from {} to {}".format(store, start, until))
+        if window is None:
+            fmt = '%Y-%m-%dT%H:%M:%S'
+            jobs = self.iter_jobs(start.strftime(fmt), to_datetime(until).strftime(fmt))
         else:
-            return True
+            jobs = self.iter_jobs(start, until, window=window, workers=workers)
+        return store.append(jobs)
+
+    def check_account_status(self, account, parent=None):
+        """Check that a slurm account exists, ignoring the parent account"""
+        return account in self.association_snapshot().accounts
 
     def accountexists(self, account, parent=None):
-        """Create the account for the project assigning it to the correct
-        parent"""
-        
-        cmd = [self.sacctmgr, 'show', 'account', account, 'withassoc',
-               'format=parentname', '--parsable', '--noheader']
-        sacctmgr = subprocess.Popen(cmd, query=True, stdout=subprocess.PIPE,
-                                    stderr=subprocess.PIPE)
-        (stdout, _) = sacctmgr.communicate()
-        for assoc in stdout.splitlines():
-            fields = assoc.split(b'|')
-            if fields[0].decode() == parent:
-                self.log.debug("Parent account {} for {} is correct".format(parent,
-                                                                     account))
-                return True
+        """Check the account for the project exists and is assigned to the
+        correct parent"""
+        if self.association_snapshot().parents.get(account) == parent:
+            self.log.debug("Parent account {} for {} is correct".format(parent,
+                                                                 account))
+            return True
 
         self.log.debug("Parent account for {} is not correct".format(account))
         return False
@@ -106,27 +311,19 @@ class SlurmClient(object):
         cmd = [self.sacctmgr, '-i', 'add', 'account', account,
                'parent={}'.format(parent),
                'Organization=Monash', 'set', 'fairshare=1']
-        subprocess.call(cmd)
+        subprocess.run(cmd, backend='slurmdbd')
         self.log.info("Assigning {} as parent account of {}".format(parent,
                                                              account))
+        snapshot = self._patch_snapshot()
+        if snapshot is not None:
+            snapshot.add_account(account, parent)
 
     def getusers(self, account):
         """Get the list of users currently able to use the account"""
 
         self.log.debug("Retrieving list of users under {} account".format(account))
 
-        user_set = set()
-        cmd = [self.sacctmgr, 'show', 'associations', '--parsable2',
-               '--noheader',
-               'account={}'.format(account), 'format=user']
-        sacctmgr = subprocess.Popen(cmd, stdout=subprocess.PIPE,
-                                    stderr=subprocess.PIPE, query=True)
-
-        (stdout, _) = sacctmgr.communicate()
-        for user in stdout.splitlines():
-            user = user.decode('utf-8')
-            if user is not None and user is not "":
-                user_set.add(user)
+        user_set = set(self.association_snapshot().users.get(account, set()))
 
         self.log.debug("List of users under {} account: {}".format(account,
                                                             user_set))
@@ -139,66 +336,81 @@ class SlurmClient(object):
 
         from collections import defaultdict
         associations = defaultdict(list)
+        for account, users in self.association_snapshot().clusters.get(cluster, {}).items():
+            associations[account].extend(users)
+        return associations
 
-        cmd = [self.sacctmgr, 'show', 'associations', 'where',
-               'cluster={}'.format(cluster), 'format=account,user',
+    def share_rows(self):
+        """One `sshare -l -a` listing as lists of
+        mercslurm.shares.SHARE_FIELDS values"""
+        from mercslurm.shares import SHARE_FIELDS
+        cmd = [self.sshare, '-l', '-a', '--format={}'.format(','.join(SHARE_FIELDS)),
                '--noheader', '--parsable2']
-        sacctmgr = subprocess.Popen(cmd, stdout=subprocess.PIPE,
-                                    stderr=subprocess.PIPE, query=True)
-        (stdout, _) = sacctmgr.communicate()
-
-        # Parse associations into a dictionary
-        for res in stdout.splitlines():
-            res = res.decode('utf-8').split("|")
-            if res[1] is not '':
-                account, user = res
-                associations[account].append(user)
-            else:
-                account = res[0]
-                associations[account].append('')
-        return associations
+        sshare = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                                  stderr=subprocess.PIPE, query=True)
+        (stdout, _) = sshare.communicate()
+        for line in stdout.decode().splitlines():
+            fields = line.split('|')
+            if len(fields) >= len(SHARE_FIELDS):
+                yield fields
+
+    def share_collector(self):
+        """Return the ShareCollector answering share and usage queries,
+        sampling sshare at most every share_interval seconds (and keeping
+        the samples in share_store if that is set in slurmconfig.yml)"""
+        if self._collector is None:
+            from mercslurm.shares import ShareCollector
+            self._collector = ShareCollector(self, self.share_store, self.share_interval)
+        return self._collector
+
+    def get_account_share_quota_usage(self, account):
+        """(NormShares, NormUsage) of account, (None, None) if unknown"""
+        sample = self.share_collector().account(account)
+        if sample is None:
+            return (None, None)
+        return (sample.NormShares, sample.NormUsage)
+
+    def get_all_share_samples(self):
+        """{account: ShareSample} for every account"""
+        return self.share_collector().accounts()
+
+    def get_user_share_samples(self, user):
+        """{account: ShareSample} for each of user's associations"""
+        return self.share_collector().user(user)
 
-    def get_account_share_quota_usage(self,account):
-        cmd = [self.sshare, '-l', '-A',account, '--format=Account,NormShares,NormUsage', '-P']
-        import subprocess
-        p = subprocess.Popen(cmd,stdout=subprocess.PIPE,stderr=subprocess.PIPE)
-        stdout,stderr = p.communicate()
-        lines = stdout.splitlines()
-        if len(lines) == 1:
-            return(None,None)
-        values = lines[-1].split(b'|')
-        try:
-            rv = (float(values[1]),float(values[2]))
-        except ValueError:
-            rv = (None,None)
+    @staticmethod
+    def _share_bytes(samples, fields):
+        """ShareSamples in the form get_all_shares always returned: the
+        fields of each account as bytes, as `sshare -P` prints them"""
+        def render(field, value):
+            if value is None:
+                return b''
+            if field == 'RawUsage':
+                return str(int(value)).encode()
+            return '{:.6f}'.format(value).encode()
+        rv = {}
+        for account, sample in samples.items():
+            d = dict([(f, render(f, getattr(sample, f))) for f in fields
+                      if f != 'Account'])
+            d['Account'] = account.encode()
+            rv[d['Account']] = d
         return rv
 
     def get_all_shares(self):
-        fields = ['Account','NormShares','NormUsage','LevelFS','RawUsage']
-        cmd = [self.sshare, '-l', '--format={}'.format(','.join(fields)), '-P']
-        import subprocess
-        rv = {}
-        p = subprocess.Popen(cmd,stdout=subprocess.PIPE,stderr=subprocess.PIPE)
-        stdout,stderr = p.communicate()
-        for l in stdout.splitlines():
-            values = l.split(b'|')
-            d = dict(zip(fields,values))
-            rv.update({d['Account']:d})
-        return rv
+        """{account: {field: value}} of Account, NormShares, NormUsage,
+        LevelFS and RawUsage for every account, keys and values as bytes.
+        See get_all_share_samples for typed values"""
+        return self._share_bytes(self.get_all_share_samples(),
+                                 ['Account', 'NormShares', 'NormUsage',
+                                  'LevelFS', 'RawUsage'])
 
     def get_shares(self, user):
-        """Get the list of accounts and norm shares and usage"""
-        fields = ['Account','NormShares','NormUsage']
-        cmd = [self.sshare, '-l', '--format={}'.format(','.join(fields)), '-P']
-        import subprocess
-        rv = {}
-        p = subprocess.Popen(cmd,stdout=subprocess.PIPE,stderr=subprocess.PIPE)
-        stdout,stderr = p.communicate()
-        for l in stdout.splitlines():
-            values = l.split(b'|')
-            d = dict(zip(fields,values))
-            rv.update({d['Account']:d})
-        return rv
+        """Get the list of accounts and norm shares and usage, as
+        get_all_shares with only Account, NormShares and NormUsage (for
+        every account, whatever user is). See get_user_share_samples for a
+        user's associations"""
+        return self._share_bytes(self.get_all_share_samples(),
+                                 ['Account', 'NormShares', 'NormUsage'])
 
     def add_user(self, account, user, cluster=None):
         """Add a user to a slurm account, optionally on a given cluster"""
@@ -210,7 +422,10 @@ class SlurmClient(object):
         else:
             cmd = [self.sacctmgr, '-i', 'add', 'user', 'name={}'.format(user),
                    'account={}'.format(account)]
-        subprocess.call(cmd)
+        subprocess.run(cmd, backend='slurmdbd')
+        snapshot = self._patch_snapshot()
+        if snapshot is not None:
+            snapshot.add_user(account, user, cluster)
         import time
         self.log.info("Sleeping for 5 seconds to reduce load on slurmdb")
         time.sleep(5)
@@ -226,73 +441,95 @@ class SlurmClient(object):
         else:
             cmd = [self.sacctmgr, '-i', 'delete', 'user',
                    'name={}'.format(user), 'account={}'.format(account)]
-        subprocess.call(cmd)
+        subprocess.run(cmd, backend='slurmdbd')
+        snapshot = self._patch_snapshot()
+        if snapshot is not None:
+            snapshot.remove_user(account, user, cluster)
         import time
         self.log.info("Sleeping for 5 seconds to reduce load on slurmdb")
         time.sleep(5)
 
-    @staticmethod
-    def get_desired_users(account):
-        """Query the OS via getent to determine which users should be added to
-        which accounts (each slurm account also has a linux group)"""
-        l.debug("Getting list of desired users for account {}".format(account))
-
-        cmd = ['getent', 'group', account]
-        getent = subprocess.Popen(cmd, stdout=subprocess.PIPE,
-                                  stderr=subprocess.PIPE, query=True)
-        (stdout, _) = getent.communicate()
-
-        users = stdout.decode('utf-8').strip().split(':')[3]
-        user_set = set()
-        for user in users.split(','):
-            user_set.add(user)
-
-        l.debug("List of desired users for account {}: {}".format(account,
-                                                                  user_set))
+    def change_associations(self, verb, account, users, cluster=None):
+        """Add ('add') or remove ('delete') several users to/from account in
+        one sacctmgr call. Returns the exit code, None in a dry run"""
+        cmd = [self.sacctmgr, '-i', verb, 'user',
+               'name={}'.format(','.join(users)),
+               'account={}'.format(account)]
+        if cluster is not None:
+            cmd.append('cluster={}'.format(cluster))
+        result = subprocess.run(cmd, backend='slurmdbd')
+        if result.stderr:
+            self.log.error("sacctmgr {} for {}: {}".format(verb, account,
+                                                          result.stderr.decode().strip()))
+        return result.returncode
+
+    def association_batch(self, cluster=None, **kwargs):
+        """Return an AssociationBatch that writes through this client"""
+        return AssociationBatch(self, cluster, **kwargs)
+
+    def group_index(self, refresh=False):
+        """Return the GroupIndex used by get_desired_users, enumerating the
+        linux groups once the first time (or when refresh is set)"""
+        if self._groups is None or refresh:
+            self._groups = GroupIndex.from_nss()
+            self.log.debug("Enumerated {} linux groups".format(len(self._groups)))
+        return self._groups
+
+    def use_group_index(self, index):
+        """Answer get_desired_users from index, e.g. GroupIndex.from_ldap"""
+        self._groups = index
+
+    def get_desired_users(self, account):
+        """Determine which users should be in the account from the members
+        of its linux group (each slurm account also has a linux group).
+        Returns None if there is no such group"""
+        self.log.debug("Getting list of desired users for account {}".format(account))
+
+        user_set = self.group_index().members(account)
+
+        self.log.debug("List of desired users for account {}: {}".format(account,
+                                                                         user_set))
         return user_set
 
     def setusers(self, account, cluster=None):
         """Calculates the changes needed for the account and makes them"""
-        current_slurm_users = self.getusers(account)
-        if account in self.get_mx_caps():
-            desired_slurm_users = set()
-        else:
-            desired_slurm_users = self.get_desired_users(account)
-        
-        for user in current_slurm_users - desired_slurm_users:
-            self.remove_user(account, user, cluster)
-        for user in desired_slurm_users - current_slurm_users:
-            self.add_user(account, user, cluster)
+        return self.setallusers([account], cluster)
+
+    def setallusers(self, accounts, cluster=None, **kwargs):
+        """Calculates the changes needed for all of accounts and makes them
+        in one AssociationBatch. accounts must be listed, as each is made to
+        match the linux group of the same name and parent accounts such as
+        root have no such group. Accounts without a linux group are left
+        alone. Returns the batch results"""
+        snapshot = self.association_snapshot()
+        mx_caps = set(self.get_mx_caps())
+        current = set()
+        desired = set()
+        for account in accounts:
+            if account in mx_caps:
+                wanted = set()
+            else:
+                wanted = self.get_desired_users(account)
+                if wanted is None:
+                    self.log.warning("No linux group for account {}, not changing it".format(account))
+                    continue
+            current.update([(account, user) for user in snapshot.users.get(account, ())])
+            desired.update([(account, user) for user in wanted])
+
+        batch = self.association_batch(cluster, **kwargs)
+        for account, user in current - desired:
+            batch.remove(account, user)
+        for account, user in desired - current:
+            batch.add(account, user)
+        self.log.debug("{} association changes for {} accounts".format(len(batch),
+                                                                        len(accounts)))
+        return batch.flush()
 
     def get_project_parent(self,account):
-        import mysubprocess as subprocess
-        cmd = [self.sacctmgr, 'show', 'Account', account , 'withassoc', '-p']
-        p = subprocess.Popen(cmd,stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        (stdout,stderr) = p.communicate()
-        lines = stdout.decode().splitlines()
-        parentcol = lines[0].split('|').index('Par Name')
-        for l in lines[1:]:
-            parent = l.split('|')[parentcol] 
-            if parent is not None:
-                return parent
-        return None
+        return self.association_snapshot().parents.get(account)
 
     def get_all_parent_projects(self):
-        import mysubprocess as subprocess
-        cmd = [self.sacctmgr, 'show', 'assoc', 'format=parentname,account', '-P',
-               '-n']
-        p = subprocess.Popen(cmd, stdout=subprocess.PIPE,
-                             stderr=subprocess.PIPE, query=True)
-        (stdout, stderr) = p.communicate()
-        lines = stdout.decode('utf-8').splitlines()
-
-        parent_dict = {}
-        for line in lines:
-            parent, account = line.split("|")
-            # A nice hack to remove duplicates from the list
-            if parent != '':
-                parent_dict[account] = parent
-        return parent_dict
+        return dict(self.association_snapshot().parents)
 
     def get_mx_caps(self):
         return ['ny79', 'sf32', 'va91', 'od25', 'qc45', 'be32']
@@ -340,27 +577,90 @@ class SlurmClient(object):
             self.log.debug("Account not found for %s", user)
 
     def get_current_default_account(self, user):
-        cmd = [self.sacctmgr, 'show', 'user', 'Format=User,DefaultAccount',
-               '--noheader', '--parsable2', 'where', 'user={}'.format(user)]
-        getent = subprocess.Popen(cmd, stdout=subprocess.PIPE,
-                                  stderr=subprocess.PIPE, query=True)
-        (stdout, _) = getent.communicate()
-
-        try:
-            fields = stdout.decode().split('|')
-            current_default_account = fields[1]
-            return current_default_account
-        except IndexError:
+        current_default_account = self.association_snapshot().default_account(user)
+        if current_default_account is None:
             self.log.debug("Default account not found for %s", user)
+        return current_default_account
 
     def set_default_account(self, user, account):
         """Set the default account for a user"""
         self.log.info("Setting default account {} for user {}".format(account,
                                                                      user))
+        if self.set_default_accounts(account, [user]) not in (0, None):
+            return
+        snapshot = self._patch_snapshot()
+        if snapshot is not None and snapshot.defaults is not None:
+            snapshot.defaults[user] = account
+
+    def get_all_user_account_shares(self):
+        """Fairshare of every user association from the share sample,
+        as {user: {account: fairshare}}"""
+        shares = {}
+        for user, accounts in self.share_collector().users().items():
+            for account, sample in accounts.items():
+                if account == 'default' or sample.FairShare is None:
+                    continue
+                shares.setdefault(user, {})[account] = sample.FairShare
+        return shares
+
+    def reconcile_default_accounts(self, users=None, chunk=50):
+        """Set every user's default account to their highest fairshare
+        account, skipping MX CAP accounts, using one sshare and one sacctmgr
+        call to gather state and one modify per new default account.
+        Optionally limited to `users`. Returns {user: (current, desired)}
+        for the users that were changed (or would be, in a dry run); a
+        chunk of users whose modify failed is logged and left out"""
+        shares = self.get_all_user_account_shares()
+        snapshot = self.association_snapshot()
+        mx_caps = self.get_mx_caps()
+        if users is not None:
+            shares = dict([(u, shares[u]) for u in users if u in shares])
+
+        changes = {}
+        for user, fair_share in shares.items():
+            candidates = [a for a in fair_share if a not in mx_caps]
+            if len(candidates) == 0:
+                self.log.debug("No default account candidate for %s", user)
+                continue
+            desired = max(sorted(candidates), key=lambda a: fair_share[a])
+            current = snapshot.default_account(user)
+            if current != desired:
+                changes[user] = (current, desired)
+        self.log.info("{} of {} users need a new default account".format(
+            len(changes), len(shares)))
+
+        by_account = {}
+        for user, (current, desired) in changes.items():
+            by_account.setdefault(desired, []).append(user)
+        for account in sorted(by_account):
+            names = sorted(by_account[account])
+            for i in range(0, len(names), chunk):
+                self.log.info("Setting default account {} for users {}".format(
+                    account, ", ".join(names[i:i + chunk])))
+                status = self.set_default_accounts(account, names[i:i + chunk])
+                if status not in (0, None):
+                    self.log.error("Failed to set default account {} for users {}".format(
+                        account, ", ".join(names[i:i + chunk])))
+                    for user in names[i:i + chunk]:
+                        del changes[user]
+                    continue
+                patch = self._patch_snapshot()
+                if patch is not None and patch.defaults is not None:
+                    for user in names[i:i + chunk]:
+                        patch.defaults[user] = account
+        return changes
+
+    def set_default_accounts(self, account, users):
+        """Set the same default account for several users in one call.
+        Returns the exit code, None in a dry run"""
         cmd = [self.sacctmgr, '-i', 'modify', 'user', 'where',
-               'name={}'.format(user), 'set',
+               'name={}'.format(','.join(users)), 'set',
                'DefaultAccount={}'.format(account)]
-        subprocess.call(cmd)
+        result = subprocess.run(cmd, backend='slurmdbd')
+        if result.stderr:
+            self.log.error("sacctmgr modify for {}: {}".format(account,
+                                                              result.stderr.decode().strip()))
+        return result.returncode
 
     def set_default_account_handler(self, user):
         current_default_account = self.get_current_default_account(user).strip()
@@ -380,3 +680,224 @@ class SlurmClient(object):
             self.log.info("Default account is correct for {} - "
                    "default account is {}".format(user,
                                                   current_default_account))
+
+
+class AssociationSnapshot(object):
+    """All slurm associations, parsed from one
+    `sacctmgr show associations format=cluster,account,user,parentname`
+    into indexes:
+
+    accounts      every account with an association, root included
+    parents       account -> parent account
+    users         account -> set of users
+    user_accounts user -> set of accounts
+    clusters      cluster -> account -> list of users ('' for the account
+                  association itself, as get_cluster_associations returns)
+
+    Default accounts are not part of the associations listing, they are
+    loaded with one `sacctmgr show user` the first time one is asked for.
+    """
+    def __init__(self, slurm_client, text=''):
+        from collections import defaultdict
+        self.slurm = slurm_client
+        self.accounts = set()
+        self.parents = {}
+        self.users = defaultdict(set)
+        self.user_accounts = defaultdict(set)
+        self.clusters = defaultdict(lambda: defaultdict(list))
+        self.defaults = None
+        for line in text.splitlines():
+            fields = line.split('|')
+            if len(fields) < 4:
+                continue
+            self.add_row(*fields[:4])
+
+    def add_row(self, cluster, account, user, parent):
+        """Index one association, user is '' for an account association"""
+        self.accounts.add(account)
+        self.clusters[cluster][account].append(user)
+        if user == '':
+            if parent != '':
+                self.parents[account] = parent
+        else:
+            self.users[account].add(user)
+            self.user_accounts[user].add(account)
+
+    def default_account(self, user):
+        if self.defaults is None:
+            self.load_defaults()
+        return self.defaults.get(user)
+
+    def load_defaults(self):
+        self.defaults = self.slurm.get_all_default_accounts()
+
+    def _clusters_for(self, account, cluster):
+        if cluster is not None:
+            return [cluster]
+        return [c for c in self.clusters if account in self.clusters[c]]
+
+    def add_account(self, account, parent):
+        self.accounts.add(account)
+        self.parents[account] = parent
+        for cluster in self.clusters:
+            if '' not in self.clusters[cluster][account]:
+                self.clusters[cluster][account].append('')
+
+    def add_user(self, account, user, cluster=None):
+        self.users[account].add(user)
+        self.user_accounts[user].add(account)
+        for c in self._clusters_for(account, cluster):
+            if user not in self.clusters[c][account]:
+                self.clusters[c][account].append(user)
+
+    def remove_user(self, account, user, cluster=None):
+        for c in self._clusters_for(account, cluster):
+            if user in self.clusters[c][account]:
+                self.clusters[c][account].remove(user)
+        if not any([user in self.clusters[c].get(account, []) for c in self.clusters]):
+            self.users[account].discard(user)
+            self.user_accounts[user].discard(account)
+
+
+class GroupIndex(object):
+    """Linux group name -> set of member usernames, enumerated once with
+    grp.getgrall() (or built from ldap) instead of one `getent group` per
+    account. With live set, groups missing from the enumeration (sssd
+    only enumerates when configured to) are looked up individually with
+    grp.getgrnam and remembered.
+    """
+    def __init__(self, groups=None, live=True):
+        self.groups = groups if groups is not None else {}
+        self.live = live
+
+    def __len__(self):
+        return len(self.groups)
+
+    @classmethod
+    def from_nss(cls, live=True):
+        import grp
+        groups = {}
+        for group in grp.getgrall():
+            groups.setdefault(group.gr_name, set()).update(group.gr_mem)
+        return cls(groups, live)
+
+    @classmethod
+    def from_ldap(cls, ldap_client, ous=('collaborations',), live=False):
+        """Build the index from mercldap.ldap.Client.getMembershipIndex,
+        nested groups expanded"""
+        index = ldap_client.getMembershipIndex(ous)
+        groups = {}
+        for ou in ous:
+            for name in index.getProjectNames(ou):
+                members = groups.setdefault(name, set())
+                for dn in index.getMembers(name, ou):
+                    rdn = dn.split(',')[0]
+                    if rdn[0:4].lower() == 'uid=':
+                        members.add(rdn[4:])
+        return cls(groups, live)
+
+    def members(self, name):
+        """The members of group name, None if there is no such group"""
+        if name not in self.groups:
+            if not self.live:
+                return None
+            import grp
+            try:
+                self.groups[name] = set(grp.getgrnam(name).gr_mem)
+            except KeyError:
+                self.groups[name] = None
+        members = self.groups[name]
+        if members is None:
+            return None
+        return set(members)
+
+
+class AssociationBatch(object):
+    """Collects user association adds and removals and writes them with as
+    few sacctmgr invocations as possible: one per account (and operation)
+    naming up to `chunk` users at once.
+
+    Rather than sleeping a fixed 5 seconds after every change, the pause
+    between invocations is `pace` times a moving average of how long
+    slurmdbd took to answer, kept between min_pause and max_pause seconds.
+    """
+    def __init__(self, slurm_client, cluster=None, chunk=50, pace=1.0,
+                 min_pause=0.5, max_pause=10):
+        self.slurm = slurm_client
+        self.cluster = cluster
+        self.chunk = chunk
+        self.pace = pace
+        self.min_pause = min_pause
+        self.max_pause = max_pause
+        self.response_time = None
+        self._adds = {}
+        self._removes = {}
+        self.log = logging.getLogger('mgid.slurm.batch')
+
+    def __len__(self):
+        return sum([len(u) for u in self._adds.values()]) + \
+            sum([len(u) for u in self._removes.values()])
+
+    def add(self, account, user):
+        """Queue adding user to account"""
+        self._adds.setdefault(account, set()).add(user)
+        self._removes.get(account, set()).discard(user)
+
+    def remove(self, account, user):
+        """Queue removing user from account"""
+        self._removes.setdefault(account, set()).add(user)
+        self._adds.get(account, set()).discard(user)
+
+    def _commands(self):
+        for verb, pending in (('add', self._adds), ('delete', self._removes)):
+            for account in sorted(pending):
+                users = sorted(pending[account])
+                for i in range(0, len(users), self.chunk):
+                    yield verb, account, users[i:i + self.chunk]
+
+    def _pause(self):
+        if self.response_time is None:
+            return self.min_pause
+        return min(self.max_pause,
+                   max(self.min_pause, self.pace * self.response_time))
+
+    def flush(self):
+        """Run the queued changes. Returns a list of
+        (verb, account, users, returncode) tuples, returncode is None in a
+        dry run"""
+        import time
+        results = []
+        commands = list(self._commands())
+        for n, (verb, account, names) in enumerate(commands):
+            self.log.info("{} users {} {} SLURM account {}".format(
+                'Adding' if verb == 'add' else 'Removing', ", ".join(names),
+                'to' if verb == 'add' else 'from', account))
+            start = time.time()
+            returncode = self.slurm.change_associations(verb, account, names,
+                                                        self.cluster)
+            elapsed = time.time() - start
+            results.append((verb, account, names, returncode))
+            if subprocess.debug:
+                continue
+            snapshot = self.slurm._patch_snapshot()
+            if snapshot is not None and returncode != 0:
+                # Leave the detached snapshot as it was, sacctmgr may have
+                # applied none or some of the change
+                self.slurm.invalidate_snapshot()
+            elif snapshot is not None:
+                for name in names:
+                    if verb == 'add':
+                        snapshot.add_user(account, name, self.cluster)
+                    else:
+                        snapshot.remove_user(account, name, self.cluster)
+            if self.response_time is None:
+                self.response_time = elapsed
+            else:
+                self.response_time = 0.7 * self.response_time + 0.3 * elapsed
+            if n < len(commands) - 1:
+                pause = self._pause()
+                self.log.debug("slurmdbd answered in {:.2f}s, pausing {:.2f}s".format(elapsed, pause))
+                time.sleep(pause)
+        self._adds = {}
+        self._removes = {}
+        return results
@@ -0,0 +1,283 @@
+"""SlurmClient backend speaking the slurmrestd JSON API
+
+Selected with `backend: rest` in slurmconfig.yml:
+
+    backend: rest
+    slurm_base: /usr/bin
+    rest:
+      url: https://slurmrestd.example:6820
+      user: slurm
+      token: <JWT from scontrol token>
+      version: v0.0.39
+      cluster: m3
+
+All requests go over one keep-alive requests.Session, so the hot paths
+(association snapshot, user adds, default accounts, job extraction) no
+longer fork a process and open a new slurmdbd connection per call. Methods
+slurmrestd has no equivalent for fall back to the command line tools under
+slurm_base.
+Writes honour the mysubprocess dry-run flag: the request is printed
+instead of sent.
+"""
+import json
+import logging
+
+import mysubprocess as subprocess
+from mercslurm.slurm import SlurmClient, AssociationSnapshot
+
+
+class SlurmRestError(Exception):
+    pass
+
+
+class SlurmRestClient(SlurmClient):
+    """The SlurmClient interface implemented over slurmrestd"""
+
+    def __init__(self, slurm_base='/usr/bin', rest=None, **kwargs):
+        import requests
+        from requests.adapters import HTTPAdapter
+        super(SlurmRestClient, self).__init__(slurm_base, **kwargs)
+        rest = rest or {}
+        self.url = rest.get('url', 'http://localhost:6820').rstrip('/')
+        self.version = rest.get('version', 'v0.0.39')
+        self.cluster = rest.get('cluster')
+        self.timeout = rest.get('timeout', 60)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1,
+                              pool_maxsize=rest.get('pool_size', 8),
+                              max_retries=rest.get('retries', 3))
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        if rest.get('user') is not None:
+            self.session.headers['X-SLURM-USER-NAME'] = rest['user']
+        if rest.get('token') is not None:
+            self.session.headers['X-SLURM-USER-TOKEN'] = rest['token']
+        if rest.get('cafile') is not None:
+            self.session.verify = rest['cafile']
+        self.log = logging.getLogger('mgid.slurm.rest')
+
+    def __repr__(self):
+        return "<mercslurm.SlurmRestClient {}>".format(self.url)
+
+    def _path(self, api, path):
+        return '{}/{}/{}/{}'.format(self.url, api, self.version, path)
+
+    def _request(self, method, api, path, params=None, body=None, write=False):
+        url = self._path(api, path)
+        if write and subprocess.debug:
+            print(" ".join([method, url, json.dumps(body) if body else '']).strip())
+            return None
+        response = self.session.request(method, url, params=params, json=body,
+                                        timeout=self.timeout)
+        try:
+            data = response.json()
+        except ValueError:
+            data = {}
+        errors = [e for e in data.get('errors', []) if e]
+        if response.status_code >= 400 or errors:
+            raise SlurmRestError("{} {} returned {}: {}".format(
+                method, url, response.status_code, errors or response.text))
+        return data
+
+    def _get(self, api, path, params=None):
+        return self._request('GET', api, path, params=params)
+
+    # Status
+
+    def check_slurm_status(self):
+        try:
+            pings = self._get('slurm', 'ping').get('pings', [])
+        except Exception as e:
+            self.log.critical('Unable to ping slurmctld: {}'.format(e))
+            return 0
+        states = [str(p.get('pinged', p.get('ping', ''))).upper() for p in pings]
+        up = [s for s in states if s == 'UP']
+        if len(up) == 0:
+            self.log.critical('Slurm primary and backup controllers are down: {}'.format(states))
+            return 0
+        if len(up) < len(states):
+            self.log.debug('Slurm backup controller is down: {}'.format(states))
+            return 0
+        self.log.debug('Slurm controllers are ok: {}'.format(states))
+        return 1
+
+    def check_sacctmgr_status(self):
+        try:
+            self._get('slurmdb', 'diag')
+        except Exception as e:
+            self.log.critical("slurmrestd can't communicate with slurmdbd: {}".format(e))
+            return 1
+        return 0
+
+    # Associations and accounts
+
+    def association_snapshot(self, refresh=False):
+        if self._snapshot is None or refresh:
+            params = {}
+            if self.cluster is not None:
+                params['cluster'] = self.cluster
+            data = self._get('slurmdb', 'associations', params)
+            snapshot = AssociationSnapshot(self)
+            for assoc in data.get('associations', []):
+                snapshot.add_row(assoc.get('cluster', ''), assoc.get('account', ''),
+                                 assoc.get('user', '') or '',
+                                 assoc.get('parent_account', '') or '')
+            self._snapshot = snapshot
+            self.log.debug("Loaded {} slurm accounts".format(len(snapshot.accounts)))
+        return self._snapshot
+
+    def get_all_default_accounts(self):
+        defaults = {}
+        for user in self._get('slurmdb', 'users').get('users', []):
+            account = (user.get('default') or {}).get('account')
+            if account:
+                defaults[user['name']] = account
+        return defaults
+
+    def _association(self, account, user=None, parent=None, cluster=None):
+        assoc = {'account': account}
+        if user is not None:
+            assoc['user'] = user
+        if parent is not None:
+            assoc['parent_account'] = parent
+            assoc['shares_raw'] = 1
+        cluster = cluster or self.cluster
+        if cluster is not None:
+            assoc['cluster'] = cluster
+        return assoc
+
+    def createaccount(self, account, parent):
+        if parent is None or parent == "":
+            return
+        if account is None or account == "":
+            return
+        self._request('POST', 'slurmdb', 'accounts', write=True,
+                      body={'accounts': [{'name': account,
+                                          'organization': 'Monash',
+                                          'description': account}]})
+        self._request('POST', 'slurmdb', 'associations', write=True,
+                      body={'associations': [self._association(account, parent=parent)]})
+        self.log.info("Assigning {} as parent account of {}".format(parent,
+                                                                     account))
+        snapshot = self._patch_snapshot()
+        if snapshot is not None:
+            snapshot.add_account(account, parent)
+
+    def change_associations(self, verb, account, users, cluster=None):
+        try:
+            if verb == 'add':
+                self._request('POST', 'slurmdb', 'associations', write=True,
+                              body={'associations': [self._association(account, user, cluster=cluster)
+                                                     for user in users]})
+            else:
+                for user in users:
+                    params = {'account': account, 'user': user}
+                    if cluster or self.cluster:
+                        params['cluster'] = cluster or self.cluster
+                    self._request('DELETE', 'slurmdb', 'association',
+                                  params=params, write=True)
+        except SlurmRestError as e:
+            self.log.error("slurmrestd {} for {}: {}".format(verb, account, e))
+            return 1
+        return None if subprocess.debug else 0
+
+    def add_user(self, account, user, cluster=None):
+        """Add a user to a slurm account, optionally on a given cluster"""
+        self.log.info("Adding user {} to SLURM account {}".format(user, account))
+        if self.change_associations('add', account, [user], cluster) == 0:
+            snapshot = self._patch_snapshot()
+            if snapshot is not None:
+                snapshot.add_user(account, user, cluster)
+
+    def remove_user(self, account, user, cluster=None):
+        """remove a user from a slurm account, optionally on a given cluster"""
+        self.log.info("Removing user {} from SLURM account {}".format(user, account))
+        if self.change_associations('delete', account, [user], cluster) == 0:
+            snapshot = self._patch_snapshot()
+            if snapshot is not None:
+                snapshot.remove_user(account, user, cluster)
+
+    def set_default_accounts(self, account, users):
+        try:
+            self._request('POST', 'slurmdb', 'users', write=True,
+                          body={'users': [{'name': user, 'default': {'account': account}}
+                                          for user in users]})
+        except SlurmRestError as e:
+            self.log.error("slurmrestd default account {}: {}".format(account, e))
+            return 1
+        return None if subprocess.debug else 0
+
+    def set_default_account(self, user, account):
+        """Set the default account for a user"""
+        self.log.info("Setting default account {} for user {}".format(account,
+                                                                     user))
+        if self.set_default_accounts(account, [user]) not in (0, None):
+            return
+        snapshot = self._patch_snapshot()
+        if snapshot is not None and snapshot.defaults is not None:
+            snapshot.defaults[user] = account
+
+    # Fairshare
+
+    @staticmethod
+    def _number(value):
+        """slurmrestd wraps some numbers as {'set': .., 'number': ..}"""
+        if isinstance(value, dict):
+            value = value.get('number')
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return None
+
+    def share_rows(self):
+        """The /shares listing as mercslurm.shares.SHARE_FIELDS values"""
+        shares = self._get('slurm', 'shares').get('shares', {})
+        if isinstance(shares, dict):
+            shares = shares.get('shares', [])
+        for share in shares:
+            fairshare = share.get('fairshare') or {}
+            if 'USER' in share.get('type', []):
+                account, user = share.get('parent', ''), share.get('name', '')
+            else:
+                account, user = share.get('name', ''), ''
+            yield [account, user] + [self._number(v) for v in (
+                share.get('shares_normalized'), share.get('usage_normalized'),
+                fairshare.get('level'), share.get('usage'), fairshare.get('factor'))]
+
+    # Jobs
+
+    def _sacct_lines(self, starttime, endtime, fields=None):
+        """Jobs from slurmdbd via slurmrestd, rendered as the sacct fields
+        the parsers in mercslurm.slurm expect"""
+        import datetime
+        from mercslurm.slurm import JOB_FIELDS, to_datetime
+        fields = fields or JOB_FIELDS
+
+        def stamp(value):
+            value = self._number(value)
+            if not value:
+                return 'Unknown'
+            return datetime.datetime.fromtimestamp(value).strftime('%Y-%m-%dT%H:%M:%S')
+
+        params = {'start_time': int(to_datetime(starttime).timestamp()),
+                  'end_time': int(to_datetime(endtime).timestamp())}
+        for job in self._get('slurmdb', 'jobs', params).get('jobs', []):
+            times = job.get('time', {})
+            state = job.get('state', {}).get('current', '')
+            if isinstance(state, list):
+                state = ",".join(state)
+            cpus = self._number(job.get('required', {}).get('CPUs')) or 0
+            elapsed = self._number(times.get('elapsed')) or 0
+            record = {'JobID': str(job.get('job_id', '')),
+                      'User': job.get('user', ''),
+                      'Account': job.get('account', ''),
+                      'AllocCPUS': str(int(cpus)),
+                      'AllocGRES': '',
+                      'ReqGRES': '',
+                      'CPUTimeRAW': str(int(cpus * elapsed)),
+                      'JobName': job.get('name', ''),
+                      'Submit': stamp(times.get('submission')),
+                      'Start': stamp(times.get('start')),
+                      'End': stamp(times.get('end')),
+                      'State': state}
+            yield [record.get(f, '') for f in fields]
@@ -2,16 +2,59 @@
 through a series of flags"""
 
 import subprocess
+import time
 debug = True
 testvar = False
 PIPE = subprocess.PIPE
 
 
 class myPopen:
+    returncode = None
+
     @staticmethod
     def communicate():
         return None, None
 
+    @staticmethod
+    def wait():
+        return None
+
+
+class TimedPopen(subprocess.Popen):
+    """subprocess.Popen that records its wall time, exit status and output
+    size with mysubprocess.metrics once it has finished. A caller reading
+    stdout itself adds what it read to stdout_bytes"""
+    def __init__(self, *args, **kwargs):
+        self._started = time.time()
+        self._recorded = False
+        self._communicating = False
+        self.stdout_bytes = 0
+        super(TimedPopen, self).__init__(*args, **kwargs)
+
+    def _record(self, stdout=None, stderr=None):
+        if self._recorded:
+            return
+        self._recorded = True
+        from mysubprocess import metrics
+        metrics.record(self.args, time.time() - self._started, self.returncode,
+                       len(stdout) if stdout is not None else self.stdout_bytes,
+                       len(stderr or b''))
+
+    def communicate(self, *args, **kwargs):
+        self._communicating = True
+        try:
+            stdout, stderr = super(TimedPopen, self).communicate(*args, **kwargs)
+        finally:
+            self._communicating = False
+        self._record(stdout, stderr)
+        return stdout, stderr
+
+    def wait(self, *args, **kwargs):
+        returncode = super(TimedPopen, self).wait(*args, **kwargs)
+        if not self._communicating:
+            self._record()
+        return returncode
+
 
 def Popen(*args, **kwargs):
     query = kwargs.pop('query',False)
@@ -19,14 +62,28 @@ def Popen(*args, **kwargs):
         print(" ".join(args[0]))
         return myPopen
     else:
-        return subprocess.Popen(*args, **kwargs)
+        return TimedPopen(*args, **kwargs)
 
 
 def call(*args, **kwargs):
+    """Run a command and wait for it, returning its exit status (None in a
+    dry run)"""
     query = kwargs.pop('query',False)
     if debug and not query:
         print(" ".join(args[0]))
-        return myPopen
+        return None
     else:
+        return TimedPopen(*args, **kwargs).wait()
+
+
+def submit(*args, **kwargs):
+    """Start a command on the shared engine (see mysubprocess.engine),
+    returning a Future of its Result"""
+    from mysubprocess.engine import get_engine
+    return get_engine().submit(*args, **kwargs)
+
 
-        return subprocess.Popen(*args, **kwargs)
+def run(*args, **kwargs):
+    """Run a command on the shared engine and wait for its Result"""
+    from mysubprocess.engine import get_engine
+    return get_engine().run(*args, **kwargs)
@@ -0,0 +1,132 @@
+"""A bounded pool for running commands concurrently with the dry-run flag
+
+Commands are submitted to an Engine and come back as futures of Result.
+Each command may name a backend (e.g. 'slurmdbd', 'filesystem'); a backend
+with a limit has its own pool of limits[backend] threads, so slurmdbd still
+sees one sacctmgr at a time while independent filesystem commands overlap,
+and commands queued for a slow backend never hold threads another backend
+could use:
+
+    engine = mysubprocess.engine.get_engine()
+    futures = [engine.submit(['mkdir', path], backend='filesystem')
+               for path in paths]
+    for result in engine.wait(futures):
+        if result.returncode != 0: ...
+
+As with mysubprocess.Popen, unless mysubprocess.debug is cleared (or query
+is set) the command is only printed, at submit time so the dry-run output
+keeps its order, and its Result has returncode None.
+"""
+import logging
+import subprocess
+import threading
+import time
+
+from collections import namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import mysubprocess
+from mysubprocess import metrics
+
+# returncode is None for a dry run, timed_out is set if the command was
+# killed after its timeout. stdout and stderr are bytes (None in a dry run)
+Result = namedtuple('Result', ['args', 'returncode', 'stdout', 'stderr',
+                               'elapsed', 'timed_out'])
+
+DEFAULT_LIMITS = {'slurmdbd': 1, 'filesystem': 16, 'keygen': 4}
+
+
+class Engine(object):
+    """Runs commands of each limited backend on that backend's own
+    limits[backend] threads, and everything else on `workers` threads"""
+
+    def __init__(self, workers=16, limits=None, timeout=None):
+        self.workers = workers
+        self.timeout = timeout
+        self.limits = dict(DEFAULT_LIMITS)
+        if limits is not None:
+            self.limits.update(limits)
+        self._executors = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self.log = logging.getLogger('mgid.subprocess')
+
+    def __repr__(self):
+        return "<mysubprocess.Engine x{} {}>".format(self.workers, self.limits)
+
+    def _executor_for(self, backend):
+        if backend is None or backend not in self.limits:
+            return self._executor
+        with self._lock:
+            if backend not in self._executors:
+                self._executors[backend] = ThreadPoolExecutor(
+                    max_workers=self.limits[backend],
+                    thread_name_prefix='mysubprocess-{}'.format(backend))
+            return self._executors[backend]
+
+    @staticmethod
+    def _dry(args):
+        print(args if isinstance(args, str) else " ".join(args))
+        future = Future()
+        future.set_result(Result(args, None, None, None, 0.0, False))
+        return future
+
+    def submit(self, args, backend=None, timeout=None, query=False, input=None,
+               **kwargs):
+        """Start args (as for subprocess.Popen, extra keyword arguments are
+        passed on) and return a Future of its Result. A command running
+        longer than timeout seconds (the Engine default if None) is killed"""
+        if mysubprocess.debug and not query:
+            return self._dry(args)
+        if timeout is None:
+            timeout = self.timeout
+        return self._executor_for(backend).submit(self._run, args, timeout,
+                                                  input, kwargs)
+
+    def _run(self, args, timeout, input, kwargs):
+        kwargs.setdefault('stdout', subprocess.PIPE)
+        kwargs.setdefault('stderr', subprocess.PIPE)
+        if input is not None:
+            kwargs.setdefault('stdin', subprocess.PIPE)
+        start = time.time()
+        proc = subprocess.Popen(args, **kwargs)
+        timed_out = False
+        try:
+            stdout, stderr = proc.communicate(input, timeout=timeout)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            stdout, stderr = proc.communicate()
+            timed_out = True
+            self.log.error("Killed {} after {}s".format(args, timeout))
+        elapsed = time.time() - start
+        metrics.record(args, elapsed, proc.returncode, len(stdout or b''),
+                       len(stderr or b''), timed_out)
+        return Result(args, proc.returncode, stdout, stderr, elapsed,
+                      timed_out)
+
+    def run(self, args, **kwargs):
+        """submit args and wait for its Result"""
+        return self.submit(args, **kwargs).result()
+
+    def wait(self, futures):
+        """The Results of futures, in the order given"""
+        return [future.result() for future in futures]
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            executors = list(self._executors.values())
+        for executor in [self._executor] + executors:
+            executor.shutdown(wait=wait)
+
+
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def get_engine(**kwargs):
+    """The shared Engine, created with kwargs the first time"""
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            _engine = Engine(**kwargs)
+        return _engine
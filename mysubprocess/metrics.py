@@ -0,0 +1,166 @@
+"""Timing of every command run through mysubprocess
+
+Each command that actually runs (not those only printed in a dry run) is
+recorded with its wall time, exit status and stdout/stderr byte counts,
+under its family: the basename of the binary, e.g. sacctmgr or rsync.
+Families are aggregated into cumulative histograms of wall time, and at the
+end of a run the summary can be written as JSON, or as a Prometheus
+textfile-collector file so slow commands can be tracked across runs:
+
+    mysubprocess.metrics.write_json('/var/log/manageid-metrics.json')
+    mysubprocess.metrics.write_prometheus(
+        '/var/lib/node_exporter/textfile/manageid.prom')
+"""
+import json
+import os
+import threading
+import time
+
+# Upper bounds (seconds) of the wall time histogram buckets
+BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900)
+
+
+def family(args):
+    """The command family of args: the binary's basename"""
+    if isinstance(args, (bytes, str)):
+        args = args.split()
+    if not args:
+        return ''
+    first = args[0]
+    if isinstance(first, bytes):
+        first = first.decode('utf-8', 'replace')
+    # A shell=True command line passed as a one element list
+    first = first.split()[0] if first.split() else first
+    return os.path.basename(first)
+
+
+class Histogram(object):
+    """Wall times and outcomes of one command family"""
+
+    def __init__(self):
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self.buckets = [0] * len(BUCKETS)
+        self.failures = 0
+        self.timeouts = 0
+        self.exit_codes = {}
+        self.stdout_bytes = 0
+        self.stderr_bytes = 0
+
+    def add(self, elapsed, returncode, stdout_bytes=0, stderr_bytes=0,
+            timed_out=False):
+        self.count += 1
+        self.sum += elapsed
+        self.max = max(self.max, elapsed)
+        for i, bound in enumerate(BUCKETS):
+            if elapsed <= bound:
+                self.buckets[i] += 1
+        if returncode != 0:
+            self.failures += 1
+        if timed_out:
+            self.timeouts += 1
+        key = str(returncode)
+        self.exit_codes[key] = self.exit_codes.get(key, 0) + 1
+        self.stdout_bytes += stdout_bytes or 0
+        self.stderr_bytes += stderr_bytes or 0
+
+    def summary(self):
+        return {'count': self.count,
+                'sum': self.sum,
+                'mean': self.sum / self.count if self.count else 0.0,
+                'max': self.max,
+                'buckets': [[b, n] for b, n in zip(BUCKETS, self.buckets)],
+                'failures': self.failures,
+                'timeouts': self.timeouts,
+                'exit_codes': dict(self.exit_codes),
+                'stdout_bytes': self.stdout_bytes,
+                'stderr_bytes': self.stderr_bytes}
+
+
+class Recorder(object):
+    """Histograms of every command run, keyed by family"""
+
+    def __init__(self):
+        self.started = time.time()
+        self.families = {}
+        self._lock = threading.Lock()
+
+    def record(self, args, elapsed, returncode, stdout_bytes=0, stderr_bytes=0,
+               timed_out=False):
+        name = family(args)
+        with self._lock:
+            if name not in self.families:
+                self.families[name] = Histogram()
+            self.families[name].add(elapsed, returncode, stdout_bytes,
+                                    stderr_bytes, timed_out)
+
+    def summary(self):
+        with self._lock:
+            return {'started': self.started,
+                    'duration': time.time() - self.started,
+                    'commands': dict([(name, h.summary())
+                                      for name, h in sorted(self.families.items())])}
+
+    def write_json(self, path):
+        _write_atomic(path, json.dumps(self.summary(), indent=2, sort_keys=True) + '\n')
+
+    def write_prometheus(self, path, job='manageid'):
+        """Write the histograms in the Prometheus text exposition format"""
+        summary = self.summary()
+        lines = ['# HELP mysubprocess_command_seconds Wall time of commands run',
+                 '# TYPE mysubprocess_command_seconds histogram']
+        for name, h in summary['commands'].items():
+            labels = 'job="{}",family="{}"'.format(job, name)
+            for bound, n in h['buckets']:
+                lines.append('mysubprocess_command_seconds_bucket{{{},le="{}"}} {}'.format(
+                    labels, bound, n))
+            lines.append('mysubprocess_command_seconds_bucket{{{},le="+Inf"}} {}'.format(
+                labels, h['count']))
+            lines.append('mysubprocess_command_seconds_sum{{{}}} {}'.format(labels, h['sum']))
+            lines.append('mysubprocess_command_seconds_count{{{}}} {}'.format(labels, h['count']))
+        for metric, key, help_text in (
+                ('mysubprocess_command_failures_total', 'failures', 'Commands exiting non-zero'),
+                ('mysubprocess_command_timeouts_total', 'timeouts', 'Commands killed after their timeout'),
+                ('mysubprocess_command_stdout_bytes_total', 'stdout_bytes', 'Bytes read from stdout'),
+                ('mysubprocess_command_stderr_bytes_total', 'stderr_bytes', 'Bytes read from stderr')):
+            lines.append('# HELP {} {}'.format(metric, help_text))
+            lines.append('# TYPE {} counter'.format(metric))
+            for name, h in summary['commands'].items():
+                lines.append('{}{{job="{}",family="{}"}} {}'.format(metric, job, name, h[key]))
+        lines.append('# HELP mysubprocess_run_seconds Wall time of the whole run')
+        lines.append('# TYPE mysubprocess_run_seconds gauge')
+        lines.append('mysubprocess_run_seconds{{job="{}"}} {}'.format(job, summary['duration']))
+        _write_atomic(path, '\n'.join(lines) + '\n')
+
+
+def _write_atomic(path, text):
+    # The textfile collector may read at any moment, so never leave a
+    # partly written file in place
+    tmppath = '{}.tmp{}'.format(path, os.getpid())
+    with open(tmppath, 'w') as f:
+        f.write(text)
+    os.rename(tmppath, path)
+
+
+_recorder = Recorder()
+
+
+def get_recorder():
+    return _recorder
+
+
+def record(*args, **kwargs):
+    _recorder.record(*args, **kwargs)
+
+
+def summary():
+    return _recorder.summary()
+
+
+def write_json(path):
+    _recorder.write_json(path)
+
+
+def write_prometheus(path, job='manageid'):
+    _recorder.write_prometheus(path, job)
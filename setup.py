@@ -90,6 +90,11 @@ setup(
             "influxdb"
             ],
 
+    # Optional: in process ssh key generation (merchpcuser.sshkeys falls
+    # back to ssh-keygen without it)
+    extras_require={
+        'keys': ["cryptography"],
+    },
 
     data_files = [],
 
@@ -0,0 +1,55 @@
+import threading
+
+import ldap3
+import pytest
+
+from mercldap import ldap
+from mercldap.aioldap import AsyncClient
+
+BASE = 'dc=erc,dc=monash,dc=edu,dc=au'
+
+
+def mock_client():
+    server = ldap3.Server('mock', get_info=ldap3.OFFLINE_SLAPD_2_4)
+    conn = ldap3.Connection(server, user='cn=admin,{}'.format(BASE), password='secret',
+                            client_strategy=ldap3.MOCK_SYNC, raise_exceptions=True)
+    conn.strategy.add_entry('cn=admin,{}'.format(BASE), {'userPassword': 'secret', 'sn': 'admin'})
+    for uid, mail in (('alice', 'alice@example.org'), ('bob', 'shared@example.org'),
+                      ('carol', 'shared@example.org')):
+        conn.strategy.add_entry('uid={},ou=Accounts,{}'.format(uid, BASE), {
+            'objectClass': ['top', 'inetOrgPerson', 'posixAccount'],
+            'uid': uid, 'cn': uid, 'sn': uid, 'uidNumber': 10001, 'gidNumber': 10001,
+            'homeDirectory': '/home/{}'.format(uid), 'mail': mail})
+    conn.bind()
+    client = ldap.Client()
+    client.conn = conn
+    return client
+
+
+def test_calls_run_on_the_pool_and_raise():
+    client = mock_client()
+    threads = set()
+    searchUser = client.searchUser
+
+    def tracked(*args, **kwargs):
+        threads.add(threading.current_thread())
+        return searchUser(*args, **kwargs)
+
+    client.searchUser = tracked
+    # One worker, as a MOCK_SYNC connection can't be shared between threads
+    aclient = AsyncClient(client, concurrency=1)
+    try:
+        users = aclient.run(aclient.map(aclient.searchUser, ['alice', 'nobody']))
+        assert users[0]['attributes']['uid'] == ['alice']
+        assert users[1] is None
+        assert threading.current_thread() not in threads
+
+        with pytest.raises(Exception, match='too any users matched'):
+            aclient.run(aclient.getUserByMail('shared@example.org'))
+        results = aclient.run(aclient.map(aclient.getUserByMail,
+                                          ['alice@example.org', 'shared@example.org'],
+                                          return_exceptions=True))
+        assert results[0].dn.startswith('uid=alice,')
+        assert isinstance(results[1], Exception)
+    finally:
+        aclient.close()
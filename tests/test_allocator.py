@@ -0,0 +1,49 @@
+import ldap3
+
+from mercldap.allocator import IdAllocator
+
+
+class NoPoolConnection(object):
+    """A connection to a directory without an id pool which may not add one"""
+
+    def __init__(self):
+        self.response = []
+        self.added = 0
+
+    def search(self, *args, **kwargs):
+        self.response = []
+        return False
+
+    def add(self, *args, **kwargs):
+        self.added += 1
+        raise ldap3.core.exceptions.LDAPInsufficientAccessRightsResult('no add')
+
+
+class FakeClient(object):
+    idPoolDN = 'cn=idpool,dc=erc,dc=monash,dc=edu,dc=au'
+    idPoolObjectClass = ['top', 'device', 'sambaUnixIdPool']
+
+    def __init__(self):
+        self.conn = NoPoolConnection()
+        self.maxUid = 10000
+        self.maxGid = 20000
+
+    def _getMaxUidNumber(self):
+        return self.maxUid
+
+    def _getMaxGidNumber(self):
+        return self.maxGid
+
+
+def test_falls_back_to_scan_without_pool():
+    client = FakeClient()
+    uids = IdAllocator(client, 'uidNumber')
+    gids = IdAllocator(client, 'gidNumber', ceiling=65534)
+    assert uids.next() == 10001
+    assert gids.next() == 20001
+    # Numbers already handed out aren't reused before they show up in a scan
+    assert uids.next() == 10002
+    client.maxUid = 10010
+    assert uids.reserve(3) == [10011, 10012, 10013]
+    # Creating the pool is only attempted once per allocator
+    assert client.conn.added == 2
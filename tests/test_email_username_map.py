@@ -0,0 +1,76 @@
+import dbm
+
+from manageid import email_username_map
+
+
+class FakeLdap(object):
+    """Answers the map's searches from a dict of uid -> (mail, stamp)"""
+
+    def __init__(self, accounts):
+        self.accounts = accounts
+        self.searches = []
+
+    def search(self, search_str, attributes=None):
+        self.searches.append(search_str)
+        since, after = None, None
+        if 'modifyTimestamp>=' in search_str:
+            since = search_str.split('modifyTimestamp>=')[1].rstrip(')')
+        if '!(modifyTimestamp<=' in search_str:
+            after = search_str.split('!(modifyTimestamp<=')[1].rstrip(')')
+        for uid, (mail, stamp) in sorted(self.accounts.items()):
+            if since is not None and stamp < since:
+                continue
+            if after is not None and stamp <= after:
+                continue
+            yield {'dn': 'uid={},ou=People'.format(uid),
+                   'attributes': {'uid': [uid], 'mail': [mail],
+                                  'modifyTimestamp': [stamp]}}
+
+
+def lookup(path):
+    with dbm.open(path, 'r') as db:
+        return dict((k.decode(), db[k].decode()) for k in db.keys())
+
+
+def test_dbm_incremental_drops_deleted_accounts(tmp_path):
+    path = str(tmp_path / 'mailmap')
+    ldap = FakeLdap({'alice': ('alice@example.org', '20260101000000Z'),
+                     'bob': ('bob@example.org', '20260102000000Z')})
+    email_username_map.write_dbm(ldap, path)
+    assert lookup(path) == {'alice@example.org': 'alice', 'bob@example.org': 'bob'}
+
+    # Deleting alice modifies nothing, an update within the interval is skipped
+    del ldap.accounts['alice']
+    email_username_map.write_dbm(ldap, path, incremental=True)
+    assert 'alice@example.org' in lookup(path)
+
+    # but once the interval has passed the map is rebuilt
+    email_username_map.write_dbm(ldap, path, incremental=True, prune_interval=0)
+    assert lookup(path) == {'bob@example.org': 'bob'}
+
+
+def test_dbm_incremental_skips_rebuild_when_unchanged(tmp_path):
+    path = str(tmp_path / 'mailmap')
+    ldap = FakeLdap({'alice': ('alice@example.org', '20260101000000Z'),
+                     'bob': ('bob@example.org', '20260102000000Z')})
+    email_username_map.write_dbm(ldap, path)
+    ldap.searches = []
+    email_username_map.write_dbm(ldap, path, incremental=True)
+    assert len(ldap.searches) == 1
+    assert email_username_map.SEARCH_STR not in ldap.searches
+
+    # A newer stamp is picked up and rebuilds the map
+    ldap.accounts['carol'] = ('carol@example.org', '20260103000000Z')
+    email_username_map.write_dbm(ldap, path, incremental=True)
+    assert lookup(path)['carol@example.org'] == 'carol'
+
+
+def test_dbm_old_marker_rebuilds(tmp_path):
+    path = str(tmp_path / 'mailmap')
+    ldap = FakeLdap({'alice': ('alice@example.org', '20260101000000Z')})
+    email_username_map.write_dbm(ldap, path)
+    with open(path + '.marker', 'w') as f:
+        f.write('20260101000000Z')
+    del ldap.accounts['alice']
+    email_username_map.write_dbm(ldap, path, incremental=True)
+    assert lookup(path) == {}
@@ -0,0 +1,42 @@
+import time
+
+import pytest
+
+import mysubprocess
+from mysubprocess.engine import Engine
+
+
+@pytest.fixture
+def execute():
+    debug = mysubprocess.debug
+    mysubprocess.debug = False
+    yield
+    mysubprocess.debug = debug
+
+
+def test_backend_limit(execute):
+    engine = Engine(workers=4, limits={'slurmdbd': 1})
+    start = time.time()
+    results = engine.wait([engine.submit(['sleep', '0.2'], backend='slurmdbd')
+                           for i in range(3)])
+    assert time.time() - start >= 0.6
+    assert [r.returncode for r in results] == [0, 0, 0]
+    engine.shutdown()
+
+
+def test_slow_backend_does_not_block_others(execute):
+    engine = Engine(workers=4, limits={'slurmdbd': 1})
+    queued = [engine.submit(['sleep', '0.5'], backend='slurmdbd') for i in range(4)]
+    start = time.time()
+    assert engine.run(['true'], backend='filesystem').returncode == 0
+    assert time.time() - start < 0.4
+    engine.wait(queued)
+    engine.shutdown()
+
+
+def test_dry_run_prints(capsys):
+    engine = Engine()
+    result = engine.run(['mkdir', '/nonexistent/x'], backend='filesystem')
+    assert result.returncode is None
+    assert capsys.readouterr().out == "mkdir /nonexistent/x\n"
+    engine.shutdown()
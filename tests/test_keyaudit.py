@@ -0,0 +1,68 @@
+import os
+
+from merchpcuser import keyaudit
+from merchpcuser.inventory import HomeInventory
+from merchpcuser.keyaudit import KeyAudit
+
+KEY = 'ssh-ed25519 AAAAC3Nza alice@m3\n'
+
+
+class Home(object):
+    """The parts of UserHome that KeyAudit uses"""
+
+    def __init__(self, mnt, username):
+        self.username = username
+        self.homepath = os.path.join(mnt, username)
+        self.sshpath = os.path.join(self.homepath, '.ssh')
+        self.keypath = os.path.join(self.sshpath, 'id_ed25519')
+        self.publickey = self.keypath + '.pub'
+        self.authfile = os.path.join(self.sshpath, 'authorized_keys')
+
+
+def make_home(tmp_path, auth=KEY):
+    ssh = tmp_path / 'alice' / '.ssh'
+    ssh.mkdir(parents=True)
+    (ssh / 'id_ed25519').write_text('private')
+    (ssh / 'id_ed25519.pub').write_text(KEY)
+    (ssh / 'authorized_keys').write_text(auth)
+    return Home(str(tmp_path), 'alice')
+
+
+def test_unchanged_home_costs_one_stat(tmp_path, monkeypatch):
+    home = make_home(tmp_path)
+    path = str(tmp_path / 'keyaudit.db')
+    inventory = HomeInventory(str(tmp_path)).scan(['alice'])
+    audit = KeyAudit(path)
+    assert audit.audit([home], inventory) == {'alice': True}
+    audit.close()
+
+    stats = []
+    stat = os.stat
+    monkeypatch.setattr(os, 'stat', lambda p, *a, **k: stats.append(p) or stat(p, *a, **k))
+    monkeypatch.setattr(keyaudit, 'key_present', None)
+    audit = KeyAudit(path)
+    assert audit.audit([home], inventory) == {'alice': True}
+    assert [p for p in stats if p.startswith(home.homepath)] == [home.sshpath]
+    audit.close()
+
+
+def test_replaced_authorized_keys_is_read_again(tmp_path):
+    home = make_home(tmp_path)
+    audit = KeyAudit()
+    assert audit.check(home)
+    # Written elsewhere and renamed into place, as editors and ssh-copy-id do
+    replacement = tmp_path / 'alice' / '.ssh' / 'authorized_keys.new'
+    replacement.write_text('ssh-rsa AAAAB3Nza other@m3\n')
+    os.rename(str(replacement), home.authfile)
+    assert not audit.check(home)
+    assert audit.misses == 2
+
+
+def test_old_verdicts_are_read_again(tmp_path):
+    home = make_home(tmp_path)
+    audit = KeyAudit(recheck=0)
+    assert audit.check(home)
+    # An in place edit leaves .ssh unchanged, the age limit still catches it
+    with open(home.authfile, 'w') as f:
+        f.write('ssh-rsa AAAAB3Nza other@m3\n')
+    assert not audit.check(home)
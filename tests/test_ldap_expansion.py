@@ -0,0 +1,72 @@
+from mercldap import ldap
+
+A = 'cn=a,ou=collaborations,dc=erc,dc=monash,dc=edu,dc=au'
+B = 'cn=b,ou=collaborations,dc=erc,dc=monash,dc=edu,dc=au'
+C = 'cn=c,ou=collaborations,dc=erc,dc=monash,dc=edu,dc=au'
+X = 'uid=x,ou=People,dc=erc,dc=monash,dc=edu,dc=au'
+Y = 'uid=y,ou=People,dc=erc,dc=monash,dc=edu,dc=au'
+Z = 'uid=z,ou=People,dc=erc,dc=monash,dc=edu,dc=au'
+
+# a -> b -> a, and c -> a from outside the cycle
+GROUPS = {
+    A.lower(): [X, B],
+    B.lower(): [Y, A],
+    C.lower(): [Z, A],
+}
+
+
+def cycle_client():
+    client = ldap.Client()
+    client._directMembers = lambda dn: [(m, 'uid=' not in m[0:4])
+                                        for m in GROUPS[dn.lower()]]
+    return client
+
+
+def members(client, dn):
+    return sorted(client.getDNMembers(dn))
+
+
+def test_cycle_expanded_either_order():
+    for first, second in ((A, B), (B, A)):
+        ldap._expansionCache.clear()
+        client = cycle_client()
+        assert members(client, first) == [X, Y]
+        assert members(client, second) == [X, Y]
+        assert members(client, C) == [X, Y, Z]
+
+
+def test_cycle_members_cached_complete():
+    ldap._expansionCache.clear()
+    client = cycle_client()
+    list(client.getDNMembers(A))
+    assert sorted(ldap._expansionCache.get(A.lower())) == [X, Y]
+    assert sorted(ldap._expansionCache.get(B.lower())) == [X, Y]
+    ldap._expansionCache.clear()
+
+
+def cycle_index():
+    index = ldap.MembershipIndex(None, ['collaborations'])
+    for dn, cn in ((A, 'a'), (B, 'b'), (C, 'c')):
+        index._addGroup(dn, cn, list(GROUPS[dn.lower()]))
+    return index
+
+
+def test_index_cycle_expanded_either_order():
+    for first, second in (('a', 'b'), ('b', 'a')):
+        index = cycle_index()
+        assert sorted(index.getMembers(first)) == [X, Y]
+        assert sorted(index.getMembers(second)) == [X, Y]
+        assert sorted(index.getMembers('c')) == [X, Y, Z]
+
+
+def test_index_members_listed_once():
+    index = cycle_index()
+    index._addGroup(C, 'c', [Z, A, B, X.lower()])
+    assert sorted(index.getMembers('c')) == [X, Y, Z]
+
+
+def test_index_names_ignore_case():
+    index = ldap.MembershipIndex(ldap.Client(), ('collaborations',))
+    index._addGroup(A, 'pMOSP', [X])
+    assert index.getMembers('pmosp') == [X]
+    assert index.getProjectNames() == ['pMOSP']
@@ -0,0 +1,20 @@
+import pytest
+from ldap3.core.exceptions import LDAPServerPoolExhaustedError
+from ldap3.utils.config import get_config_parameter, set_config_parameter
+
+from mercldap.ldap import ConnectionPool
+
+
+@pytest.fixture
+def no_pool_sleep():
+    timeout = get_config_parameter('POOLING_LOOP_TIMEOUT')
+    set_config_parameter('POOLING_LOOP_TIMEOUT', 0)
+    yield
+    set_config_parameter('POOLING_LOOP_TIMEOUT', timeout)
+
+
+def test_unreachable_pool_raises(no_pool_sleep):
+    # Nothing listens on port 1, binding gives up rather than cycling forever
+    pool = ConnectionPool(['ldaps://127.0.0.1:1'])
+    with pytest.raises(LDAPServerPoolExhaustedError):
+        pool.connection()
@@ -0,0 +1,52 @@
+from argparse import Namespace
+
+import manageid
+
+
+class FakeSlack(object):
+    def __init__(self):
+        self.sent = []
+
+    def send_slack(self, *args):
+        self.sent.append(args)
+
+
+class FakeBatch(object):
+    def __init__(self):
+        self.adds = []
+
+    def add(self, account, user):
+        self.adds.append((account, user))
+
+    def flush(self):
+        # sacctmgr rejected the adds to pBAD
+        return [('add', account, [user], 1 if account == 'pBAD' else 0)
+                for account, user in self.adds]
+
+
+class FakeSlurm(object):
+    def check_slurm_status(self):
+        return 0
+
+    def get_cluster_associations(self, cluster):
+        return {'pGOOD': [''], 'pBAD': ['']}
+
+    def association_batch(self):
+        return FakeBatch()
+
+    def get_mx_caps(self):
+        return []
+
+
+def test_failed_adds_not_reported_as_added(monkeypatch):
+    slack = FakeSlack()
+    monkeypatch.setattr(manageid, 'get_clients_dict',
+                        lambda args, clients: {'slurm': FakeSlurm(), 'slack': slack})
+    args = Namespace(cluster='m3', execute=True)
+    manageid.create_slurm_associations(args, {'pGOOD': ['alice', 'bob'],
+                                              'pBAD': ['carol', 'dave']})
+    failed, added, warned = slack.sent[0][:3]
+    assert 'alice' in added and 'bob' in added
+    assert 'carol' not in added and 'dave' not in added
+    assert 'Failed to add user `carol` to slurm assoc `pBAD`' in failed
+    assert 'Failed to add user `dave` to slurm assoc `pBAD`' in failed
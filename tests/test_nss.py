@@ -0,0 +1,22 @@
+import grp
+
+import pytest
+
+from merchpcuser.nss import NssIndex
+
+
+def test_missing_group_found_once_created(monkeypatch):
+    created = {}
+
+    def getgrnam(name):
+        if name not in created:
+            raise KeyError(name)
+        return created[name]
+
+    monkeypatch.setattr(grp, 'getgrnam', getgrnam)
+    index = NssIndex()
+    with pytest.raises(KeyError):
+        index.getgrnam('pNEW')
+    created['pNEW'] = grp.struct_group(('pNEW', 'x', 20002, []))
+    assert index.getgrnam('pNEW').gr_gid == 20002
+    assert index.getgrgid(20002).gr_name == 'pNEW'
@@ -0,0 +1,96 @@
+import datetime
+
+import ldap3
+import pytest
+
+from mercldap import ldap
+
+BASE = 'dc=erc,dc=monash,dc=edu,dc=au'
+ALICE = 'uid=alice,ou=Accounts,{}'.format(BASE)
+PROJECT = 'cn=pMOSP,ou=collaborations,{}'.format(BASE)
+
+
+def mock_connection():
+    server = ldap3.Server('mock', get_info=ldap3.OFFLINE_SLAPD_2_4)
+    # The site schema's auxiliary class for posix attributes on groupOfNames
+    server.schema.object_classes['auxPosixGroup'] = server.schema.object_classes['posixGroup']
+    conn = ldap3.Connection(server, user='cn=admin,{}'.format(BASE), password='secret',
+                            client_strategy=ldap3.MOCK_SYNC, raise_exceptions=True)
+    conn.strategy.add_entry('cn=admin,{}'.format(BASE), {'userPassword': 'secret', 'sn': 'admin'})
+    for ou in ('Accounts', 'collaborations'):
+        conn.strategy.add_entry('ou={},{}'.format(ou, BASE), {'objectClass': 'organizationalUnit',
+                                                              'ou': ou})
+    conn.strategy.add_entry(ALICE, {
+        'objectClass': ['top', 'inetOrgPerson', 'posixAccount'],
+        'uid': 'alice', 'cn': 'Alice Smith', 'sn': 'Smith',
+        'uidNumber': 10001, 'gidNumber': 10001, 'homeDirectory': '/home/alice',
+        'mail': ['alice@example.org', 'asmith@example.org'],
+        'userPassword': 'hunter2', 'modifyTimestamp': '20260101000000Z'})
+    conn.strategy.add_entry(PROJECT, {
+        'objectClass': ['top', 'groupOfNames', 'auxPosixGroup'],
+        'cn': 'pMOSP', 'gidNumber': 20001, 'member': [ALICE],
+        'modifyTimestamp': '20260101000000Z'})
+    conn.bind()
+    return conn
+
+
+@pytest.fixture
+def clients(tmp_path):
+    conn = mock_connection()
+    live = ldap.Client()
+    live.conn = conn
+    replicated = ldap.Client(replicaPath=str(tmp_path / 'replica.db'))
+    replicated.conn = conn
+    # ldap3's mock doesn't implement extensible matches like (ou:dn:=...)
+    replicated.replica._groupFilter = lambda: '(objectClass=groupOfNames)'
+    return live, replicated
+
+
+@pytest.mark.parametrize('attributes', [
+    ['uid', 'uidNumber', 'gidNumber', 'mail', 'homeDirectory'],
+    ['uid', 'loginShell'],
+    ['1.1'],
+])
+def test_replica_user_matches_live(clients, attributes):
+    live, replicated = clients
+    expected = live.searchUser('alice', attributes=attributes)
+    got = replicated.searchUser('alice', attributes=attributes)
+    assert got.dn == expected.dn
+    assert dict(got['attributes']) == dict(expected['attributes'])
+
+
+def test_replica_keeps_single_values(clients):
+    live, replicated = clients
+    attrs = replicated.searchUser('alice')['attributes']
+    assert attrs['uidNumber'] == 10001
+    assert attrs['mail'] == ['alice@example.org', 'asmith@example.org']
+    assert 'userPassword' not in attrs
+    assert 'modifyTimestamp' not in attrs
+    stamp = replicated.searchUser('alice', attributes=['modifyTimestamp'])
+    assert stamp['attributes']['modifyTimestamp'] == \
+        datetime.datetime(2026, 1, 1, tzinfo=datetime.timezone.utc)
+    assert replicated.getUserByMail('ASmith@example.org').dn == ALICE
+
+
+def test_replica_project_matches_live(clients):
+    live, replicated = clients
+    attributes = ['cn', 'gidNumber', 'member']
+    expected = live.searchProject('pMOSP', attributes=attributes)
+    got = replicated.searchProject('pMOSP', attributes=attributes)
+    assert dict(got['attributes']) == dict(expected['attributes'])
+    assert replicated.getMembers('pMOSP') == [ALICE]
+
+
+def test_replica_lookups_ignore_case(clients):
+    live, replicated = clients
+    assert replicated.searchUser('ALICE').dn == live.searchUser('ALICE').dn == ALICE
+    assert replicated.searchProject('pmosp').dn == live.searchProject('pmosp').dn == PROJECT
+
+
+def test_replica_membership_index_is_cached(clients):
+    live, replicated = clients
+    index = replicated.getMembershipIndex()
+    assert replicated.getMembers('pMOSP') == [ALICE]
+    assert replicated.getMembershipIndex() is index
+    replicated.replica.invalidate()
+    assert replicated.getMembershipIndex() is not index
@@ -0,0 +1,112 @@
+from mercslurm.slurm import AssociationSnapshot, SlurmClient
+
+ASSOCIATIONS = """m3|root||
+m3|root|root|
+m3|monash||root
+m3|pMOSP||monash
+m3|pMOSP|alice|
+m3|pMOSP|bob|
+"""
+
+
+def client_with(text):
+    client = SlurmClient('/nonexistent')
+    client._snapshot = AssociationSnapshot(client, text)
+    return client
+
+
+def test_check_account_status_top_level_accounts():
+    client = client_with(ASSOCIATIONS)
+    assert client.check_account_status('root')
+    assert client.check_account_status('monash')
+    assert client.check_account_status('pMOSP')
+    assert not client.check_account_status('pNONE')
+    assert client.getusers('pMOSP') == set(['alice', 'bob'])
+
+
+def test_setallusers_leaves_accounts_without_group():
+    import mysubprocess
+    from mercslurm.slurm import GroupIndex
+    client = client_with(ASSOCIATIONS)
+    client.use_group_index(GroupIndex({'pMOSP': set(['alice', 'carol'])}, live=False))
+    debug = mysubprocess.debug
+    mysubprocess.debug = True
+    try:
+        results = client.setallusers(['root', 'monash', 'pMOSP'], pace=0)
+    finally:
+        mysubprocess.debug = debug
+    assert sorted([(verb, account, users) for verb, account, users, rc in results]) == \
+        [('add', 'pMOSP', ['carol']), ('delete', 'pMOSP', ['bob'])]
+
+
+def test_reconcile_default_accounts_keeps_failed_chunks(monkeypatch):
+    import mysubprocess
+    client = client_with(ASSOCIATIONS)
+    client._snapshot.defaults = {'alice': 'pOLD', 'bob': 'pOLD', 'carol': 'pOLD'}
+    monkeypatch.setattr(client, 'get_all_user_account_shares', lambda: {
+        'alice': {'pMOSP': 0.5, 'pOLD': 0.1},
+        'bob': {'pMOSP': 0.5, 'pOLD': 0.1},
+        'carol': {'pOTHER': 0.9, 'pOLD': 0.1}})
+    calls = []
+
+    def set_default_accounts(account, users):
+        # bob's chunk and the pOTHER modify fail
+        calls.append((account, users))
+        return 1 if 'bob' in users or account == 'pOTHER' else 0
+    monkeypatch.setattr(client, 'set_default_accounts', set_default_accounts)
+    monkeypatch.setattr(mysubprocess, 'debug', False)
+    changes = client.reconcile_default_accounts(chunk=1)
+    assert calls == [('pMOSP', ['alice']), ('pMOSP', ['bob']), ('pOTHER', ['carol'])]
+    assert changes == {'alice': ('pOLD', 'pMOSP')}
+    assert client._snapshot.defaults == {'alice': 'pMOSP', 'bob': 'pOLD', 'carol': 'pOLD'}
+
+
+def test_share_methods_keep_bytes_dicts(monkeypatch):
+    from mercslurm.shares import ShareSample
+    client = client_with(ASSOCIATIONS)
+    monkeypatch.setattr(client, 'share_rows', lambda: iter([
+        ['root', '', '1.000000', '1.000000', '', '5000', ''],
+        ['pMOSP', '', '0.250000', '0.125000', 'inf', '1234', ''],
+        ['pMOSP', 'alice', '0.500000', '0.062500', '8.0', '617', '0.75']]))
+    shares = client.get_all_shares()
+    assert shares[b'pMOSP'] == {'Account': b'pMOSP', 'NormShares': b'0.250000',
+                                'NormUsage': b'0.125000', 'LevelFS': b'inf',
+                                'RawUsage': b'1234'}
+    assert shares[b'root']['LevelFS'] == b''
+    assert client.get_shares('alice')[b'pMOSP'] == {
+        'Account': b'pMOSP', 'NormShares': b'0.250000', 'NormUsage': b'0.125000'}
+    assert client.get_account_share_quota_usage('pMOSP') == (0.25, 0.125)
+    assert isinstance(client.get_all_share_samples()['pMOSP'], ShareSample)
+    assert client.get_user_share_samples('alice')['pMOSP'].FairShare == 0.75
+
+
+def test_sacct_lines_records_streamed_bytes(tmp_path):
+    from mysubprocess import metrics
+    output = "1|alice|pMOSP|\n2|bob|pMOSP|\n"
+    sacct = tmp_path / 'sacct'
+    sacct.write_text("#!/bin/sh\nprintf '{}'\n".format(output.replace('\n', '\\n')))
+    sacct.chmod(0o755)
+    client = SlurmClient(str(tmp_path))
+    before = metrics.summary()['commands'].get('sacct', {}).get('stdout_bytes', 0)
+    rows = list(client._sacct_lines('2024-01-01', '2024-01-02', ['JobID', 'User', 'Account']))
+    assert rows == [['1', 'alice', 'pMOSP', ''], ['2', 'bob', 'pMOSP', '']]
+    after = metrics.summary()['commands']['sacct']['stdout_bytes']
+    assert after - before == len(output)
+
+
+def test_failed_batch_leaves_snapshot_unpatched():
+    import mysubprocess
+    client = client_with(ASSOCIATIONS)
+    snapshot = client.association_snapshot()
+    client.change_associations = lambda verb, account, users, cluster=None: 1
+    debug = mysubprocess.debug
+    mysubprocess.debug = False
+    try:
+        batch = client.association_batch(min_pause=0)
+        batch.add('pMOSP', 'carol')
+        batch.remove('pMOSP', 'bob')
+        assert [r[3] for r in batch.flush()] == [1, 1]
+    finally:
+        mysubprocess.debug = debug
+    assert snapshot.users['pMOSP'] == set(['alice', 'bob'])
+    assert client._snapshot is None
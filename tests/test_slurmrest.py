@@ -0,0 +1,140 @@
+import json
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+import mysubprocess
+from mercslurm.slurm import make_job
+from mercslurm.slurmrest import SlurmRestClient
+
+ASSOCIATIONS = [
+    {'cluster': 'm3', 'account': 'root', 'user': None, 'parent_account': None},
+    {'cluster': 'm3', 'account': 'monash', 'user': None, 'parent_account': 'root'},
+    {'cluster': 'm3', 'account': 'pMOSP', 'user': None, 'parent_account': 'monash'},
+    {'cluster': 'm3', 'account': 'pMOSP', 'user': 'alice', 'parent_account': 'monash'},
+]
+
+JOB = {'job_id': 42, 'user': 'alice', 'account': 'pMOSP', 'name': 'sim',
+       'required': {'CPUs': 4},
+       'state': {'current': ['COMPLETED']},
+       'time': {'elapsed': 60,
+                'submission': {'set': True, 'number': 1767225600},
+                'start': 1767225660,
+                'end': {'set': False, 'number': 0}}}
+
+
+class SlurmrestdHandler(BaseHTTPRequestHandler):
+    """A stand-in for slurmrestd answering the requests the client makes"""
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, status, data):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _record(self):
+        url = urlparse(self.path)
+        length = int(self.headers.get('Content-Length') or 0)
+        body = json.loads(self.rfile.read(length)) if length else None
+        self.server.requests.append((self.command, url.path, parse_qs(url.query), body))
+        return url.path, parse_qs(url.query), body
+
+    def do_GET(self):
+        path, query, _ = self._record()
+        if path == '/slurmdb/v0.0.39/associations':
+            self._reply(200, {'associations': ASSOCIATIONS, 'errors': []})
+        elif path == '/slurmdb/v0.0.39/jobs':
+            self._reply(200, {'jobs': [JOB], 'errors': []})
+        else:
+            self._reply(404, {'errors': [{'error': 'no such path'}]})
+
+    def do_POST(self):
+        path, _, body = self._record()
+        users = [a.get('user') for a in body.get('associations', [])]
+        if 'mallory' in users:
+            self._reply(500, {'errors': [{'error_number': 1, 'error': 'no such user'}]})
+        else:
+            self._reply(200, {'errors': []})
+
+    def do_DELETE(self):
+        self._record()
+        self._reply(200, {'errors': []})
+
+
+@pytest.fixture
+def slurmrestd():
+    server = HTTPServer(('127.0.0.1', 0), SlurmrestdHandler)
+    server.requests = []
+    thread = threading.Thread(target=server.serve_forever, args=(0.05,), daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def client(slurmrestd):
+    debug = mysubprocess.debug
+    mysubprocess.debug = False
+    yield SlurmRestClient(rest={'url': 'http://127.0.0.1:{}'.format(slurmrestd.server_port),
+                                'cluster': 'm3', 'retries': 0})
+    mysubprocess.debug = debug
+
+
+def test_association_snapshot(client, slurmrestd):
+    snapshot = client.association_snapshot()
+    assert snapshot.accounts == set(['root', 'monash', 'pMOSP'])
+    assert snapshot.parents == {'monash': 'root', 'pMOSP': 'monash'}
+    assert snapshot.users['pMOSP'] == set(['alice'])
+    assert client.check_account_status('root')
+    assert slurmrestd.requests[0][2] == {'cluster': ['m3']}
+
+
+def test_change_associations(client, slurmrestd):
+    assert client.change_associations('add', 'pMOSP', ['bob', 'carol']) == 0
+    method, path, _, body = slurmrestd.requests[-1]
+    assert (method, path) == ('POST', '/slurmdb/v0.0.39/associations')
+    assert body == {'associations': [{'account': 'pMOSP', 'user': 'bob', 'cluster': 'm3'},
+                                     {'account': 'pMOSP', 'user': 'carol', 'cluster': 'm3'}]}
+
+    assert client.change_associations('delete', 'pMOSP', ['alice']) == 0
+    method, path, query, _ = slurmrestd.requests[-1]
+    assert (method, path) == ('DELETE', '/slurmdb/v0.0.39/association')
+    assert query == {'account': ['pMOSP'], 'user': ['alice'], 'cluster': ['m3']}
+
+
+def test_change_associations_error(client, slurmrestd):
+    assert client.change_associations('add', 'pMOSP', ['mallory']) == 1
+
+
+def test_change_associations_dry_run(client, slurmrestd, capsys):
+    mysubprocess.debug = True
+    assert client.change_associations('add', 'pMOSP', ['bob']) is None
+    assert slurmrestd.requests == []
+    assert 'POST' in capsys.readouterr().out
+
+
+def test_sacct_lines_timestamps(client, slurmrestd, monkeypatch):
+    monkeypatch.setenv('TZ', 'UTC')
+    time.tzset()
+    try:
+        lines = list(client._sacct_lines('2026-01-01T00:00:00', '2026-01-02T00:00:00'))
+        query = slurmrestd.requests[-1][2]
+    finally:
+        monkeypatch.undo()
+        time.tzset()
+    assert query == {'start_time': ['1767225600'], 'end_time': ['1767312000']}
+    assert lines == [['42', 'alice', 'pMOSP', '4', '', '', '240', 'sim',
+                      '2026-01-01T00:00:00', '2026-01-01T00:01:00', 'Unknown', 'COMPLETED']]
+    job = make_job(lines[0])
+    assert job.CPUTimeRAW == 240
+    assert job.End is None
@@ -0,0 +1,33 @@
+from mercldap import ldap
+
+# The options generate_all_uids gives 'John Smith'
+OPTIONS = ['jsmith', 'johns', 'johnsmith', 'smith', 'john']
+
+
+class TakenClient(ldap.Client):
+    """Answers get_taken_usernames from a fixed set, counting searches"""
+
+    def __init__(self, taken):
+        super(TakenClient, self).__init__()
+        self.taken = set(taken)
+        self.searches = 0
+
+    def get_taken_usernames(self, uids, chunk=100):
+        self.searches += 1
+        return set(uids) & self.taken
+
+
+def test_whole_suffix_kept():
+    # One option is free, the first suffix adds all five of its options
+    client = TakenClient([o for o in OPTIONS if o != 'smith'])
+    uids = client.possible_username_handler('john@example.org', 'John Smith')
+    assert sorted(uids) == sorted(['smith'] + [o + '0001' for o in OPTIONS])
+
+
+def test_collisions_checked_in_batches():
+    taken = OPTIONS + ['{}{:04d}'.format(o, n) for o in OPTIONS for n in range(1, 40)]
+    client = TakenClient(taken)
+    uids = client.possible_username_handler('john@example.org', 'John Smith')
+    assert sorted(uids) == sorted([o + '0040' for o in OPTIONS])
+    # The unsuffixed options, then suffixes 1-25 and 26-50
+    assert client.searches == 3